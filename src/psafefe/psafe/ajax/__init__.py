@@ -15,3 +15,34 @@
 #    You should have received a copy of the GNU General Public License
 #    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html 
 #===============================================================================
+''' AJAX functions for the web UI
+'''
+from django.utils import simplejson
+from django.conf import settings
+from dajaxice.core import dajaxice_functions  # @UnresolvedImport
+from psafefe.psafe.models import MemPSafe, PasswordSafeRepo
+from psafefe.psafe import indexes
+import logging
+log = logging.getLogger("psafefe.psafe.ajax")
+log.debug('initing')
+
+
+def typeahead(request, query, limit=10):
+    """ Fuzzy lookup of entries by Title, Group or URL for the search box. 
+    Only safes that are already cached and readable by the logged in user
+    are searched so no safe passwords are needed. 
+    @return: JSON list of dicts. See indexes.fuzzyMatchDict. 
+    """
+    if not request.user.is_authenticated():
+        return simplejson.dumps([])
+    try:
+        limit = min(int(limit), getattr(settings, 'PSAFE_SEARCH_MAX_RESULTS', 100))
+    except (TypeError, ValueError):
+        limit = 10
+    if limit < 1:
+        return simplejson.dumps([])
+    repos = [repo for repo in PasswordSafeRepo.objects.all() if repo.user_can_access(user=request.user, mode="R")]
+    memSafes = list(MemPSafe.objects.filter(safe__repo__in=repos))
+    found = indexes.searchFuzzy(memSafes, query, limit=limit)
+    return simplejson.dumps([indexes.fuzzyMatchDict(entry, score, field) for entry, score, field in found])
+dajaxice_functions.register(typeahead)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+""" Pluggable backends for the decrypted psafe cache
+@warning: Backends are looked up by dotted path via getCacheBackend. Add new backends as modules in this package. 
+"""
+import logging
+log = logging.getLogger("psafefe.psafe.cache")
+log.debug('initing')
+
+# Memory-only DB tables (MemPSafe/MemPsafeEntry). Required by anything that
+# runs DB queries against the cache, such as psafe.search.
+MEMTABLE_BACKEND = 'psafefe.psafe.cache.memtable.MemTableCacheBackend'
+# In-process, slotted records. Cheap reads but local to each worker process.
+COMPACT_BACKEND = 'psafefe.psafe.cache.compact.CompactCacheBackend'
+
+# Default Django cache alias for output that includes decrypted passwords
+SECRET_CACHE_ALIAS = 'psafe-secrets'
+
+# Backend instances by dotted path
+_backends = {}
+
+
+def getCacheBackend(path=None):
+    """ Returns the cache backend instance for the given dotted path. 
+    @param path: Dotted path to a BaseCacheBackend subclass. Use None for settings.PSAFE_CACHE_BACKEND.
+    @type path: None or string
+    @return: A BaseCacheBackend instance. One instance per path per process.  
+    """
+    if path is None:
+        from django.conf import settings
+        path = getattr(settings, 'PSAFE_CACHE_BACKEND', MEMTABLE_BACKEND)
+    if path not in _backends:
+        from django.utils.importlib import import_module
+        moduleName, className = path.rsplit('.', 1)
+        log.debug("Loading cache backend %r from %r", className, moduleName)
+        _backends[path] = getattr(import_module(moduleName), className)()
+    return _backends[path]
+
+
+def forgetSafe(psafe, keep=MEMTABLE_BACKEND):
+    """ Drop the safe from every backend loaded in this process other than keep. 
+    Used after a write so backends that aren't patched reload from the new file. 
+    @param keep: Dotted path of the backend to leave alone
+    """
+    for path, backend in _backends.items():
+        if path != keep:
+            backend.remove(psafe)
+
+
+def coldScore(lastUsed, lastRefreshed, useCount, now):
+    """ Returns how cold a cached safe is. Higher scores should be evicted first. 
+    @param lastUsed: When the safe was last used or None if it never has been
+    @param lastRefreshed: When the safe was last loaded
+    @param useCount: The number of uses since the last refresh
+    @param now: The current time   
+    @return: float
+    """
+    idle = now - (lastUsed or lastRefreshed or now)
+    idleSeconds = idle.days * 24 * 60 * 60 + idle.seconds
+    return float(idleSeconds) / (1 + useCount)
+
+
+def getCacheBudget():
+    """ Returns the cache budget as a tuple of (max safes, max rows). Either may be None for no limit. """
+    from django.conf import settings
+    return (
+            getattr(settings, 'PSAFE_CACHE_MAX_SAFES', None),
+            getattr(settings, 'PSAFE_CACHE_MAX_ROWS', None),
+            )
+
+
+def getSecretCache():
+    """ Returns the Django cache for cached output that includes decrypted passwords, 
+    such as MemPSafe.todict output and psafe.search results. 
+    @return: The Django cache named by settings.PSAFE_SECRET_CACHE or None if that alias 
+    isn't in settings.CACHES. Never falls back to the default cache. 
+    """
+    from django.conf import settings
+    from django.core.cache import get_cache
+    alias = getattr(settings, 'PSAFE_SECRET_CACHE', SECRET_CACHE_ALIAS)
+    if alias not in settings.CACHES:
+        return None
+    return get_cache(alias)
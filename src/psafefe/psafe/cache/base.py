@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+""" Base psafe cache backend
+"""
+
+
+class BaseCacheBackend(object):
+    """ Interface that all psafe cache backends must provide. 
+    
+    Cached safe objects returned by get() must provide:
+        * todict(getEntries=True, getEntryHistory=True)
+        * getEntriesByGroup(groupName, history=True)
+        * onUse()
+    """
+
+    def get(self, psafe):
+        """ Return the cached safe for the given PasswordSafe
+        @raise EntryNotCached: The safe isn't in this cache  
+        """
+        raise NotImplementedError("%r doesn't implement get" % self)
+
+    def load(self, psafe, password, force=False):
+        """ Load the given PasswordSafe into the cache. 
+        @return: True if the cache was updated. False otherwise.
+        """
+        raise NotImplementedError("%r doesn't implement load" % self)
+
+    def remove(self, psafe):
+        """ Drop the given PasswordSafe from the cache, if cached """
+        raise NotImplementedError("%r doesn't implement remove" % self)
+
+    def isCurrent(self, psafe, cached):
+        """ Returns True if the cached safe from get() still matches the psafe file. 
+        Backends that aren't kept current by the write and refresh tasks must check. 
+        """
+        return True
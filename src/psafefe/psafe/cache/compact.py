@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+""" In-process cache backend. Safes are kept as compact, slotted records
+with per-field interned strings so reads don't touch the DB or the ORM. 
+@warning: Each worker process has its own copy of the cache. 
+"""
+import logging
+log = logging.getLogger("psafefe.psafe.cache.compact")
+log.debug('initing')
+
+import os
+import stat
+import datetime
+import threading
+from psafefe.psafe.cache.base import BaseCacheBackend
+
+# Entry fields that tend to repeat within a safe. Values are interned per safe.
+INTERNED_FIELDS = (
+                   'group',
+                   'title',
+                   'username',
+                   'url',
+                   'autotype',
+                   'runCommand',
+                   'email',
+                   )
+
+
+def _recordHistory(record):
+    """ Returns the old passwords for the pypwsafe record as a tuple of (password, saved) """
+    try:
+        return tuple([(old['password'], old['saved']) for old in record.getHistory()])
+    except KeyError:
+        # No history field on the record
+        return ()
+
+
+class CompactEntry(object):
+    """ A cached password safe entry. Same output as MemPsafeEntry. """
+    __slots__ = (
+                 'uuid',
+                 'group',
+                 'title',
+                 'username',
+                 'notes',
+                 'password',
+                 'creationTime',
+                 'passwordModTime',
+                 'accessTime',
+                 'passwordExpiryTime',
+                 'modTime',
+                 'url',
+                 'autotype',
+                 'runCommand',
+                 'email',
+                 # A tuple of (password, creationTime) tuples
+                 'history',
+                 )
+
+    def __init__(self, **kw):
+        for name in self.__slots__:
+            setattr(self, name, kw.get(name, None))
+
+    def todict(self, history=True):
+        """ Return an XML-RPC safe dictionary of the data. Null 
+        fields are deleted! Keys match MemPsafeEntry.todict except 
+        for 'PK', which is left out as compact entries aren't DB rows. """
+        ret = {
+             'UUID':self.uuid,
+             'Group':self.group,
+             'Title':self.title,
+             'Username':self.username,
+             'Notes':self.notes,
+             'Password':self.password,
+             'Creation Time':self.creationTime,
+             'Password Last Modification Time':self.passwordModTime,
+             'Last Access Time':self.accessTime,
+             'Password Expiry':self.passwordExpiryTime,
+             'Entry Last Modification Time':self.modTime,
+             'URL':self.url,
+             'AutoType':self.autotype,
+             'Run Command':self.runCommand,
+             'Email':self.email,
+             }
+        if history:
+            ret['History'] = [dict(Password=password, CreationTime=creationTime) for password, creationTime in self.history or ()]
+        for k, v in ret.items():
+            if v is None:
+                del ret[k]
+        return ret
+
+
+class CompactSafe(object):
+    """ A cached psafe. Same output as MemPSafe. """
+    __slots__ = (
+                 'safePK',
+                 'uuid',
+                 'dbName',
+                 'dbDescription',
+                 'dbPassword',
+                 'dbTimeStampOfLastSave',
+                 'dbLastSaveApp',
+                 'dbLastSaveHost',
+                 'dbLastSaveUser',
+                 'fileLastModified',
+                 'fileLastSize',
+                 'entryUseCount',
+                 'entryLastRefreshed',
+                 'entryLastUsed',
+                 # Tuple of CompactEntry objects
+                 'entries',
+                 # Secondary indexes
+                 'byUUID',
+                 'byGroup',
+                 # Entry and history rows held. Entries don't change once loaded. 
+                 'rows',
+                 )
+
+    def __init__(self, safePK, pypwsafe, password, fileLastModified, fileLastSize):
+        self.safePK = safePK
+        self.uuid = str(pypwsafe.getUUID())
+        self.dbName = pypwsafe.getDbName()
+        self.dbDescription = pypwsafe.getDbDesc()
+        self.dbPassword = password
+        self.dbTimeStampOfLastSave = pypwsafe.getTimeStampOfLastSave()
+        self.dbLastSaveApp = pypwsafe.getLastSaveApp()
+        self.dbLastSaveHost = pypwsafe.getLastSaveHost()
+        self.dbLastSaveUser = pypwsafe.getLastSaveUser()
+        self.fileLastModified = fileLastModified
+        self.fileLastSize = fileLastSize
+        self.entryUseCount = 0
+        self.entryLastRefreshed = datetime.datetime.now()
+        self.entryLastUsed = None
+
+        interned = dict([(name, {}) for name in INTERNED_FIELDS])
+        entries = []
+        self.byUUID = {}
+        self.byGroup = {}
+        for record in pypwsafe.getEntries():
+            values = dict(
+                          uuid=unicode(record.getUUID()),
+                          group='.'.join(record.getGroup()),
+                          title=record.getTitle(),
+                          username=record.getUsername(),
+                          notes=record.getNote(),
+                          password=record.getPassword(),
+                          creationTime=record.getCreated(),
+                          passwordModTime=record.getPasswordModified(),
+                          accessTime=record.getLastAccess(),
+                          passwordExpiryTime=record.getExpires(),
+                          modTime=record.getEntryModified(),
+                          url=record.getURL(),
+                          autotype=record.getAutoType(),
+                          runCommand=record.getRunCommand(),
+                          email=record.getEmail(),
+                          history=_recordHistory(record),
+                          )
+            for name in INTERNED_FIELDS:
+                if values[name] is not None:
+                    values[name] = interned[name].setdefault(values[name], values[name])
+            entry = CompactEntry(**values)
+            entries.append(entry)
+            self.byUUID.setdefault(entry.uuid, []).append(entry)
+            self.byGroup.setdefault(entry.group, []).append(entry)
+        self.entries = tuple(entries)
+        self.rows = len(self.entries) + sum([len(i.history) for i in self.entries])
+
+    def onUse(self, save=True):
+        """ The safe has been used """
+        self.entryUseCount += 1
+        self.entryLastUsed = datetime.datetime.now()
+
+    def todict(self, getEntries=True, getEntryHistory=True):
+        """ Return an XML-RPC safe dictionary of the data. Null 
+        fields are deleted! """
+        ret = {
+             'PK':self.safePK,
+             'UUID':self.uuid,
+             'Name':self.dbName,
+             'Description':self.dbDescription,
+             'Password':self.dbPassword,
+             'Last Save Time':self.dbTimeStampOfLastSave,
+             'Last Save App':self.dbLastSaveApp,
+             'Last Save Host':self.dbLastSaveHost,
+             'Last Save User':self.dbLastSaveUser,
+             }
+        if getEntries:
+            ret['Entries'] = [i.todict(history=getEntryHistory) for i in self.entries]
+        for k, v in ret.items():
+            if v is None:
+                del ret[k]
+        return ret
+
+    def rowCount(self):
+        """ The number of entry and history rows held. Comparable to the memory table cache's rows. """
+        return self.rows
+
+    def getEntriesByGroup(self, groupName, history=True):
+        """ Return a list of entry dicts that are in the given group """
+        return [i.todict(history=history) for i in self.byGroup.get(groupName, [])]
+
+    def getEntriesByUUID(self, uuid, history=True):
+        """ Return a list of entry dicts with the given UUID """
+        return [i.todict(history=history) for i in self.byUUID.get(unicode(uuid), [])]
+
+
+class CompactCacheBackend(BaseCacheBackend):
+    """ Cache safes as CompactSafe objects in this process's memory """
+
+    def __init__(self):
+        # CompactSafe objects by PasswordSafe PK
+        self.safes = {}
+        self.lock = threading.RLock()
+
+    def get(self, psafe):
+        from psafefe.psafe.errors import EntryNotCached
+        try:
+            return self.safes[psafe.pk]
+        except KeyError:
+            raise EntryNotCached("%r doesn't have a cached entry" % psafe)
+
+    def isCurrent(self, psafe, cached):
+        """ Nothing patches or refreshes compact safes, so compare the file's 
+        size and last-modified time with what was loaded. """
+        try:
+            info = os.stat(psafe.psafePath())
+        except OSError:
+            return False
+        return cached.fileLastModified == datetime.datetime.fromtimestamp(info[stat.ST_MTIME]) and cached.fileLastSize == info[stat.ST_SIZE]
+
+    def load(self, psafe, password, force=False):
+        from pypwsafe import PWSafe3
+        from psafefe.psafe.errors import NoAccessToPasswordSafe
+        if not os.access(psafe.psafePath(), os.R_OK):
+            raise NoAccessToPasswordSafe, "Can't read psafe file %r" % psafe.psafePath()
+        info = os.stat(psafe.psafePath())
+        fileLastModified = datetime.datetime.fromtimestamp(info[stat.ST_MTIME])
+        fileLastSize = info[stat.ST_SIZE]
+
+        existing = self.safes.get(psafe.pk, None)
+        if existing and not force and existing.fileLastModified == fileLastModified and existing.fileLastSize == fileLastSize:
+            log.debug("No change in size or last-modified for %r. Not loading. ", psafe)
+            return False
+
+        # Let standard psafe errors travel on up
+        pypwsafe = PWSafe3(
+                         filename=psafe.psafePath(),
+                         password=password,
+                         mode="R",
+                         )
+        if pypwsafe.getUUID() != psafe.uuid:
+            psafe.uuid = pypwsafe.getUUID()
+            psafe.save()
+        compact = CompactSafe(
+                              safePK=psafe.pk,
+                              pypwsafe=pypwsafe,
+                              password=password,
+                              fileLastModified=fileLastModified,
+                              fileLastSize=fileLastSize,
+                              )
+        with self.lock:
+            self.safes[psafe.pk] = compact
+            self.evict(keepPKs=[psafe.pk, ])
+        log.debug("Cached %d entries from %r", len(compact.entries), psafe)
+        return True
+
+    def evict(self, keepPKs=[]):
+        """ Drop the coldest safes until the cache is within budget. Evicted safes
+        are reloaded by PasswordSafe.getCached(canLoad=True) the next time they're used. 
+        @return: int, the number of safes evicted
+        """
+        from psafefe.psafe.cache import coldScore, getCacheBudget
+        maxSafes, maxRows = getCacheBudget()
+        if maxSafes is None and maxRows is None:
+            return 0
+        with self.lock:
+            now = datetime.datetime.now()
+            candidates = []
+            rowCount = 0
+            for pk, safe in self.safes.items():
+                rowCount += safe.rowCount()
+                if pk not in keepPKs:
+                    candidates.append((coldScore(safe.entryLastUsed, safe.entryLastRefreshed, safe.entryUseCount, now), pk))
+            # Coldest first
+            candidates.sort(reverse=True)
+            evicted = 0
+            for score, pk in candidates:
+                if (maxSafes is None or len(self.safes) <= maxSafes) and (maxRows is None or rowCount <= maxRows):
+                    break
+                log.debug("Evicting safe %r with a score of %r", pk, score)
+                rowCount -= self.safes.pop(pk).rowCount()
+                evicted += 1
+        return evicted
+
+    def remove(self, psafe):
+        with self.lock:
+            self.safes.pop(psafe.pk, None)
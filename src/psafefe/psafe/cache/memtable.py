@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+""" Cache backend using memory-only DB tables. This is the default backend.
+"""
+import logging
+log = logging.getLogger("psafefe.psafe.cache.memtable")
+log.debug('initing')
+
+from psafefe.psafe.cache.base import BaseCacheBackend
+
+
+class MemTableCacheBackend(BaseCacheBackend):
+    """ Cache safes in MemPSafe, MemPsafeEntry and MemPasswordEntryHistory """
+
+    def get(self, psafe):
+        from psafefe.psafe.models import MemPSafe
+        from psafefe.psafe.errors import EntryNotCached
+        try:
+            return MemPSafe.objects.get(safe=psafe)
+        except MemPSafe.DoesNotExist:
+            raise EntryNotCached("%r doesn't have a cached entry" % psafe)
+
+    def load(self, psafe, password, force=False):
+        from psafefe.psafe.tasks.load import loadSafe
+        ls = loadSafe.delay(psafe_pk=psafe.pk, password=password, force=force)  # @UndefinedVariable
+        return ls.wait()
+
+    def remove(self, psafe):
+        from psafefe.psafe.models import MemPSafe
+        for memPSafe in MemPSafe.objects.filter(safe=psafe):
+            memPSafe.invalidateSerialized()
+        MemPSafe.objects.filter(safe=psafe).delete()
@@ -42,3 +42,16 @@ class CantLocateHelperFiles(ValueError):
 class EntryNotCached(KeyError):
     """ Can't find a cached entry for the requested PasswordSafe """
     
+
+class BatchedWriteError(ValueError):
+    """ A modifyEntries batch that was merged into another task's write failed. 
+    The message has the original error. """
+
+class JournalIntegrityError(ValueError):
+    """ A sealed write journal value failed its HMAC check """
+
+class InvalidImportError(ValueError):
+    """ Bulk import data couldn't be parsed """
+
+class TooManyMatchesError(ValueError):
+    """ A modifyEntries action with an onMaxMatches of 'fail' matched more than maxMatches entries """
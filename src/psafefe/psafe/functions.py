@@ -25,8 +25,10 @@ from psafefe.psafe.models import *
 from os.path import join
 from django.conf import settings
 import os
+import time
 from psafefe.psafe.errors import *
 from psafefe.psafe.rpc.errors import *
+from psafefe.psafe.cache import MEMTABLE_BACKEND
 
 
 def getPersonalPsafeRepo():
@@ -86,8 +88,7 @@ def getDatabasePasswordByUser(user, userPassword, psafe, ppsafe=None, wait=True)
     assert psafe.repo.user_can_access(user=user, mode="R")
 
     # work delayed
-    memsafe = MemPSafe.objects.get(safe=ppsafe)
-    memsafe.onUse()
+    memsafe = _personalMemSafe(ppsafe, userPassword)
     ents = MemPsafeEntry.objects.filter(safe=memsafe)
     ents = ents.filter(group="Password Safe Passwords.%d" % psafe.repo.pk)
     ents = ents.filter(title="PSafe id %d" % psafe.pk)
@@ -104,6 +105,36 @@ def getDatabasePasswordByUser(user, userPassword, psafe, ppsafe=None, wait=True)
 
 
 
+def getSafesWithPasswordsByUser(user, userPassword, psafes):
+    """ Returns the psafes that the user has the password for in their personal DB. 
+    Does one lookup for all of the safes. 
+    @param psafes: PasswordSafe objects. The user's access to their repos must already be checked. 
+    @return: A list of PasswordSafe objects
+    """
+    ppsafe = getUsersPersonalSafe(user, userPassword, wait=True)
+    assert user.check_password(userPassword)
+    assert ppsafe.owner == user
+    memsafe = _personalMemSafe(ppsafe, userPassword)
+    stored = set(MemPsafeEntry.objects.filter(
+                                              safe=memsafe,
+                                              group__startswith="Password Safe Passwords.",
+                                              ).values_list('group', 'title', 'username'))
+    return [psafe for psafe in psafes if ("Password Safe Passwords.%d" % psafe.repo_id, "PSafe id %d" % psafe.pk, psafe.filename) in stored]
+
+
+def _personalMemSafe(ppsafe, userPassword):
+    """ Returns the cache of the user's personal safe, loading it if needed """
+    try:
+        memsafe = MemPSafe.objects.get(safe=ppsafe)
+    except MemPSafe.DoesNotExist:
+        # Evicted from the cache
+        from psafefe.psafe.tasks.load import loadSafe
+        loadSafe(psafe_pk=ppsafe.pk, password=userPassword, force=False)
+        memsafe = MemPSafe.objects.get(safe=ppsafe)
+    memsafe.onUse()
+    return memsafe
+
+
 def setDatabasePasswordByUser(user, userPassword, psafe, psafePassword, wait=True):
     """ Store/update the password for the given psafe in the user's personal psafe """
     repo = psafe.repo
@@ -142,3 +173,95 @@ def setDatabasePasswordByUser(user, userPassword, psafe, psafePassword, wait=Tru
     if wait:
         task.wait()
 
+
+def getReadableMemSafes(user, userPassword, safeIDs=None):
+    """ Returns the MemPSafes to search. If safeIDs is empty, every cached safe
+    the user can read and has the password for is used. Otherwise the listed 
+    safes are loaded if needed. 
+    @raise EntryDoesntExistError: One of the safes doesn't exist or the user doesn't have permission to read it.
+    @raise NoPasswordForPasswordSafe: The user doesn't have the password for one of the listed safes
+    """
+    memSafes = []
+    if safeIDs:
+        for safeID in safeIDs:
+            try:
+                safe = PasswordSafe.objects.get(pk=safeID)
+            except PasswordSafe.DoesNotExist:
+                raise EntryDoesntExistError("No safe with an ID of %r" % safeID)
+            if not safe.repo.user_can_access(user=user, mode="R"):
+                log.warning("User %r is NOT allowed to access %r", user, safe.repo)
+                raise EntryDoesntExistError("No safe with an ID of %r" % safeID)
+            memSafes.append(safe)
+        memSafes = loadMemSafes(user, userPassword, memSafes, wait=True)[0].values()
+    else:
+        repos = [repo for repo in PasswordSafeRepo.objects.all() if repo.user_can_access(user=user, mode="R")]
+        memSafes = list(MemPSafe.objects.filter(safe__repo__in=repos).select_related('safe'))
+        allowed = set([safe.pk for safe in getSafesWithPasswordsByUser(user, userPassword, [memSafe.safe for memSafe in memSafes])])
+        memSafes = [memSafe for memSafe in memSafes if memSafe.safe_id in allowed]
+    return memSafes
+
+
+def loadMemSafes(user, userPassword, safes, wait=True, passwords=None):
+    """ Returns the memory table cache of each safe. Uncached safes are loaded
+    in parallel. Up to settings.PSAFE_SEARCH_MAX_PARALLEL_LOADS loads are run
+    at once and a new one is started as soon as any finishes. 
+    The user's access to the safes' repos must already be checked. 
+    @param safes: The PasswordSafe objects to get the cache of
+    @param wait: If False, don't wait for loads. Uncached safes are queued to load
+    and left out of the results. 
+    @param passwords: If a dict is given, it's filled in with safe PK => the safe's password
+    from the user's personal safe. 
+    @return: A tuple of a dict of safe PK => MemPSafe and a list of the PKs of the safes still loading
+    @raise EntryNotCached: A safe failed to load
+    @raise NoPasswordForPasswordSafe: The user doesn't have the password for one of the safes
+    """
+    from django.core.cache import cache
+    from psafefe.psafe.tasks.load import loadSafe, evictColdSafes
+    # Cached or not, the user must have each safe's password
+    ppsafe = getUsersPersonalSafe(user, userPassword, wait=True)
+    dbPasswords = {} if passwords is None else passwords
+    for safe in safes:
+        dbPasswords[safe.pk] = getDatabasePasswordByUser(user, userPassword, safe, ppsafe=ppsafe, wait=True)
+
+    memSafes = dict([(memSafe.safe_id, memSafe) for memSafe in MemPSafe.objects.filter(safe__in=safes)])
+    uncached = [safe for safe in safes if safe.pk not in memSafes]
+    if not uncached:
+        return memSafes, []
+
+    if not wait:
+        loading = []
+        for safe in uncached:
+            # Don't queue the same safe again while it's still loading
+            if cache.add("psafe-loading-%d" % safe.pk, True, getattr(settings, 'PSAFE_SEARCH_LOAD_TIMEOUT', 60)):
+                loadSafe.delay(psafe_pk=safe.pk, password=dbPasswords[safe.pk], force=False)  # @UndefinedVariable
+            loading.append(safe.pk)
+        log.debug("Queued loading of %d uncached safes for %r", len(loading), user)
+        return memSafes, loading
+
+    maxParallel = getattr(settings, 'PSAFE_SEARCH_MAX_PARALLEL_LOADS', 4)
+    log.debug("Loading %d uncached safes for %r, up to %d at a time", len(uncached), user, maxParallel)
+    toLoad = list(uncached)
+    running = []
+    while toLoad or running:
+        while toLoad and len(running) < maxParallel:
+            safe = toLoad.pop(0)
+            # Evicting per load could drop safes this call just loaded
+            running.append((safe, loadSafe.delay(psafe_pk=safe.pk, password=dbPasswords[safe.pk], force=False, evict=False)))  # @UndefinedVariable
+        finished = [(safe, task) for safe, task in running if task.ready()]
+        if not finished:
+            time.sleep(0.05)
+            continue
+        for safe, task in finished:
+            running.remove((safe, task))
+            try:
+                task.get()
+            except Exception, e:
+                raise EntryNotCached, "%r doesn't have a cached entry and loading failed with %r" % (safe, e)
+    for memSafe in MemPSafe.objects.filter(safe__in=uncached):
+        memSafes[memSafe.safe_id] = memSafe
+    for safe in uncached:
+        if safe.pk not in memSafes:
+            raise EntryNotCached, "%r doesn't have a cached entry after loading" % safe
+    # Make room without dropping any of the safes being searched
+    evictColdSafes(keepPKs=[memSafe.pk for memSafe in memSafes.values()])
+    return memSafes, []
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Bulk entry import. Rows from a CSV or JSON upload are validated and
+turned into add-update actions so a whole import is applied in one 
+modifyEntries call, i.e. one decrypt, one save and one cache patch. 
+'''
+import logging
+log = logging.getLogger("psafefe.psafe.importer")
+log.debug('initing')
+
+from psafefe.psafe.errors import InvalidImportError
+from cStringIO import StringIO
+from uuid import UUID
+import csv
+import json
+
+# Record fields that can be imported
+IMPORT_FIELDS = (
+                 'UUID',
+                 'Group',
+                 'Title',
+                 'Username',
+                 'Password',
+                 'Notes',
+                 'URL',
+                 'EMail',
+                 'AutoType',
+                 'Run Command',
+                 )
+# Fields every row must have
+REQUIRED_FIELDS = ('Title', 'Password')
+# Used to find an existing entry when a row has no UUID
+MATCH_FIELDS = ('Group', 'Title', 'Username')
+IMPORT_FORMATS = ('csv', 'json')
+
+
+def parseRows(data, format='csv'):
+    """ Parse an import upload into a list of row dicts. 
+    @param data: The upload. Byte strings must be UTF-8. 
+    @type data: string or unicode
+    @param format: 'csv' for a CSV file with a header row of field names. 'json' for
+    a list of objects or one object per line. 
+    @type format: string
+    @raise InvalidImportError: The data isn't valid for the format
+    """
+    if format == 'csv':
+        # The csv module only handles bytes. Cells are decoded by validateRows. 
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        try:
+            rows = []
+            for row in csv.DictReader(StringIO(data)):
+                # Empty cells are the same as a missing field
+                rows.append(dict([(k, v) for k, v in row.items() if k is not None and v not in (None, '')]))
+            return rows
+        except csv.Error, e:
+            raise InvalidImportError("Invalid CSV: %s" % e)
+    elif format == 'json':
+        data = data.strip()
+        try:
+            if data.startswith('['):
+                rows = json.loads(data)
+            else:
+                rows = [json.loads(line) for line in data.splitlines() if line.strip()]
+        except ValueError, e:
+            raise InvalidImportError("Invalid JSON: %s" % e)
+        for row in rows:
+            if not isinstance(row, dict):
+                raise InvalidImportError("Expected each JSON row to be an object, not %r" % type(row))
+        return rows
+    raise InvalidImportError("Unknown import format %r. Expected one of %r" % (format, IMPORT_FORMATS))
+
+
+def _cleanText(value):
+    """ Returns the value as unicode. Byte strings must be UTF-8. 
+    @raise ValueError: The value isn't text or a number
+    """
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError("%r isn't valid UTF-8" % value)
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return unicode(value)
+    raise ValueError("Expected text, not %r" % type(value).__name__)
+
+
+def _cleanGroup(value):
+    """ Returns the group as a list of unicode names 
+    @raise ValueError: The group isn't a dot separated string or a list of strings
+    """
+    if isinstance(value, basestring):
+        value = _cleanText(value).split(u'.')
+    elif not isinstance(value, (list, tuple)):
+        raise ValueError("Group must be a dot separated string or a list of strings, not %r" % type(value).__name__)
+    ret = []
+    for name in value:
+        if not isinstance(name, basestring):
+            raise ValueError("Group names must be strings, not %r" % type(name).__name__)
+        ret.append(_cleanText(name))
+    return ret
+
+
+def validateRows(rows):
+    """ Check and normalize import rows
+    @return: A tuple of (valid rows, errors). Valid rows are (row number, row) 
+    tuples with groups split into lists and UUIDs converted to UUID objects. 
+    Errors are dicts with the one-based 'Row' number and an 'Error' message. 
+    """
+    valid = []
+    errors = []
+    seen = set()
+    for rowNumber, row in enumerate(rows, 1):
+        unknown = [k for k in row.keys() if k not in IMPORT_FIELDS]
+        if unknown:
+            errors.append(dict(Row=rowNumber, Error="Unknown fields %r" % sorted(unknown)))
+            continue
+        missing = [k for k in REQUIRED_FIELDS if not row.get(k)]
+        if missing:
+            errors.append(dict(Row=rowNumber, Error="Missing fields %r" % missing))
+            continue
+        clean = {}
+        try:
+            for field, value in row.items():
+                if value is None:
+                    # Same as a missing field
+                    continue
+                if field == 'Group':
+                    clean[field] = _cleanGroup(value)
+                else:
+                    clean[field] = _cleanText(value)
+        except ValueError, e:
+            errors.append(dict(Row=rowNumber, Error="Invalid %s: %s" % (field, e)))
+            continue
+        if 'UUID' in clean:
+            try:
+                clean['UUID'] = UUID(clean['UUID'])
+            except ValueError:
+                errors.append(dict(Row=rowNumber, Error="Invalid UUID %r" % clean['UUID']))
+                continue
+            key = clean['UUID']
+        else:
+            key = tuple([tuple(clean.get(i) or ()) if i == 'Group' else clean.get(i) for i in MATCH_FIELDS])
+        if key in seen:
+            errors.append(dict(Row=rowNumber, Error="Duplicate of an earlier row"))
+            continue
+        seen.add(key)
+        valid.append((rowNumber, clean))
+    log.debug("Validated %d rows. %d are valid. ", len(rows), len(valid))
+    return valid, errors
+
+
+def importActions(rows):
+    """ Returns the modifyEntries actions for a list of validated row dicts. 
+    Rows with a UUID update the entry with that UUID, others update the 
+    entry with the same group, title and username. A row without a group
+    or username only matches entries without one. A new entry is added 
+    if there isn't one. 
+    """
+    actions = []
+    for row in rows:
+        if 'UUID' in row:
+            vfilters = {'UUID':row['UUID']}
+        else:
+            vfilters = dict([(i, row.get(i)) for i in MATCH_FIELDS])
+        actions.append({
+                        'action':'add-update',
+                        'refilters':{},
+                        'vfilters':vfilters,
+                        'changes':row,
+                        })
+    return actions
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Secondary indexes over the memory table cache. All of these are
+maintained by loadSafe. 
+'''
+import logging
+log = logging.getLogger("psafefe.psafe.indexes")
+log.debug('initing')
+
+from hashlib import sha1, sha256
+import hmac
+import math
+import re
+
+
+#            Group index
+def groupHash(path):
+    """ Returns the hash used to look up a dot separated group path """
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return sha1(path or '').hexdigest()
+
+
+def groupAncestors(path):
+    """ Returns the given group path and all of its parents, top level first. 
+    e.g. 'Datacenter.East.Web' => ['Datacenter', 'Datacenter.East', 'Datacenter.East.Web'] 
+    """
+    if not path:
+        return []
+    parts = path.split('.')
+    return ['.'.join(parts[:i]) for i in xrange(1, len(parts) + 1)]
+
+
+def rebuildGroupIndex(memPSafe):
+    """ Rebuild the group tree for a cached safe 
+    @return: int, the number of groups indexed
+    """
+    from psafefe.psafe.models import MemPsafeEntry, MemPsafeGroup, MemPsafeGroupMember
+    MemPsafeGroup.objects.filter(safe=memPSafe).delete()
+
+    # Entry PKs that are in each group's subtree
+    members = {}
+    for entryPK, group in MemPsafeEntry.objects.filter(safe=memPSafe).values_list('pk', 'group'):
+        for path in groupAncestors(group):
+            members.setdefault(path, []).append(entryPK)
+
+    groups = []
+    for path, entryPKs in members.items():
+        parts = path.split('.')
+        groups.append(MemPsafeGroup(
+                                    safe=memPSafe,
+                                    path=path,
+                                    pathHash=groupHash(path),
+                                    parentHash=groupHash('.'.join(parts[:-1])),
+                                    name=parts[-1],
+                                    depth=len(parts),
+                                    entryCount=len(entryPKs),
+                                    ))
+    MemPsafeGroup.objects.bulk_create(groups)
+
+    # bulk_create doesn't set PKs
+    groupPKs = dict(MemPsafeGroup.objects.filter(safe=memPSafe).values_list('path', 'pk'))
+    links = []
+    for path, entryPKs in members.items():
+        for entryPK in entryPKs:
+            links.append(MemPsafeGroupMember(group_id=groupPKs[path], entry_id=entryPK))
+    MemPsafeGroupMember.objects.bulk_create(links)
+    log.debug("Indexed %d groups and %d group links for %r", len(groups), len(links), memPSafe)
+    return len(groups)
+
+
+def getChildGroups(memPSafe, path):
+    """ Returns the MemPsafeGroup objects directly under the given group path. Use 
+    an empty path for the top level groups. """
+    from psafefe.psafe.models import MemPsafeGroup
+    return MemPsafeGroup.objects.filter(safe=memPSafe, parentHash=groupHash(path)).order_by('name')
+
+
+def getGroupTreeEntries(memPSafe, path):
+    """ Returns a queryset of all entries in the given group and its sub-groups. 
+    Use an empty path for the whole safe. """
+    from psafefe.psafe.models import MemPsafeEntry
+    if not path:
+        return MemPsafeEntry.objects.filter(safe=memPSafe)
+    return MemPsafeEntry.objects.filter(
+                                        mempsafegroupmember__group__safe=memPSafe,
+                                        mempsafegroupmember__group__pathHash=groupHash(path),
+                                        )
+
+
+#            Text index
+# (todict name, model field, rank weight) of fields in the text index
+TEXT_FIELDS = (
+               ('Title', 'title', 5),
+               ('Group', 'group', 3),
+               ('Username', 'username', 3),
+               ('URL', 'url', 3),
+               ('Email', 'email', 2),
+               ('Notes', 'notes', 1),
+               )
+TOKEN_MAX_LENGTH = 64
+TOKEN_SPLIT_RE = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def tokenize(text):
+    """ Returns the set of lower case tokens in the given text. 
+    e.g. 'db-prod-01.example.com' => set(['db', 'prod', '01', 'example', 'com'])  
+    """
+    if not text:
+        return set()
+    return set([i[:TOKEN_MAX_LENGTH] for i in TOKEN_SPLIT_RE.split(text.lower()) if i])
+
+
+def _textFields():
+    """ Returns the TEXT_FIELDS that are enabled """
+    from django.conf import settings
+    if getattr(settings, 'PSAFE_TEXT_INDEX_NOTES', False):
+        return TEXT_FIELDS
+    return [i for i in TEXT_FIELDS if i[0] != 'Notes']
+
+
+def indexEntryText(memEntry, new=False):
+    """ Replace the text index rows for the given entry 
+    @param new: Set if the entry was just created so there are no rows to remove
+    @return: int, the number of tokens indexed 
+    """
+    from psafefe.psafe.models import MemEntryToken
+    if not new:
+        MemEntryToken.objects.filter(entry=memEntry).delete()
+    rows = []
+    for name, modelField, weight in _textFields():
+        for token in tokenize(getattr(memEntry, modelField)):
+            rows.append(MemEntryToken(
+                                      safe_id=memEntry.safe_id,
+                                      entry=memEntry,
+                                      field=name,
+                                      token=token,
+                                      weight=weight,
+                                      ))
+    MemEntryToken.objects.bulk_create(rows)
+    return len(rows)
+
+
+def searchText(memSafes, query, fields=None, offset=0, limit=50):
+    """ Find entries that contain every token in query, best matches first. 
+    @param memSafes: The MemPSafe objects to search
+    @param query: Free text. Matched per token, case-insensitive.
+    @param fields: None for all indexed fields or a list of todict field names to limit matches to 
+    @return: tuple(total number of matches, list of (MemPsafeEntry, score))
+    """
+    from django.db.models import Count, Sum
+    from psafefe.psafe.models import MemEntryToken, MemPsafeEntry
+    tokens = tokenize(query)
+    if not tokens:
+        return (0, [])
+    rows = MemEntryToken.objects.filter(safe__in=memSafes, token__in=tokens)
+    if fields:
+        rows = rows.filter(field__in=fields)
+    matches = rows.values('entry').annotate(
+                                            matched=Count('token', distinct=True),
+                                            score=Sum('weight'),
+                                            ).filter(matched=len(tokens))
+    total = matches.count()
+    page = list(matches.order_by('-score', 'entry')[offset:offset + limit])
+    entries = MemPsafeEntry.objects.select_related('safe').in_bulk([i['entry'] for i in page])
+    return (total, [(entries[i['entry']], i['score']) for i in page if i['entry'] in entries])
+
+
+#            Trigram index
+# (todict name, model field) of fields in the trigram index
+TRIGRAM_FIELDS = (
+                  ('Title', 'title'),
+                  ('Group', 'group'),
+                  ('URL', 'url'),
+                  )
+
+
+def trigrams(text):
+    """ Returns the set of lower case trigrams in the given text. The text is
+    padded so short values and the start of values still match. 
+    e.g. 'db1' => set(['  d', ' db', 'db1', 'b1 '])
+    """
+    if not text:
+        return set()
+    padded = u"  %s " % text.lower()
+    return set([padded[i:i + 3] for i in xrange(len(padded) - 2)])
+
+
+def indexEntryTrigrams(memEntry, new=False):
+    """ Replace the trigram index rows for the given entry 
+    @param new: Set if the entry was just created so there are no rows to remove
+    @return: int, the number of trigrams indexed 
+    """
+    from psafefe.psafe.models import MemEntryTrigram
+    if not new:
+        MemEntryTrigram.objects.filter(entry=memEntry).delete()
+    rows = []
+    for name, modelField in TRIGRAM_FIELDS:
+        grams = trigrams(getattr(memEntry, modelField))
+        for gram in grams:
+            rows.append(MemEntryTrigram(
+                                        safe_id=memEntry.safe_id,
+                                        entry=memEntry,
+                                        field=name,
+                                        trigram=gram,
+                                        total=len(grams),
+                                        ))
+    MemEntryTrigram.objects.bulk_create(rows)
+    return len(rows)
+
+
+def searchFuzzy(memSafes, query, limit=10, minSimilarity=0.2):
+    """ Find entries whose Title, Group or URL is similar to query, most similar first. 
+    Similarity is the Jaccard index of the query's and the field's trigrams. 
+    @param memSafes: The MemPSafe objects to search
+    @return: A list of (MemPsafeEntry, similarity, matching todict field name)
+    """
+    from django.db.models import Count, Max
+    from psafefe.psafe.models import MemEntryTrigram, MemPsafeEntry
+    grams = trigrams(query)
+    if not grams:
+        return []
+    # A field sharing n of the query's trigrams scores at most n / len(grams). 
+    # Fields sharing fewer can't reach minSimilarity so the DB drops them. 
+    minShared = max(1, int(math.ceil(minSimilarity * len(grams) - 1e-9)))
+    # The union size needs both totals so the final score is done here. 
+    candidates = MemEntryTrigram.objects.filter(
+                                                safe__in=memSafes,
+                                                trigram__in=grams,
+                                                ).values('entry', 'field').annotate(
+                                                                                  shared=Count('trigram'),
+                                                                                  total=Max('total'),
+                                                                                  ).filter(shared__gte=minShared)
+    best = {}
+    for i in candidates:
+        score = float(i['shared']) / (len(grams) + i['total'] - i['shared'])
+        if score >= minSimilarity and score > best.get(i['entry'], (0.0, None))[0]:
+            best[i['entry']] = (score, i['field'])
+    top = sorted(best.items(), key=lambda i: (-i[1][0], i[0]))[:limit]
+    entries = MemPsafeEntry.objects.select_related('safe').in_bulk([entryPK for entryPK, match in top])
+    return [(entries[entryPK], score, field) for entryPK, (score, field) in top if entryPK in entries]
+
+
+def fuzzyMatchDict(entry, score, field):
+    """ Returns the lightweight dict used for fuzzy matches. Doesn't include the password. """
+    return {
+            'PK':entry.pk,
+            'UUID':entry.uuid,
+            'Title':entry.title,
+            'Group':entry.group,
+            'URL':entry.url,
+            'Safe PK':entry.safe.safe_id,
+            'Score':score,
+            'Field':field,
+            }
+
+
+#            Password digest index
+def _passwordIndexKey():
+    """ Returns the HMAC key for password digests """
+    from django.conf import settings
+    key = getattr(settings, 'PSAFE_PASSWORD_INDEX_KEY', None)
+    if not key:
+        # Don't use SECRET_KEY directly so the digests can't be used against anything else keyed with it
+        key = sha256("psafefe.psafe.indexes.passwordDigest" + settings.SECRET_KEY).digest()
+    return key
+
+
+def passwordDigest(password):
+    """ Returns the hex keyed digest of the given password """
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    return hmac.new(_passwordIndexKey(), password or '', sha256).hexdigest()
+
+
+def indexEntryPasswords(memEntry, oldPasswords, new=False):
+    """ Replace the password digest rows for the given entry 
+    @param oldPasswords: The entry's old passwords
+    @type oldPasswords: A list of strings
+    @param new: Set if the entry was just created so there are no rows to remove
+    @return: int, the number of digests indexed
+    """
+    from psafefe.psafe.models import MemPasswordDigest
+    if not new:
+        MemPasswordDigest.objects.filter(entry=memEntry).delete()
+    rows = []
+    if memEntry.password:
+        rows.append(MemPasswordDigest(safe_id=memEntry.safe_id, entry=memEntry, digest=passwordDigest(memEntry.password), current=True))
+    for old in set([old for old in oldPasswords if old]):
+        rows.append(MemPasswordDigest(safe_id=memEntry.safe_id, entry=memEntry, digest=passwordDigest(old), current=False))
+    MemPasswordDigest.objects.bulk_create(rows)
+    return len(rows)
+
+
+def entriesByPassword(memSafes, password, current=None):
+    """ Returns the entries that have or had the given password 
+    @param current: True for current passwords only, False for old passwords only, None for both
+    @return: A list of tuples of (MemPsafeEntry, current)
+    """
+    from psafefe.psafe.models import MemPasswordDigest
+    digests = MemPasswordDigest.objects.filter(safe__in=memSafes, digest=passwordDigest(password))
+    if current is not None:
+        digests = digests.filter(current=current)
+    return [(i.entry, i.current) for i in digests.select_related('entry', 'entry__safe').order_by('entry', '-current')]
+
+
+def passwordReuse(memSafes, minCount=2):
+    """ Find current passwords shared by minCount or more entries. Done as a 
+    grouped query on the digest index. 
+    @return: A list of lists of MemPsafeEntry objects with the same password. Largest groups first. 
+    """
+    from django.db.models import Count
+    from psafefe.psafe.models import MemPasswordDigest
+    shared = MemPasswordDigest.objects.filter(
+                                              safe__in=memSafes,
+                                              current=True,
+                                              ).values('digest').annotate(
+                                                                          count=Count('entry'),
+                                                                          ).filter(count__gte=minCount).order_by('-count')
+    counts = [(i['digest'], i['count']) for i in shared]
+    groups = dict([(digest, []) for digest, count in counts])
+    if groups:
+        rows = MemPasswordDigest.objects.filter(
+                                                safe__in=memSafes,
+                                                current=True,
+                                                digest__in=groups.keys(),
+                                                ).select_related('entry', 'entry__safe')
+        for i in rows:
+            groups[i.digest].append(i.entry)
+    return [groups[digest] for digest, count in counts]
+
+
+#            All per-entry indexes
+def entryIndexValues(memEntry):
+    """ Returns the values of all per-entry indexed fields. Used to check if an entry needs reindexing. """
+    return tuple([getattr(memEntry, modelField) for name, modelField, weight in _textFields()] + \
+                 [getattr(memEntry, modelField) for name, modelField in TRIGRAM_FIELDS])
+
+
+def indexEntry(memEntry, new=False):
+    """ Update the text and trigram indexes for the given entry 
+    @param new: Set if the entry was just created so there are no rows to remove
+    """
+    indexEntryText(memEntry, new=new)
+    indexEntryTrigrams(memEntry, new=new)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Durable write journal. Write batches are stored encrypted in WriteJournal
+and applied to the safe files in order by the applyWriteJournal task. Until 
+then, overlayEntries and the helpers built on it show a user their own pending
+changes in the psafe.read RPCs. 
+'''
+import logging
+log = logging.getLogger("psafefe.psafe.journal")
+log.debug('initing')
+
+from django.conf import settings
+from psafefe.psafe.errors import JournalIntegrityError
+from psafefe.utils import compilePattern
+from hashlib import sha256
+from base64 import b64encode, b64decode
+import cPickle as pickle
+from uuid import UUID, uuid4
+import hmac
+import os
+
+# Twofish, as used by the safes themselves
+BLOCK_SIZE = 16
+MAC_SIZE = 32
+
+
+def _journalKeys():
+    """ Returns a tuple of the (encryption key, HMAC key) """
+    key = getattr(settings, 'PSAFE_JOURNAL_KEY', None)
+    if not key:
+        key = "psafefe.psafe.journal" + settings.SECRET_KEY
+    return (
+            hmac.new(key, "encrypt", sha256).digest(),
+            hmac.new(key, "mac", sha256).digest(),
+            )
+
+
+def _cipher(key, iv):
+    import mcrypt  # @UnresolvedImport
+    cipher = mcrypt.MCRYPT('twofish', 'cbc')
+    cipher.init(key, iv)
+    return cipher
+
+
+def seal(value):
+    """ Pickle, encrypt and sign a value. Returns a base64 string. """
+    encKey, macKey = _journalKeys()
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    pad = BLOCK_SIZE - len(data) % BLOCK_SIZE
+    data += chr(pad) * pad
+    iv = os.urandom(BLOCK_SIZE)
+    body = iv + _cipher(encKey, iv).encrypt(data)
+    return b64encode(body + hmac.new(macKey, body, sha256).digest())
+
+
+def unseal(sealed):
+    """ Reverse of seal 
+    @raise JournalIntegrityError: The value was changed or sealed with a different key
+    """
+    encKey, macKey = _journalKeys()
+    raw = b64decode(sealed)
+    body, mac = raw[:-MAC_SIZE], raw[-MAC_SIZE:]
+    expected = hmac.new(macKey, body, sha256).digest()
+    # Constant time compare
+    if len(mac) != MAC_SIZE or sum([ord(a) ^ ord(b) for a, b in zip(mac, expected)]) != 0:
+        raise JournalIntegrityError("Journal value failed its integrity check")
+    iv, data = body[:BLOCK_SIZE], body[BLOCK_SIZE:]
+    data = _cipher(encKey, iv).decrypt(data)
+    return pickle.loads(data[:-ord(data[-1])])
+
+
+def journalWrite(psafe, user, psafePassword, actions, onError='fail'):
+    """ Durably record a write batch and queue it to be applied. 
+    @param actions: modifyEntries actions
+    @return: The WriteJournal. Its ticket can be used to check on the batch. 
+    """
+    from psafefe.psafe.models import WriteJournal
+    from psafefe.psafe.tasks.write import applyWriteJournal
+    entry = WriteJournal(
+                         safe=psafe,
+                         user=user,
+                         sealed=seal(dict(password=psafePassword, actions=_repeatable(actions), onError=onError)),
+                         )
+    entry.save()
+    applyWriteJournal.delay(psafePK=psafe.pk)  # @UndefinedVariable
+    log.debug("Journaled %d actions for %r as %r", len(actions), psafe, entry.ticket)
+    return entry
+
+
+def _repeatable(actions):
+    """ Returns the actions with each 'add' turned into an 'add-update' of a 
+    new UUID. A batch may be applied twice if its applier is thought to have
+    died, so adding the same entry again must not make a copy. 
+    """
+    ret = []
+    for action in actions:
+        if action.get('action') == 'add':
+            changes = dict(action.get('changes', {}))
+            changes.setdefault('UUID', uuid4())
+            action = {
+                      'action':'add-update',
+                      'refilters':{},
+                      'vfilters':{'UUID':changes['UUID']},
+                      'changes':changes,
+                      }
+        ret.append(action)
+    return ret
+
+
+def _pendingWrites(psafe, user):
+    from psafefe.psafe.models import WriteJournal
+    return WriteJournal.objects.filter(
+                                       safe=psafe,
+                                       user=user,
+                                       status__in=[WriteJournal.STATUS_QUEUED, WriteJournal.STATUS_APPLYING],
+                                       ).order_by('pk')
+
+
+def hasPendingWrites(psafe, user):
+    """ Returns True if the user has journaled writes to the safe that haven't been applied """
+    return _pendingWrites(psafe, user).exists()
+
+
+def pendingSafePKs(user):
+    """ Returns a set of the PKs of the safes the user has journaled writes to that haven't been applied """
+    from psafefe.psafe.models import WriteJournal
+    return set(WriteJournal.objects.filter(
+                                           user=user,
+                                           status__in=[WriteJournal.STATUS_QUEUED, WriteJournal.STATUS_APPLYING],
+                                           ).values_list('safe', flat=True))
+
+
+def _changeValue(field, value):
+    """ Returns the todict form of a modifyEntries change value """
+    if field == 'Group' and isinstance(value, (list, tuple)):
+        return '.'.join(value)
+    if isinstance(value, UUID):
+        return unicode(value)
+    return value
+
+
+def _matches(entry, action):
+    for field, value in action.get('vfilters', {}).items():
+        if entry.get(field) != _changeValue(field, value):
+            return False
+    for field, raw in action.get('refilters', {}).items():
+        actual = entry.get(field)
+        if actual is None or not compilePattern(raw).match(actual):
+            return False
+    return True
+
+
+def _applyChanges(entry, changes, ticket):
+    for field, value in changes.items():
+        entry[field] = _changeValue(field, value)
+    entry['Pending Ticket'] = ticket
+
+
+def overlayEntries(psafe, user, entries, group=None):
+    """ Apply the user's pending journaled writes to a list of entry dicts 
+    from the cache so the user sees their own changes before they're in the
+    safe file. Changed and added entries get a 'Pending Ticket' key. 
+    @param entries: MemPsafeEntry.todict() output for all entries in the safe
+    @param group: If given, only return entries in this group
+    @return: A new list of entry dicts
+    """
+    entries = [dict(i) for i in entries]
+    for pending in _pendingWrites(psafe, user):
+        try:
+            batch = unseal(pending.sealed)
+        except Exception, e:
+            log.warn("Couldn't read journaled batch %r: %r", pending.ticket, e)
+            continue
+        for action in batch['actions']:
+            maxMatches = action.get('maxMatches')
+            if action['action'] == 'add':
+                entry = {}
+                _applyChanges(entry, action['changes'], pending.ticket)
+                entries.insert(0, entry)
+                continue
+            matched = [i for i in entries if _matches(i, action)]
+            if maxMatches is not None:
+                matched = matched[:maxMatches]
+            if action['action'] in ('update', 'add-update'):
+                for entry in matched:
+                    _applyChanges(entry, action['changes'], pending.ticket)
+                if not matched and action['action'] == 'add-update':
+                    entry = {}
+                    _applyChanges(entry, action['changes'], pending.ticket)
+                    entries.insert(0, entry)
+            elif action['action'] == 'delete':
+                matchedIDs = set([id(i) for i in matched])
+                entries = [i for i in entries if id(i) not in matchedIDs]
+    if group is not None:
+        entries = [i for i in entries if i.get('Group') == group]
+    return entries
+
+
+def overlaySafe(psafe, user, safe):
+    """ Apply the user's pending journaled writes to the entries of a 
+    MemPSafe.todict() dict 
+    @return: The safe dict. A new one if there were any pending writes. 
+    """
+    if 'Entries' not in safe or not hasPendingWrites(psafe, user):
+        return safe
+    ret = dict(safe)
+    ret['Entries'] = overlayEntries(psafe, user, safe['Entries'])
+    return ret
+
+
+def overlayEntry(memSafe, user, entry):
+    """ Apply the user's pending journaled writes to a single entry dict 
+    @param memSafe: The MemPSafe the entry is from
+    @param entry: MemPsafeEntry.todict() output
+    @return: The new entry dict or None if a pending write deletes the entry
+    """
+    for i in overlayEntries(memSafe.safe, user, memSafe.todict()['Entries']):
+        if i.get('PK') == entry['PK']:
+            return i
+    return None
+
+
+def findOverlaid(memSafe, user, field, value):
+    """ Returns the entry dicts of the safe, with the user's pending journaled
+    writes applied, that have the given value for the field. Finds added 
+    entries too. 
+    """
+    return [i for i in overlayEntries(memSafe.safe, user, memSafe.todict()['Entries']) if i.get(field) == value]
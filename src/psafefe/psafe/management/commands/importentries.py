@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Bulk import entries into a safe from a CSV or JSON file
+'''
+import logging
+log = logging.getLogger("psafefe.psafe.management.commands.importentries")
+log.debug('initing')
+
+from django.core.management.base import BaseCommand, CommandError
+from psafefe.psafe.models import PasswordSafe
+from psafefe.psafe.importer import parseRows, validateRows, importActions, IMPORT_FORMATS
+from psafefe.psafe.errors import InvalidImportError
+from psafefe.psafe.tasks.write import modifyEntries
+from optparse import make_option
+from getpass import getpass
+
+
+class Command(BaseCommand):
+    args = '<safe PK> <file>'
+    help = 'Add or update entries in a safe from a CSV or JSON file in a single write'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+                    help="csv or json. Defaults to the file's extension."),
+        make_option('--on-error', dest='onError', default='fail',
+                    help="fail: import nothing if any row is invalid. skip: import the valid rows."),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Usage: importentries %s" % self.args)
+        try:
+            psafe = PasswordSafe.objects.get(pk=int(args[0]))
+        except (ValueError, PasswordSafe.DoesNotExist):
+            raise CommandError("No safe with an ID of %r" % args[0])
+        format = options['format'] or args[1].rsplit('.', 1)[-1].lower()
+        if format not in IMPORT_FORMATS:
+            raise CommandError("Unknown format %r. Use --format with one of %r" % (format, IMPORT_FORMATS))
+        if options['onError'] not in ('fail', 'skip'):
+            raise CommandError("--on-error must be fail or skip")
+
+        fil = open(args[1], 'rb')
+        try:
+            rows = parseRows(fil.read(), format=format)
+        except InvalidImportError, e:
+            raise CommandError(str(e))
+        finally:
+            fil.close()
+        valid, errors = validateRows(rows)
+        for error in errors:
+            self.stderr.write("Row %(Row)d: %(Error)s\n" % error)
+        if not valid or (errors and options['onError'] == 'fail'):
+            raise CommandError("Not importing. %d of %d rows are invalid." % (len(errors), len(rows)))
+
+        psafePassword = getpass("Password for %s: " % psafe.psafePath())
+        actions = importActions([row for rowNumber, row in valid])
+        result = modifyEntries(
+                               psafePK=psafe.pk,
+                               psafePassword=psafePassword,
+                               actions=actions,
+                               onError=options['onError'],
+                               )
+        for error in result['errors']:
+            self.stderr.write("Row %d: %s\n" % (valid[error['index']][0], error['error']))
+        self.stdout.write("Imported %d rows into %s. %d entries changed.\n" % (len(valid), psafe.psafePath(), result['changes']))
@@ -205,12 +205,16 @@ class PasswordSafe(models.Model):
         """ Returns the full path on the server to the psafe file """
         return join(self.repo.path, self.filename)
 
-    def getCached(self, canLoad=False, user=None, userPassword=None):
+    def getCached(self, canLoad=False, user=None, userPassword=None, backend=None):
         """ Return the RAM only cached data for this safe. 
         @param canLoad: Indicates what to do if the entry doesn't exist. False: Error out. True: Load the safe then return the obj.  
+        @param backend: Dotted path of the cache backend to use. None for settings.PSAFE_CACHE_BACKEND. 
+        @type backend: None or string
         """
         self.log.debug("Getting cached copy")
         from psafefe.psafe.errors import EntryNotCached
+        from psafefe.psafe.cache import getCacheBackend
+        cacheBackend = getCacheBackend(backend)
         # Can't load without the password
         from django.contrib.auth.models import User
         if not isinstance(user, User):
@@ -220,12 +224,16 @@ class PasswordSafe(models.Model):
             canLoad = False
             self.log.debug("Can't load due to lack of valid password for user (%r)" % userPassword)
         try:
-            return self.mempsafe
-        except MemPSafe.DoesNotExist, e:
+            cached = cacheBackend.get(self)
+            if not cacheBackend.isCurrent(self, cached):
+                self.log.debug("Cached copy is out of date. Dropping it. ")
+                cacheBackend.remove(self)
+                raise EntryNotCached("%r's cached entry is out of date" % self)
+            return cached
+        except EntryNotCached, e:
             if canLoad:
                 self.log.debug("Going to try loading")
                 try:
-                    from psafefe.psafe.tasks.load import  loadSafe
                     from psafefe.psafe.functions import getDatabasePasswordByUser
                     dbPassword = getDatabasePasswordByUser(
                                               user=user,
@@ -233,10 +241,9 @@ class PasswordSafe(models.Model):
                                               psafe=self,
                                               wait=True,
                                               )
-                    ls = loadSafe.delay(psafe_pk=self.pk, password=dbPassword, force=False)  # @UndefinedVariable
-                    ls.wait()
+                    cacheBackend.load(self, password=dbPassword, force=False)
                     # Make sure to prevent inf. recursion if the load fails
-                    return self.getCached(canLoad=False)
+                    return self.getCached(canLoad=False, backend=backend)
                 except Exception, e:
                     raise EntryNotCached, "%r doesn't have a cached entry and loading failed with %r" % (self, e)
             else:
@@ -334,26 +341,85 @@ class MemPSafe(models.Model):
                                             editable=False,
                                             auto_now_add=True,
                                             )
+    version = models.CharField(
+                               null=False,
+                               # Callable so each cached copy gets its own version
+                               default=lambda: uuid4().hex,
+                               max_length=32,
+                               verbose_name="Content Version",
+                               help_text="Changes every time the cached content changes",
+                               editable=False,
+                               )
+    entryLastUsed = models.DateTimeField(
+                                         null=True,
+                                         default=None,
+                                         verbose_name="Cache Entry Last Used",
+                                         help_text="The last time the cached entry was used. Used to pick safes to evict. ",
+                                         editable=False,
+                                         )
+    rowCount = models.IntegerField(
+                                   null=False,
+                                   default=0,
+                                   verbose_name="Cached Rows",
+                                   help_text="The number of entry, history and index rows cached for the safe. Set on each refresh. ",
+                                   editable=False,
+                                   )
 
     def onRefresh(self, save=True):
         """ This cache entry has been refreshed """
         import datetime
+        from psafefe.psafe.usage import discardUse
         self.entryUseCount = 0
         self.entryLastRefreshed = datetime.datetime.now()
         if save:
             self.save()
+            discardUse(self.pk)
 
     def onUse(self, save=True):
-        """ The safe has been used """
+        """ The safe has been used. The DB counters are updated in batches by psafefe.psafe.usage. """
+        import datetime
+        from psafefe.psafe.usage import recordUse
         self.entryUseCount += 1
+        self.entryLastUsed = datetime.datetime.now()
         if save:
-            self.save()
+            recordUse(self.pk)
 
     # TODO: Add in safe HMAC validation checks too
 
+    def _serializedKey(self, getEntries, getEntryHistory, version=None):
+        """ Returns the Django cache key for the given todict output """
+        return "psafe-mempsafe-todict-%d-%s-%d-%d" % (self.safe_id, version or self.version, bool(getEntries), bool(getEntryHistory))
+
+    def invalidateSerialized(self, version=None):
+        """ Drop all cached todict output for the given content version. Defaults to the current version. """
+        from psafefe.psafe.cache import getSecretCache
+        cache = getSecretCache()
+        if cache is None:
+            return
+        keys = []
+        for getEntries in (True, False):
+            for getEntryHistory in (True, False):
+                keys.append(self._serializedKey(getEntries, getEntryHistory, version=version))
+        cache.delete_many(keys)
+
     def todict(self, getEntries=True, getEntryHistory=True):
         """ Return an XML-RPC safe dictionary of the data. Null 
-        fields are deleted! """
+        fields are deleted! Output that includes entries is cached in the 
+        secret cache until the content version changes. """
+        from psafefe.psafe.cache import getSecretCache
+        from django.conf import settings
+        cache = getSecretCache()
+        if getEntries and cache is not None:
+            key = self._serializedKey(getEntries, getEntryHistory)
+            ret = cache.get(key)
+            if ret is None:
+                ret = self._todict(getEntries=getEntries, getEntryHistory=getEntryHistory)
+                cache.set(key, ret, getattr(settings, 'PSAFE_SERIALIZED_CACHE_TIMEOUT', 60 * 60))
+            return ret
+        return self._todict(getEntries=getEntries, getEntryHistory=getEntryHistory)
+
+    def _todict(self, getEntries=True, getEntryHistory=True):
+        """ Build the todict output from the DB """
         ret = {
              'PK':self.safe.pk,
              'UUID':self.uuid,
@@ -371,6 +437,10 @@ class MemPSafe(models.Model):
             if v is None:
                 del ret[k]
         return ret
+
+    def getEntriesByGroup(self, groupName, history=True):
+        """ Return a list of entry dicts that are in the given group """
+        return [i.todict(history=history) for i in self.mempsafeentry_set.filter(group=groupName)]
 admin.site.register(MemPSafe)
 
 
@@ -432,24 +502,29 @@ class MemPsafeEntry(models.Model):
     creationTime = models.DateTimeField(
                                         null=True,
                                         default=None,
+                                        db_index=True,
                                         verbose_name="Creation Time",
                                         )
     passwordModTime = models.DateTimeField(
                                            null=True,
                                            default=None,
+                                           db_index=True,
                                            verbose_name="Password Last Modification Time",
                                            )
     accessTime = models.DateTimeField(
                                       null=True,
                                       default=None,
+                                      db_index=True,
                                       verbose_name="Last Access Time",
                                       )
     passwordExpiryTime = models.DateTimeField(
                                               null=True,
+                                              db_index=True,
                                               verbose_name="Password Expiry Time",
                                               )
     modTime = models.DateTimeField(
                                    null=True,
+                                   db_index=True,
                                    verbose_name="Last Modification Time",
                                    )
     # Don't use a URL field - We don't want to risk any validation
@@ -511,7 +586,9 @@ class MemPsafeEntry(models.Model):
 
     def onUse(self):
         """ The entry was used. Update the counters on our parent mempsafe """
-        self.safe.onUse()
+        from psafefe.psafe.usage import recordUse
+        # Don't fetch the safe just to count the use
+        recordUse(self.safe_id)
 
     def getHistory(self):
         """ Return all old passwords, in order """
@@ -539,3 +616,492 @@ class MemPasswordEntryHistory(models.Model):
                                         )
 admin.site.register(MemPasswordEntryHistory)
 
+
+class MemPasswordDigest(models.Model):
+    """ Keyed hashes of current and old passwords. Used to find entries with 
+    the same password without comparing or exposing the passwords. """
+    safe = models.ForeignKey(
+                             MemPSafe,
+                             null=False,
+                             verbose_name="Password Safe",
+                             )
+    entry = models.ForeignKey(
+                              MemPsafeEntry,
+                              null=False,
+                              verbose_name="Entry",
+                              )
+    digest = models.CharField(
+                              null=False,
+                              max_length=64,
+                              db_index=True,
+                              verbose_name="Password Digest",
+                              help_text="Hex HMAC-SHA256 of the password. See indexes.passwordDigest. ",
+                              )
+    current = models.BooleanField(
+                                  null=False,
+                                  default=True,
+                                  verbose_name="Current Password",
+                                  help_text="False if this is an old password",
+                                  )
+admin.site.register(MemPasswordDigest)
+
+
+
+class MemPsafeGroup(models.Model):
+    """ A group (folder) in a cached psafe. There is one row per group path, 
+    including parent groups that only hold other groups. Paths are looked up 
+    by hash as they are too long to index. """
+    class Meta:
+        unique_together = (
+                           ('safe', 'pathHash'),
+                           )
+    safe = models.ForeignKey(
+                             MemPSafe,
+                             null=False,
+                             verbose_name="Password Safe",
+                             )
+    path = models.CharField(
+                            null=False,
+                            max_length=4096,
+                            verbose_name="Group",
+                            help_text="Dot separated group listing",
+                            )
+    pathHash = models.CharField(
+                                null=False,
+                                max_length=40,
+                                db_index=True,
+                                verbose_name="Group Hash",
+                                help_text="SHA1 of the group path",
+                                )
+    parentHash = models.CharField(
+                                  null=False,
+                                  max_length=40,
+                                  db_index=True,
+                                  verbose_name="Parent Group Hash",
+                                  help_text="SHA1 of the parent group's path. Top level groups use the hash of an empty path. ",
+                                  )
+    name = models.CharField(
+                            null=False,
+                            max_length=4096,
+                            verbose_name="Name",
+                            help_text="The last part of the group path",
+                            )
+    depth = models.IntegerField(
+                                null=False,
+                                verbose_name="Depth",
+                                help_text="Number of parts in the group path",
+                                )
+    entryCount = models.IntegerField(
+                                     null=False,
+                                     default=0,
+                                     verbose_name="Entry Count",
+                                     help_text="The number of entries in this group and all of its sub-groups",
+                                     )
+
+    def todict(self):
+        """ Return an XML-RPC safe dictionary of the data """
+        return {
+                'Group':self.path,
+                'Name':self.name,
+                'Depth':self.depth,
+                'Entry Count':self.entryCount,
+                }
+admin.site.register(MemPsafeGroup)
+
+
+class MemPsafeGroupMember(models.Model):
+    """ Links an entry to its group and to every ancestor of its group """
+    group = models.ForeignKey(
+                              MemPsafeGroup,
+                              null=False,
+                              verbose_name="Group",
+                              )
+    entry = models.ForeignKey(
+                              MemPsafeEntry,
+                              null=False,
+                              verbose_name="Entry",
+                              )
+admin.site.register(MemPsafeGroupMember)
+
+
+class MemEntryToken(models.Model):
+    """ Inverted text index over cached entries. One row per distinct token per field per entry. """
+    safe = models.ForeignKey(
+                             MemPSafe,
+                             null=False,
+                             verbose_name="Password Safe",
+                             )
+    entry = models.ForeignKey(
+                              MemPsafeEntry,
+                              null=False,
+                              verbose_name="Entry",
+                              )
+    field = models.CharField(
+                             null=False,
+                             max_length=16,
+                             verbose_name="Field",
+                             help_text="The todict name of the field the token is from",
+                             )
+    token = models.CharField(
+                             null=False,
+                             max_length=64,
+                             db_index=True,
+                             verbose_name="Token",
+                             help_text="Lower case word from the field",
+                             )
+    weight = models.SmallIntegerField(
+                                      null=False,
+                                      default=1,
+                                      verbose_name="Weight",
+                                      help_text="Rank given to a match on this field",
+                                      )
+admin.site.register(MemEntryToken)
+
+
+class MemEntryTrigram(models.Model):
+    """ Trigram index over cached entries for fuzzy matching. One row per distinct trigram per field per entry. """
+    safe = models.ForeignKey(
+                             MemPSafe,
+                             null=False,
+                             verbose_name="Password Safe",
+                             )
+    entry = models.ForeignKey(
+                              MemPsafeEntry,
+                              null=False,
+                              verbose_name="Entry",
+                              )
+    field = models.CharField(
+                             null=False,
+                             max_length=16,
+                             verbose_name="Field",
+                             help_text="The todict name of the field the trigram is from",
+                             )
+    trigram = models.CharField(
+                               null=False,
+                               max_length=3,
+                               db_index=True,
+                               verbose_name="Trigram",
+                               )
+    total = models.IntegerField(
+                                null=False,
+                                verbose_name="Total Trigrams",
+                                help_text="The number of distinct trigrams in the field's value. Used to score similarity. ",
+                                )
+admin.site.register(MemEntryTrigram)
+
+
+class MemExpiryReport(models.Model):
+    """ Precomputed list of entries with expired, soon to expire or old 
+    passwords. Rebuilt per repo by the buildExpiryReports task. """
+    REASON_EXPIRED = 'Expired'
+    REASON_EXPIRING = 'Expiring'
+    REASON_OLD = 'Old Password'
+    # The safe wasn't cached when the report was built so its entries weren't checked. 
+    # There's one of these rows per safe and entryUUID is empty. 
+    REASON_NOT_CACHED = 'Not Cached'
+    repo = models.ForeignKey(
+                             PasswordSafeRepo,
+                             null=False,
+                             verbose_name="Repository",
+                             )
+    safe = models.ForeignKey(
+                             PasswordSafe,
+                             null=False,
+                             verbose_name="Password Safe",
+                             )
+    entryUUID = models.CharField(
+                                 null=False,
+                                 max_length=36,
+                                 verbose_name="Entry UUID",
+                                 )
+    group = models.CharField(
+                             null=True,
+                             default=None,
+                             max_length=4096,
+                             verbose_name="Group",
+                             )
+    title = models.CharField(
+                             null=True,
+                             default=None,
+                             max_length=4096,
+                             verbose_name="Title",
+                             )
+    username = models.CharField(
+                                null=True,
+                                default=None,
+                                max_length=4096,
+                                verbose_name="Username",
+                                )
+    passwordModTime = models.DateTimeField(
+                                           null=True,
+                                           default=None,
+                                           verbose_name="Password Last Modification Time",
+                                           )
+    passwordExpiryTime = models.DateTimeField(
+                                              null=True,
+                                              default=None,
+                                              verbose_name="Password Expiry Time",
+                                              )
+    reason = models.CharField(
+                              null=False,
+                              max_length=16,
+                              verbose_name="Reason",
+                              help_text="Why the entry is in the report",
+                              )
+    built = models.DateTimeField(
+                                 null=False,
+                                 verbose_name="Report Built",
+                                 )
+
+    def todict(self):
+        """ Return an XML-RPC safe dictionary of the data. Null 
+        fields are deleted! """
+        ret = {
+               'Safe PK':self.safe_id,
+               'UUID':self.entryUUID,
+               'Group':self.group,
+               'Title':self.title,
+               'Username':self.username,
+               'Password Last Modification Time':self.passwordModTime,
+               'Password Expiry':self.passwordExpiryTime,
+               'Reason':self.reason,
+               }
+        for k, v in ret.items():
+            if v is None:
+                del ret[k]
+        return ret
+admin.site.register(MemExpiryReport)
+
+
+class PendingWrite(models.Model):
+    """ A modifyEntries batch waiting to be merged into a single write of its
+    safe. The actions hold passwords, so they're stored encrypted. See 
+    psafefe.psafe.tasks.write.modifyEntries. """
+    STATUS_PENDING = 'pending'
+    STATUS_CLAIMED = 'claimed'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    safe = models.ForeignKey(
+                             PasswordSafe,
+                             null=False,
+                             verbose_name="Password Safe",
+                             )
+    passwordDigest = models.CharField(
+                                      null=False,
+                                      max_length=64,
+                                      verbose_name="Safe Password Digest",
+                                      help_text="Only batches using the same safe password are merged",
+                                      )
+    actions = models.TextField(
+                               null=False,
+                               verbose_name="Encrypted Actions",
+                               help_text="List of modifyEntries actions. Sealed by psafefe.psafe.journal.seal. ",
+                               )
+    onError = models.CharField(
+                               null=False,
+                               max_length=8,
+                               verbose_name="On Error",
+                               )
+    status = models.CharField(
+                              null=False,
+                              max_length=8,
+                              default=STATUS_PENDING,
+                              db_index=True,
+                              verbose_name="Status",
+                              )
+    leader = models.CharField(
+                              null=True,
+                              default=None,
+                              max_length=32,
+                              db_index=True,
+                              verbose_name="Leader",
+                              help_text="Token of the task that claimed the batch",
+                              )
+    result = models.TextField(
+                              null=True,
+                              default=None,
+                              verbose_name="Encrypted Result",
+                              help_text="Result or error message. Sealed by psafefe.psafe.journal.seal. ",
+                              )
+    created = models.DateTimeField(
+                                   null=False,
+                                   auto_now_add=True,
+                                   verbose_name="Created",
+                                   )
+admin.site.register(PendingWrite)
+
+
+class WriteJournal(models.Model):
+    """ A write batch that has been accepted but may not be in the safe file 
+    yet. The actions and safe password are stored encrypted. See psafefe.psafe.journal. """
+    STATUS_QUEUED = 'queued'
+    STATUS_APPLYING = 'applying'
+    STATUS_APPLIED = 'applied'
+    STATUS_FAILED = 'failed'
+    ticket = models.CharField(
+                              null=False,
+                              max_length=32,
+                              unique=True,
+                              default=lambda: uuid4().hex,
+                              verbose_name="Ticket",
+                              )
+    safe = models.ForeignKey(
+                             PasswordSafe,
+                             null=False,
+                             verbose_name="Password Safe",
+                             )
+    user = models.ForeignKey(
+                             User,
+                             null=True,
+                             default=None,
+                             verbose_name="User",
+                             help_text="The user that made the change",
+                             )
+    sealed = models.TextField(
+                              null=False,
+                              verbose_name="Encrypted Batch",
+                              )
+    status = models.CharField(
+                              null=False,
+                              max_length=8,
+                              default=STATUS_QUEUED,
+                              db_index=True,
+                              verbose_name="Status",
+                              )
+    result = models.TextField(
+                              null=True,
+                              default=None,
+                              verbose_name="Encrypted Result",
+                              )
+    created = models.DateTimeField(
+                                   null=False,
+                                   auto_now_add=True,
+                                   verbose_name="Created",
+                                   )
+    claimed = models.DateTimeField(
+                                   null=True,
+                                   default=None,
+                                   verbose_name="Claimed",
+                                   help_text="When an applier started on the batch",
+                                   )
+    claimToken = models.CharField(
+                                  null=True,
+                                  default=None,
+                                  max_length=32,
+                                  db_index=True,
+                                  verbose_name="Claim Token",
+                                  help_text="Token of the applier working on the batch",
+                                  )
+    finished = models.DateTimeField(
+                                    null=True,
+                                    default=None,
+                                    verbose_name="Finished",
+                                    )
+admin.site.register(WriteJournal)
+
+
+class ImportChunk(models.Model):
+    """ One chunk of a psafe.write.entry.importEntries upload, held until the
+    final chunk arrives. Uploads have passwords in them, so the data is 
+    stored encrypted. See psafefe.psafe.journal. """
+    class Meta:
+        unique_together = (
+                           ('user', 'uploadID', 'chunkNumber'),
+                           )
+    user = models.ForeignKey(
+                             User,
+                             null=False,
+                             verbose_name="User",
+                             )
+    uploadID = models.CharField(
+                                null=False,
+                                max_length=32,
+                                verbose_name="Upload ID",
+                                help_text="MD5 of the client's upload ID",
+                                )
+    chunkNumber = models.IntegerField(
+                                      null=False,
+                                      verbose_name="Chunk Number",
+                                      )
+    sealed = models.TextField(
+                              null=False,
+                              verbose_name="Encrypted Data",
+                              )
+    created = models.DateTimeField(
+                                   null=False,
+                                   auto_now_add=True,
+                                   db_index=True,
+                                   verbose_name="Created",
+                                   )
+admin.site.register(ImportChunk)
+
+
+class RotationJob(models.Model):
+    """ A password rotation across one or more safes. The work is split into
+    one psafefe.psafe.tasks.rotation.rotateSafe task per safe. No passwords are stored. """
+    jobID = models.CharField(
+                             null=False,
+                             max_length=32,
+                             unique=True,
+                             default=lambda: uuid4().hex,
+                             verbose_name="Job ID",
+                             )
+    user = models.ForeignKey(
+                             User,
+                             null=False,
+                             verbose_name="User",
+                             help_text="The user that started the job",
+                             )
+    created = models.DateTimeField(
+                                   null=False,
+                                   auto_now_add=True,
+                                   verbose_name="Created",
+                                   )
+    finished = models.DateTimeField(
+                                    null=True,
+                                    default=None,
+                                    verbose_name="Finished",
+                                    help_text="When the last entry was done",
+                                    )
+admin.site.register(RotationJob)
+
+
+class RotationJobEntry(models.Model):
+    """ One entry to rotate as part of a RotationJob """
+    STATUS_PENDING = 'pending'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_MISSING = 'missing'
+    job = models.ForeignKey(
+                            RotationJob,
+                            null=False,
+                            verbose_name="Rotation Job",
+                            )
+    safe = models.ForeignKey(
+                             PasswordSafe,
+                             null=False,
+                             verbose_name="Password Safe",
+                             )
+    entryUUID = models.CharField(
+                                 null=False,
+                                 max_length=36,
+                                 verbose_name="Entry UUID",
+                                 )
+    status = models.CharField(
+                              null=False,
+                              max_length=8,
+                              default=STATUS_PENDING,
+                              db_index=True,
+                              verbose_name="Status",
+                              )
+    error = models.TextField(
+                             null=True,
+                             default=None,
+                             verbose_name="Error",
+                             )
+    updated = models.DateTimeField(
+                                   null=True,
+                                   default=None,
+                                   verbose_name="Updated",
+                                   )
+admin.site.register(RotationJobEntry)
@@ -26,6 +26,9 @@ from psafefe.psafe.models import *
 from uuid import UUID
 from django.conf import settings
 from psafefe.psafe.functions import getDatabasePasswordByUser
+from psafefe.psafe.cache import MEMTABLE_BACKEND
+from psafefe.psafe import indexes
+from psafefe.psafe import journal
 
 
 # Entry methods
@@ -55,7 +58,69 @@ def getEntrysByGroup(username, password, safeID, groupName, **kw):
 
     psafePassword = getDatabasePasswordByUser(kw['user'], password, safe, wait=True)
     memSafe = safe.getCached(canLoad=True, user=kw['user'], userPassword=password)
-    return [i.todict() for i in memSafe.mempsafeentry_set.filter(group=groupName)]
+    if journal.hasPendingWrites(safe, kw['user']):
+        # Show the user's own changes that aren't in the safe yet
+        return journal.overlayEntries(safe, kw['user'], memSafe.todict()['Entries'], group=groupName)
+    return memSafe.getEntriesByGroup(groupName)
+
+
+@rpcmethod(name='psafe.read.getChildGroups', signature=['array', 'string', 'string', 'int', 'string'])
+@auth
+def getChildGroups(username, password, safeID, groupName, **kw):
+    """ Return the groups directly under the given group. 
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param safeID: The PK of the PasswordSafe object
+    @type safeID: int
+    @param groupName: Dot separated group path. Use an empty string for the top level groups. 
+    @type groupName: string
+    @return: A list of dicts with the Group (full path), Name, Depth and Entry Count (including sub-groups) of each child group
+    @raise EntryDoesntExistError: The requested safe doesn't exist or the user doesn't have permission to read it.
+    """
+    memSafe = _getReadableMemSafe(username=username, password=password, safeID=safeID, **kw)
+    memSafe.onUse()
+    return [i.todict() for i in indexes.getChildGroups(memSafe, groupName)]
+
+
+@rpcmethod(name='psafe.read.getEntriesByGroupTree', signature=['array', 'string', 'string', 'int', 'string'])
+@auth
+def getEntriesByGroupTree(username, password, safeID, groupName, **kw):
+    """ Return all entries in the given group and all of its sub-groups. 
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param safeID: The PK of the PasswordSafe object
+    @type safeID: int
+    @param groupName: Dot separated group path. Use an empty string for the whole safe. 
+    @type groupName: string
+    @return: A list of dicts containing the entries' properties
+    @raise EntryDoesntExistError: The requested safe doesn't exist or the user doesn't have permission to read it.
+    """
+    memSafe = _getReadableMemSafe(username=username, password=password, safeID=safeID, **kw)
+    memSafe.onUse()
+    if journal.hasPendingWrites(memSafe.safe, kw['user']):
+        # Show the user's own changes that aren't in the safe yet
+        entries = journal.overlayEntries(memSafe.safe, kw['user'], memSafe.todict()['Entries'])
+        return [i for i in entries if not groupName or groupName in indexes.groupAncestors(i.get('Group'))]
+    return [i.todict() for i in indexes.getGroupTreeEntries(memSafe, groupName)]
+
+
+def _getReadableMemSafe(username, password, safeID, **kw):
+    """ Returns the MemPSafe for the given safe PK, loading it if needed. 
+    @raise EntryDoesntExistError: The requested safe doesn't exist or the user doesn't have permission to read it.
+    """
+    try:
+        safe = PasswordSafe.objects.get(pk=safeID)
+    except PasswordSafe.DoesNotExist, e:
+        log.warning("Got %r while trying to fetch Password Safe %r", e, safeID)
+        raise EntryDoesntExistError("No safe with an ID of %r" % safeID)
+    if not safe.repo.user_can_access(user=kw['user'], mode="R"):
+        log.warning("User %r is NOT allowed to access %r", kw['user'], safe.repo)
+        raise EntryDoesntExistError("No safe with an ID of %r" % safeID)
+    return safe.getCached(canLoad=True, user=kw['user'], userPassword=password, backend=MEMTABLE_BACKEND)
 
 
 @rpcmethod(name='psafe.read.getEntryByPK', signature=['struct', 'string', 'string', 'int'])
@@ -80,6 +145,12 @@ def getEntryByPK(username, password, entPK, **kw):
 
     repo = ent.safe.safe.repo
     if repo.user_can_access(kw['user'], mode="R"):
+        if journal.hasPendingWrites(ent.safe.safe, kw['user']):
+            # Show the user's own changes that aren't in the safe yet
+            ret = journal.overlayEntry(ent.safe, kw['user'], ent.todict())
+            if ret is None:
+                raise EntryDoesntExistError
+            return ret
         return ent.todict()
 
     # User doesn't have access so it might as well not exist
@@ -104,12 +175,17 @@ def getEntriesByUUID(username, password, entUUID, **kw):
     except:
         raise InvalidUUIDError, "%r is not a valid UUID" % entUUID
 
+    # Entries from safes with pending writes come from the overlay
+    pending = journal.pendingSafePKs(kw['user'])
     found = []
     for ent in MemPsafeEntry.objects.filter(uuid=entUUID).select_related():
+        if ent.safe.safe_id in pending:
+            continue
         ent.onUse()
         repo = ent.safe.safe.repo
         if repo.user_can_access(kw['user'], mode="R"):
             found.append(ent.todict())
+    found.extend(_pendingEntriesByUUID(kw['user'], pending, entUUID))
 
     return found
 
@@ -134,12 +210,17 @@ def getEntryByUUID(username, password, entUUID, **kw):
     except:
         raise InvalidUUIDError, "%r is not a valid UUID" % entUUID
 
+    # Entries from safes with pending writes come from the overlay
+    pending = journal.pendingSafePKs(kw['user'])
     found = []
     for ent in MemPsafeEntry.objects.filter(uuid=entUUID):
+        if ent.safe.safe_id in pending:
+            continue
         repo = ent.safe.safe.repo
         if repo.user_can_access(kw['user'], mode="R"):
             ent.onUse()
             found.append(ent.todict())
+    found.extend(_pendingEntriesByUUID(kw['user'], pending, entUUID))
 
     if len(found) == 1:
         return found[0]
@@ -147,6 +228,17 @@ def getEntryByUUID(username, password, entUUID, **kw):
         raise EntryDoesntExistError("Cound't locate %r" % entUUID)
     raise MultipleEntriesExistError("Found %d entries for %r" % (len(found), entUUID))
 
+
+def _pendingEntriesByUUID(user, safePKs, entUUID):
+    """ Returns the entry dicts with the given UUID from the cached safes in 
+    safePKs that the user can read, with the user's pending writes applied """
+    found = []
+    for memSafe in MemPSafe.objects.filter(safe__pk__in=safePKs).select_related('safe__repo'):
+        if memSafe.safe.repo.user_can_access(user, mode="R"):
+            memSafe.onUse()
+            found.extend(journal.findOverlaid(memSafe, user, 'UUID', entUUID))
+    return found
+
 #         Password Safe methods
 @rpcmethod(name='psafe.read.getSafeByPK', signature=['struct', 'string', 'string', 'int'])
 @auth
@@ -170,7 +262,8 @@ def getSafeByPK(username, password, entPK, **kw):
     repo = psafe.repo
 
     if repo.user_can_access(kw['user'], mode="R"):
-        return ent.todict()
+        # Show the user's own changes that aren't in the safe yet
+        return journal.overlaySafe(psafe, kw['user'], ent.todict())
 
     # User doesn't have access so it might as well not exist
     raise EntryDoesntExistError
@@ -201,11 +294,11 @@ def getSafeByUUID(username, password, entUUID, **kw):
         ent.onUse()
         repo = ent.repo
         if repo.user_can_access(kw['user'], mode="R"):
-            found.append(ent.getCached(
-                                       canLoad=True,
-                                       user=kw['user'],
-                                       userPassword=password,
-                                       ).todict())
+            found.append(journal.overlaySafe(ent, kw['user'], ent.getCached(
+                                                                          canLoad=True,
+                                                                          user=kw['user'],
+                                                                          userPassword=password,
+                                                                          ).todict()))
 
     if len(found) == 1:
         return found[0]
@@ -236,7 +329,7 @@ def getSafesByUUID(username, password, entUUID, **kw):
         repo = ent.repo
         if repo.user_can_access(kw['user'], mode="R"):
             memEnt = ent.getCached(canLoad=True, user=kw['user'], userPassword=password)
-            found.append(memEnt.todict())
+            found.append(journal.overlaySafe(ent, kw['user'], memEnt.todict()))
 
     return found
 
@@ -267,5 +360,40 @@ def getSafesForUser(username, password, getEntries=False, getEntryHistory=False,
                 except Exception, e:
                     pass
 
-    return [safe.todict(getEntries=getEntries, getEntryHistory=getEntryHistory) for safe in valid.values()]
+    # Show the user's own changes that aren't in the safes yet
+    return [journal.overlaySafe(safe.safe, kw['user'], safe.todict(getEntries=getEntries, getEntryHistory=getEntryHistory)) for safe in valid.values()]
+
+
 
+@rpcmethod(name='psafe.read.getExpiryReport', signature=['struct', 'string', 'string', 'int'])
+@auth
+def getExpiryReport(username, password, repoID, **kw):
+    """ Return the precomputed expiry/age report for a repo. The report is
+    rebuilt from the cached safes by the buildExpiryReports task. 
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param repoID: The PK of the repo
+    @type repoID: int
+    @return: A dict with 'Built', when the report was built, 'Entries', a list of dicts with 'Safe PK', 'UUID', 'Group', 'Title', 'Username', 'Password Last Modification Time', 'Password Expiry' and 'Reason', one of 'Expired', 'Expiring' or 'Old Password', and 'Not Cached', a list of the PKs of safes that weren't cached so weren't checked. 'Built' is left out if the report hasn't been built yet. 
+    @raise EntryDoesntExistError: The requested repo doesn't exist or the user doesn't have permission to read it.
+    """
+    try:
+        repo = PasswordSafeRepo.objects.get(pk=repoID)
+    except PasswordSafeRepo.DoesNotExist:
+        raise EntryDoesntExistError("No repo with an ID of %r" % repoID)
+    if not repo.user_can_access(user=kw['user'], mode="R"):
+        log.warning("User %r is NOT allowed to access %r", kw['user'], repo)
+        raise EntryDoesntExistError("No repo with an ID of %r" % repoID)
+    rows = list(MemExpiryReport.objects.filter(repo=repo).order_by('-built', 'passwordExpiryTime'))
+    if not rows:
+        return {'Entries':[], 'Not Cached':[]}
+    # Only the latest build. An older one may still be in the middle of being replaced. 
+    built = rows[0].built
+    rows = [i for i in rows if i.built == built]
+    return {
+            'Built':built,
+            'Entries':[i.todict() for i in rows if i.reason != MemExpiryReport.REASON_NOT_CACHED],
+            'Not Cached':sorted([i.safe_id for i in rows if i.reason == MemExpiryReport.REASON_NOT_CACHED]),
+            }
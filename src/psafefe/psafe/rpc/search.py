@@ -15,6 +15,9 @@
 #    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
 #===============================================================================
 ''' Read-only functions
+@note: Searches run against the cached safes only. Journaled writes that 
+haven't been applied to a safe yet aren't searched, even for the user who 
+made them. Use the psafe.read RPCs to see those. 
 Created on Aug 16, 2011
 
 @author: gpmidi
@@ -25,7 +28,11 @@ from psafefe.psafe.rpc.auth import auth
 from psafefe.psafe.models import *
 from uuid import UUID
 from django.conf import settings
-from psafefe.psafe.functions import getDatabasePasswordByUser
+from psafefe.psafe.functions import getDatabasePasswordByUser, getReadableMemSafes, getSafesWithPasswordsByUser, loadMemSafes
+from psafefe.psafe.cache import MEMTABLE_BACKEND, getSecretCache
+from psafefe.psafe import indexes
+from django.db.models import Q
+from hashlib import md5
 import datetime
 import sys
 
@@ -49,8 +56,15 @@ FILTER_FIELDS_MAPPING = {
                          'Old Passwords':(str, None),
                          }
 
+# Range filter operators for datetime fields => Django lookup
+RANGE_OPERATORS = {
+                   'lt':'lt',
+                   'gt':'gt',
+                   'between':'range',
+                   }
+
 # Entry methods
-def _filterComplex(username, password, safeIDs, include, exclude, **kw):
+def _filterComplex(username, password, safeIDs, include, exclude, cachedOnly = False, **kw):
     """ 
     @param username: Requesting user's login
     @type username: string
@@ -62,10 +76,13 @@ def _filterComplex(username, password, safeIDs, include, exclude, **kw):
     @type include: A dict where keys are the fields names and the values are a list of possible values for matching entries.
     @param exclude: A dict indicating what fields/values must NOT match.   
     @type exclude: A dict where keys are the fields names and the values are a list of possible values for entries that should be excluded.
-    @return: A list of dicts containing all matching entries
+    @param cachedOnly: If True, don't wait for uncached safes to load. Only cached safes are searched. 
+    @type cachedOnly: bool
+    @return: A tuple of a list of dicts containing all matching entries and a list of the PKs of safes that are still loading
     @raise EntryDoesntExistError: The requested entry doesn't exist or the user doesn't have permission to read it.
     @raise InvalidQueryError: One or more of the include/exclude field names or list of values is not valid.
     @note: Valid fields for filters: PK, UUID, Group, Title, Username, Notes, Password, Creation Time, Password Last Modification Time, Last Access Time, Password Expiry, Entry Last Modification Time, URL, AutoType, Run Command, Email.
+    @note: Datetime fields also take a dict of range operators instead of a list: {'lt':datetime}, {'gt':datetime} and/or {'between':[start, end]}. Between includes both ends. 
     
     @warning: WHEN UPDATING THE ARG LIST OR THIS DOC STRING, MAKE SURE TO UPDATE THE RPC FUNCTIONS BELOW!  
     """
@@ -99,46 +116,78 @@ def _filterComplex(username, password, safeIDs, include, exclude, **kw):
             log.warning("User %r is NOT allowed to access %r", kw['user'], safe.repo, extra = extra)
             # raise NoPermissionError("User %r can't access this repo" % kw['user'])
             raise EntryDoesntExistError("No safe with an ID of %r" % safeID)
-        safes.append(safe)
     extra['safes'] = safes
 
     log.debug("User %r is querying %d safes", kw['user'], len(safes), extra = extra)
 
-    # Get the cached entry or load it if needed
-    memSafes = {}
-    for safe in safes:
-        psafePassword = getDatabasePasswordByUser(kw['user'], password, safe, wait = True)
-        memSafes[safe.pk] = safe.getCached(canLoad = True, user = kw['user'], userPassword = password)
-
-    extra['memSafes'] = memSafes
-    if len(memSafes) == 1:
-        extra['memSafePK'] = memSafes.keys()[0]
-
     # Provide basic validation of the filters since the DB filter errors aren't passed on to the user
     for filterName, filterDict in [ ('include', include), ('exclude', exclude), ]:
         for field, values in filterDict.items():
             if field not in FILTER_FIELDS_MAPPING:
                 log.warning("User %r passed in field %r which isn't valid", kw['user'], field, extra = extra)
                 raise InvalidQueryError("The field %r:%r in %r is not a valid field name" % (field, values, filterName))
+            fieldType, modelFieldName = FILTER_FIELDS_MAPPING[field]
+            if isinstance(values, dict) and fieldType is datetime.datetime:
+                # Range filter
+                for op, value in values.items():
+                    if op not in RANGE_OPERATORS:
+                        log.warning("User %r passed in range operator %r for field %r", kw['user'], op, field, extra = extra)
+                        raise InvalidQueryError("The range operator %r for field %r is not one of %r" % (op, field, sorted(RANGE_OPERATORS.keys())))
+                    if op == 'between':
+                        if not isinstance(value, list) or len(value) != 2:
+                            raise InvalidQueryError("The 'between' value for field %r, which is %r, is not a list of two values" % (field, value))
+                        bounds = value
+                    else:
+                        bounds = [value, ]
+                    for bound in bounds:
+                        if not isinstance(bound, fieldType):
+                            log.warning("User %r passed in value %r for field %r which isn't %r", kw['user'], bound, field, fieldType, extra = extra)
+                            raise InvalidQueryError("The value %r from field %r in filter %r is not of type %r" % (bound, field, filterName, fieldType))
+                continue
             if not isinstance(values, list):
                 log.warning("User %r passed in a value of %r for field %r. The value needs to be a list. ", kw['user'], values, field, extra = extra)
                 raise InvalidQueryError("The value list for field %r, which is %r, is not a list" % (field, values))
-            fieldType, modelFieldName = FILTER_FIELDS_MAPPING[field]
             for value in values:
                 if not isinstance(value, fieldType):
                     log.warning("User %r passed in value %r for field %r which isn't %r", kw['user'], value, fieldType, extra = extra)
                     raise InvalidQueryError("The value %r from field %r in filter %r is not of type %r" % (value, field, filterName, fieldType))
 
+    # Get the cached entries, loading any uncached safes in parallel. Searches 
+    # run as DB queries so they always use the memory table cache. This also
+    # checks that the user has every safe's password, so it's done before
+    # the result cache is used. 
+    dbPasswords = {}
+    memSafes, loading = loadMemSafes(kw['user'], password, list(safes), wait = not cachedOnly, passwords = dbPasswords)
+
+    extra['memSafes'] = memSafes
+    extra['loading'] = loading
+    if len(memSafes) == 1:
+        extra['memSafePK'] = memSafes.keys()[0]
+
+    # Repeated queries are served from the result cache. The results include
+    # passwords so only the secret cache is used. The key includes the content 
+    # version of every safe so a reload of any of them misses. Safes may be 
+    # reloaded after this so the versions read here are the ones searched. 
+    cache = getSecretCache()
+    versions = dict([(pk, memSafe.version) for pk, memSafe in memSafes.items()])
+    cacheKey = _searchCacheKey(kw['user'], versions, dbPasswords, include, exclude)
+    if not loading and cache is not None:
+        ret = cache.get(cacheKey)
+        if ret is not None:
+            log.debug("User %r's query matched the result cache", kw['user'], extra = extra)
+            return ret, []
+
     # Passed sanity checks of data...now to build the query
     entryFilter = MemPsafeEntry.objects.filter(safe__in = memSafes.values())
     try:
         for field, values in include.items():
             if field == 'Old Passwords':
-                for value in values:
-                    entryFilter = entryFilter.filter(mempasswordentryhistory__contains = value)
+                # Matched by keyed digest so the old passwords aren't scanned. 
+                # Any of the values matches, like the other fields. 
+                digests = [indexes.passwordDigest(value) for value in values]
+                entryFilter = entryFilter.filter(pk__in = MemPasswordDigest.objects.filter(digest__in = digests, current = False).values('entry'))
             else:
-                fieldFilterName = "%s__in" % field
-                entryFilter = entryFilter.filter(**{fieldFilterName:values})
+                entryFilter = entryFilter.filter(_fieldFilter(field, values))
     except Exception, e:
         log.warn("Error processing include filter: %r User: %r", e, kw['user'], exc_info = sys.exc_info(), extra = extra)
         raise InvalidQueryError("Error in include filter")
@@ -146,19 +195,53 @@ def _filterComplex(username, password, safeIDs, include, exclude, **kw):
     try:
         for field, values in exclude.items():
             if field == 'Old Passwords':
-                for value in values:
-                    entryFilter = entryFilter.exclude(mempasswordentryhistory__contains = value)
+                digests = [indexes.passwordDigest(value) for value in values]
+                entryFilter = entryFilter.exclude(pk__in = MemPasswordDigest.objects.filter(digest__in = digests, current = False).values('entry'))
             else:
-                fieldFilterName = "%s__in" % field
-                entryFilter = entryFilter.exclude(**{fieldFilterName:values})
+                entryFilter = entryFilter.exclude(_fieldFilter(field, values))
     except Exception, e:
         log.warn("Error processing exclude filter: %r User: %r", e, kw['user'], exc_info = sys.exc_info(), extra = extra)
         raise InvalidQueryError("Error in exclude filter")
 
     # Turn objects to a list of dicts
     ret = [i.todict() for i in entryFilter.select_related()]
-    log.debug("User %r's query returned %d entries", kw['user'], len(ret), extra = extra)
-    return ret
+    log.debug("User %r's query returned %d entries. %d safes still loading. ", kw['user'], len(ret), len(loading), extra = extra)
+    # Only complete results are cached
+    if not loading and cache is not None:
+        cache.set(cacheKey, ret, getattr(settings, 'PSAFE_SEARCH_CACHE_TIMEOUT', 5 * 60))
+    return ret, loading
+
+
+def _fieldFilter(field, values):
+    """ Returns the Q object for an include/exclude filter on a model field 
+    @param values: A list of values to match or, for datetime fields, a dict of range operators to values
+    """
+    fieldType, modelFieldName = FILTER_FIELDS_MAPPING[field]
+    if isinstance(values, dict):
+        q = Q()
+        for op, value in values.items():
+            q &= Q(**{"%s__%s" % (modelFieldName, RANGE_OPERATORS[op]):value})
+        return q
+    return Q(**{"%s__in" % modelFieldName:values})
+
+
+def _searchCacheKey(user, versions, passwords, include, exclude):
+    """ Returns the result cache key for a _filterComplex query 
+    @param versions: A dict of safe PK => MemPSafe.version for all safes searched
+    @param passwords: A dict of safe PK => the safe's password from the user's personal safe. 
+    Only keyed digests of the passwords are used. 
+    """
+    def normalize(filterDict):
+        ret = []
+        for field, values in filterDict.items():
+            if isinstance(values, dict):
+                ret.append((field, sorted(values.items())))
+            else:
+                ret.append((field, sorted(values)))
+        return sorted(ret)
+    digests = sorted([(pk, indexes.passwordDigest(safePassword)) for pk, safePassword in passwords.items()])
+    key = repr((user.pk, sorted(versions.items()), digests, normalize(include), normalize(exclude)))
+    return "psafe-search-filter-%s" % md5(key).hexdigest()
 
 
 @rpcmethod(name = 'psafe.search.filterSafeComplex', signature = ['struct', 'string', 'string', 'int', 'struct', 'struct'])
@@ -179,9 +262,10 @@ def filterSafeComplex(username, password, safeID, include, exclude, **kw):
     @raise EntryDoesntExistError: The requested entry doesn't exist or the user doesn't have permission to read it.
     @raise InvalidQueryError: One or more of the include/exclude field names or list of values is not valid.  
     @note: Valid fields: PK, UUID, Group, Title, Username, Notes, Password, Creation Time, Password Last Modification Time, Last Access Time, Password Expiry, Entry Last Modification Time, URL, AutoType, Run Command, Email.  
+    @note: Datetime fields also take a dict of range operators instead of a list: {'lt':datetime}, {'gt':datetime} and/or {'between':[start, end]}. Between includes both ends. 
     """
     # Don't use **kwargs for the RPC args as rpc4django depends on the arg names being defined
-    return _filterComplex(username = username, password = password, safeIDs = [safeID, ], include = include, exclude = exclude, **kw)
+    return _filterComplex(username = username, password = password, safeIDs = [safeID, ], include = include, exclude = exclude, **kw)[0]
 
 
 @rpcmethod(name = 'psafe.search.filterComplex', signature = ['struct', 'string', 'string', 'list', 'struct', 'struct'])
@@ -202,6 +286,197 @@ def filterComplex(username, password, safeIDs, include, exclude, **kw):
     @raise EntryDoesntExistError: The requested entry doesn't exist or the user doesn't have permission to read it.
     @raise InvalidQueryError: One or more of the include/exclude field names or list of values is not valid.
     @note: Valid fields: PK, UUID, Group, Title, Username, Notes, Password, Creation Time, Password Last Modification Time, Last Access Time, Password Expiry, Entry Last Modification Time, URL, AutoType, Run Command, Email.  
+    @note: Datetime fields also take a dict of range operators instead of a list: {'lt':datetime}, {'gt':datetime} and/or {'between':[start, end]}. Between includes both ends. 
     """
     # Don't use **kwargs for the RPC args as rpc4django depends on the arg names being defined
-    return _filterComplex(username = username, password = password, safeIDs = safeIDs, include = include, exclude = exclude, **kw)
+    return _filterComplex(username = username, password = password, safeIDs = safeIDs, include = include, exclude = exclude, **kw)[0]
+
+
+
+@rpcmethod(name = 'psafe.search.filterComplexCached', signature = ['struct', 'string', 'string', 'list', 'struct', 'struct'])
+@auth
+def filterComplexCached(username, password, safeIDs, include, exclude, **kw):
+    """ Same as psafe.search.filterComplex but doesn't wait for uncached safes
+    to load. Uncached safes are queued for loading and left out of the results.
+    Call again once 'Loading' is empty to get complete results. 
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param safeIDs: The PKs of all psafe objects that should be included in the search. 
+    @type safeIDs: A list of ints
+    @param include: A dict indicating what fields must match and possible values to match against.  
+    @type include: A dict where keys are the fields names and the values are a list of possible values for matching entries.
+    @param exclude: A dict indicating what fields/values must NOT match.   
+    @type exclude: A dict where keys are the fields names and the values are a list of possible values for entries that should be excluded.
+    @return: A dict with 'Entries', a list of dicts containing all matching entries from cached safes, and 'Loading', a list of the PKs of safes that were not searched because they are still loading. 
+    @raise EntryDoesntExistError: The requested entry doesn't exist or the user doesn't have permission to read it.
+    @raise InvalidQueryError: One or more of the include/exclude field names or list of values is not valid.
+    @note: Valid fields: PK, UUID, Group, Title, Username, Notes, Password, Creation Time, Password Last Modification Time, Last Access Time, Password Expiry, Entry Last Modification Time, URL, AutoType, Run Command, Email.  
+    @note: Datetime fields also take a dict of range operators instead of a list: {'lt':datetime}, {'gt':datetime} and/or {'between':[start, end]}. Between includes both ends. 
+    """
+    # Don't use **kwargs for the RPC args as rpc4django depends on the arg names being defined
+    entries, loading = _filterComplex(username = username, password = password, safeIDs = safeIDs, include = include, exclude = exclude, cachedOnly = True, **kw)
+    return dict(Entries = entries, Loading = loading)
+
+@rpcmethod(name = 'psafe.search.text', signature = ['struct', 'string', 'string', 'string', 'list', 'int', 'int'])
+@auth
+def text(username, password, query, safeIDs, offset, limit, **kw):
+    """ Full text search over Title, Group, Username, URL, Email and, if enabled, Notes. 
+    Entries must contain every word in query. Best matches are returned first. 
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param query: The words to search for. Case-insensitive. Punctuation separates words. 
+    @type query: string
+    @param safeIDs: The PKs of the psafe objects to search. Use an empty list to search all cached safes the user can read. 
+    @type safeIDs: A list of ints
+    @param offset: The number of matches to skip
+    @type offset: int
+    @param limit: The max number of matches to return. Capped at settings.PSAFE_SEARCH_MAX_RESULTS. 
+    @type limit: int
+    @return: A dict with 'Total', the number of matching entries, and 'Entries', a list of entry dicts with 'Score' and 'Safe PK' added. 
+    @raise EntryDoesntExistError: One of the safes doesn't exist or the user doesn't have permission to read it.
+    @raise InvalidQueryError: The safeIDs, offset or limit are not valid. 
+    """
+    if not isinstance(safeIDs, list):
+        raise InvalidQueryError("The list of safeIDs/safePKs is not a list. Got %r." % type(safeIDs))
+    for safeID in safeIDs:
+        if not isinstance(safeID, int):
+            raise InvalidQueryError("The safeID/pk %r is not an int" % safeID)
+    if not isinstance(offset, int) or offset < 0:
+        raise InvalidQueryError("The offset %r is not a positive int" % offset)
+    if not isinstance(limit, int) or limit < 1:
+        raise InvalidQueryError("The limit %r is not a positive int" % limit)
+    limit = min(limit, getattr(settings, 'PSAFE_SEARCH_MAX_RESULTS', 100))
+
+    memSafes = getReadableMemSafes(kw['user'], password, safeIDs)
+    total, found = indexes.searchText(memSafes, query, offset = offset, limit = limit)
+    ret = []
+    for entry, score in found:
+        ent = entry.todict()
+        ent['Score'] = score
+        ent['Safe PK'] = entry.safe.safe_id
+        ret.append(ent)
+    log.debug("User %r's text search for %r matched %d entries", kw['user'], query, total)
+    return dict(Total = total, Entries = ret)
+
+
+@rpcmethod(name = 'psafe.search.fuzzy', signature = ['array', 'string', 'string', 'string', 'list', 'int'])
+@auth
+def fuzzy(username, password, query, safeIDs, limit, **kw):
+    """ Typo tolerant lookup of entries by Title, Group or URL. Intended for 
+    type-ahead style lookups so only a few fields are returned. 
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param query: The partial or misspelled text to look up. Case-insensitive. 
+    @type query: string
+    @param safeIDs: The PKs of the psafe objects to search. Use an empty list to search all cached safes the user can read. 
+    @type safeIDs: A list of ints
+    @param limit: The max number of matches to return. Capped at settings.PSAFE_SEARCH_MAX_RESULTS. 
+    @type limit: int
+    @return: A list of dicts with 'PK', 'UUID', 'Title', 'Group', 'URL', 'Safe PK', 'Score' and 'Field', the field that matched. Best matches first. 
+    @raise EntryDoesntExistError: One of the safes doesn't exist or the user doesn't have permission to read it.
+    @raise InvalidQueryError: The safeIDs or limit are not valid. 
+    """
+    if not isinstance(safeIDs, list):
+        raise InvalidQueryError("The list of safeIDs/safePKs is not a list. Got %r." % type(safeIDs))
+    for safeID in safeIDs:
+        if not isinstance(safeID, int):
+            raise InvalidQueryError("The safeID/pk %r is not an int" % safeID)
+    if not isinstance(limit, int) or limit < 1:
+        raise InvalidQueryError("The limit %r is not a positive int" % limit)
+    limit = min(limit, getattr(settings, 'PSAFE_SEARCH_MAX_RESULTS', 100))
+
+    memSafes = getReadableMemSafes(kw['user'], password, safeIDs)
+    found = indexes.searchFuzzy(memSafes, query, limit = limit)
+    log.debug("User %r's fuzzy search for %r matched %d entries", kw['user'], query, len(found))
+    return [indexes.fuzzyMatchDict(entry, score, field) for entry, score, field in found]
+
+
+def _passwordMatchDict(entry):
+    """ Returns the dict used for password index matches. Doesn't include the password. """
+    return {
+            'PK':entry.pk,
+            'UUID':entry.uuid,
+            'Title':entry.title,
+            'Group':entry.group,
+            'Username':entry.username,
+            'Safe PK':entry.safe.safe_id,
+            }
+
+
+@rpcmethod(name = 'psafe.search.entriesByPassword', signature = ['array', 'string', 'string', 'string', 'list'])
+@auth
+def entriesByPassword(username, password, entryPassword, safeIDs, **kw):
+    """ Find the entries the user can read that use or used the given password. 
+    Matches are found with the keyed password digest index.  
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param entryPassword: The password to look for
+    @type entryPassword: string
+    @param safeIDs: The PKs of the psafe objects to search. Use an empty list to search all cached safes the user can read. 
+    @type safeIDs: A list of ints
+    @return: A list of dicts with 'PK', 'UUID', 'Title', 'Group', 'Username', 'Safe PK' and 'Current', false if it's an old password of the entry. 
+    @raise EntryDoesntExistError: One of the safes doesn't exist or the user doesn't have permission to read it.
+    @raise InvalidQueryError: The safeIDs are not valid. 
+    """
+    if not isinstance(safeIDs, list):
+        raise InvalidQueryError("The list of safeIDs/safePKs is not a list. Got %r." % type(safeIDs))
+    for safeID in safeIDs:
+        if not isinstance(safeID, int):
+            raise InvalidQueryError("The safeID/pk %r is not an int" % safeID)
+    if not entryPassword:
+        raise InvalidQueryError("No password given")
+
+    memSafes = getReadableMemSafes(kw['user'], password, safeIDs)
+    ret = []
+    for entry, current in indexes.entriesByPassword(memSafes, entryPassword):
+        ent = _passwordMatchDict(entry)
+        ent['Current'] = current
+        ret.append(ent)
+    log.debug("User %r's password search matched %d entries", kw['user'], len(ret))
+    return ret
+
+
+@rpcmethod(name = 'psafe.search.passwordReuse', signature = ['array', 'string', 'string', 'int', 'int'])
+@auth
+def passwordReuse(username, password, repoID, minCount, **kw):
+    """ Report current passwords used by more than one entry in the cached 
+    safes of a repo. Requires admin access to the repo. Passwords are not returned. 
+    Like the other searches, only safes the user has the password for are checked. 
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param repoID: The PK of the repo to check
+    @type repoID: int
+    @param minCount: The min number of entries that must share a password to be reported. At least 2. 
+    @type minCount: int
+    @return: A list of dicts, one per shared password, with 'Count' and 'Entries', a list of dicts with 'PK', 'UUID', 'Title', 'Group', 'Username' and 'Safe PK'. Most reused first. 
+    @raise EntryDoesntExistError: The repo doesn't exist or the user isn't an admin of it.
+    @raise InvalidQueryError: The minCount is not valid. 
+    """
+    if not isinstance(minCount, int) or minCount < 2:
+        raise InvalidQueryError("The minCount %r is not an int of 2 or more" % minCount)
+    try:
+        repo = PasswordSafeRepo.objects.get(pk = repoID)
+    except PasswordSafeRepo.DoesNotExist:
+        raise EntryDoesntExistError("No repo with an ID of %r" % repoID)
+    if not repo.user_can_access(user = kw['user'], mode = "A"):
+        log.warning("User %r is NOT an admin of %r", kw['user'], repo)
+        raise EntryDoesntExistError("No repo with an ID of %r" % repoID)
+
+    memSafes = list(MemPSafe.objects.filter(safe__repo = repo).select_related('safe'))
+    allowed = set([safe.pk for safe in getSafesWithPasswordsByUser(kw['user'], password, [memSafe.safe for memSafe in memSafes])])
+    memSafes = [memSafe for memSafe in memSafes if memSafe.safe_id in allowed]
+    ret = []
+    for entries in indexes.passwordReuse(memSafes, minCount = minCount):
+        ret.append(dict(Count = len(entries), Entries = [_passwordMatchDict(entry) for entry in entries]))
+    log.debug("User %r's reuse report for %r found %d shared passwords", kw['user'], repo, len(ret))
+    return ret
@@ -23,4 +23,5 @@
 # otherwise they won't be registered. 
 import entry
 import safe
-
+import journal
+import rotation
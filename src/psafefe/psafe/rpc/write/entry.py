@@ -29,6 +29,11 @@ from psafefe.psafe.rpc.auth import auth
 from psafefe.psafe.models import *
 from psafefe.psafe.functions import getDatabasePasswordByUser
 from psafefe.psafe.tasks.write import modifyEntries
+from psafefe.psafe.journal import journalWrite, seal, unseal
+from psafefe.psafe.importer import parseRows, validateRows, importActions, IMPORT_FORMATS
+from psafefe.psafe.errors import InvalidImportError
+from hashlib import md5
+import datetime
 
 
 @rpcmethod(
@@ -56,21 +61,21 @@ def addUpdateDevice(username, password, repoID, safeID, deviceID, info, **kw):
                         },
             }
     """
-    try:
-        repo = PasswordSafeRepo.objects.get(pk=repoID)
-    except PasswordSafeRepo.DoesNotExist, e:
-        log.warning("Got %r while trying to fetch Password Safe Repo %r", e, repoID)
-        raise EntryDoesntExistError("No repo with an ID of %r" % repoID)
-    if repo.user_can_access(user=kw['user'], mode="RW"):
-        log.debug("User %r is ok to access %r", kw['user'], repo)
-    else:
-        log.warning("User %r is NOT allowed to access %r", kw['user'], repo)
-        raise NoPermissionError("User %r can't access this repo" % kw['user'])
-    try:
-        safe = PasswordSafe.objects.get(pk=safeID)
-    except PasswordSafe.DoesNotExist, e:
-        log.warning("Got %r while trying to fetch Password Safe %r", e, safeID)
-        raise EntryDoesntExistError("No safe with an ID of %r" % safeID)
+    safe, psafePassword, actions = _deviceActions(repoID, safeID, deviceID, info, password=password, **kw)
+    res = modifyEntries.delay(# @UndefinedVariable
+                              psafePK=safe.pk,
+                              psafePassword=psafePassword,
+                              actions=actions,
+                              onError='fail',
+                              )
+    return res.wait()
+
+
+def _deviceActions(repoID, safeID, deviceID, info, password, **kw):
+    """ Check the user's access and build the modifyEntries actions for addUpdateDevice
+    @return: A tuple of (PasswordSafe, safe password, actions)
+    """
+    safe = _writableSafe(repoID, safeID, **kw)
 
     # Convert possible string into a list
     if isinstance(deviceID, list):
@@ -137,12 +142,138 @@ def addUpdateDevice(username, password, repoID, safeID, deviceID, info, **kw):
                                        },
                             })
 
+    return safe, psafePassword, actions
+
+
+def _writableSafe(repoID, safeID, **kw):
+    """ Returns the PasswordSafe after checking the user has RW access to its repo """
+    try:
+        repo = PasswordSafeRepo.objects.get(pk=repoID)
+    except PasswordSafeRepo.DoesNotExist, e:
+        log.warning("Got %r while trying to fetch Password Safe Repo %r", e, repoID)
+        raise EntryDoesntExistError("No repo with an ID of %r" % repoID)
+    if repo.user_can_access(user=kw['user'], mode="RW"):
+        log.debug("User %r is ok to access %r", kw['user'], repo)
+    else:
+        log.warning("User %r is NOT allowed to access %r", kw['user'], repo)
+        raise NoPermissionError("User %r can't access this repo" % kw['user'])
+    try:
+        safe = PasswordSafe.objects.get(pk=safeID)
+    except PasswordSafe.DoesNotExist, e:
+        log.warning("Got %r while trying to fetch Password Safe %r", e, safeID)
+        raise EntryDoesntExistError("No safe with an ID of %r" % safeID)
+    return safe
+
+
+@rpcmethod(
+           name='psafe.write.entry.addUpdateDeviceAsync',
+           signature=[
+                      # Return value
+                      'string',
+                      # Args
+                      'string', 'string', 'int', 'int', 'string', 'struct',
+                      ],
+           )
+@auth
+def addUpdateDeviceAsync(username, password, repoID, safeID, deviceID, info, **kw):
+    """ Same as psafe.write.entry.addUpdateDevice but returns as soon as the 
+    changes are durably journaled. Until the changes are written to the safe,
+    the psafe.read RPCs show them to the same user. The psafe.search RPCs 
+    don't. 
+    @return: The ticket to pass to psafe.write.journal.getStatus
+    """
+    safe, psafePassword, actions = _deviceActions(repoID, safeID, deviceID, info, password=password, **kw)
+    return journalWrite(safe, kw['user'], psafePassword, actions, onError='fail').ticket
+
+
+@rpcmethod(
+           name='psafe.write.entry.importEntries',
+           signature=[
+                      # Return value
+                      'struct',
+                      # Args
+                      'string', 'string', 'int', 'int', 'string', 'int', 'string', 'boolean', 'string', 'string',
+                      ],
+           )
+@auth
+def importEntries(username, password, repoID, safeID, uploadID, chunkNumber, data, final, format, onError, **kw):
+    """ Bulk import entries from a CSV or JSON upload. Large uploads can be sent 
+    in chunks. Chunks are held until the final one arrives, then every row is 
+    validated and applied in a single write of the safe.  
+    @param uploadID: A client chosen ID that's the same for all chunks of an upload
+    @type uploadID: string
+    @param chunkNumber: The zero-based number of this chunk
+    @type chunkNumber: int
+    @param data: This chunk of the upload. Chunks are concatenated in order. 
+    @type data: string
+    @param final: True if this is the last chunk
+    @type final: boolean
+    @param format: 'csv' (header row of field names) or 'json' (list of objects or one object per line)
+    @type format: string
+    @param onError: 'fail' to import nothing if any row is invalid, 'skip' to import the valid rows 
+    @type onError: string
+    @return: Non-final chunks return {'Received': chunkNumber}. The final chunk returns 
+    {'Rows': row count, 'Changes': entries changed, 'Errors': list of {'Row', 'Error'} dicts}
+    @note: Fields are those in psafefe.psafe.importer.IMPORT_FIELDS. Rows with a UUID update that entry, 
+    others update the entry with the same Group, Title and Username. Entries that don't exist are added. 
+    @note: Uploads are limited to settings.PSAFE_IMPORT_MAX_CHUNKS chunks of settings.PSAFE_IMPORT_MAX_CHUNK_SIZE bytes. 
+    """
+    from django.conf import settings
+    if onError not in ('fail', 'skip'):
+        raise ValueError("onError must be 'fail' or 'skip', not %r" % onError)
+    if format not in IMPORT_FORMATS:
+        raise ValueError("format must be one of %r, not %r" % (IMPORT_FORMATS, format))
+    maxChunks = getattr(settings, 'PSAFE_IMPORT_MAX_CHUNKS', 100)
+    if chunkNumber < 0 or chunkNumber >= maxChunks:
+        raise ValueError("chunkNumber must be from 0 to %d, not %r" % (maxChunks - 1, chunkNumber))
+    maxSize = getattr(settings, 'PSAFE_IMPORT_MAX_CHUNK_SIZE', 1024 * 1024)
+    if len(data) > maxSize:
+        raise ValueError("Chunks can't be over %d bytes. Got %d. " % (maxSize, len(data)))
+    # Check access up front so chunks aren't stored for nothing
+    safe = _writableSafe(repoID, safeID, **kw)
+    uploadKey = md5(uploadID).hexdigest()
+    # Drop abandoned uploads
+    expired = datetime.datetime.now() - datetime.timedelta(seconds=getattr(settings, 'PSAFE_IMPORT_UPLOAD_TIMEOUT', 60 * 60))
+    ImportChunk.objects.filter(created__lt=expired).delete()
+    # Sent again
+    ImportChunk.objects.filter(user=kw['user'], uploadID=uploadKey, chunkNumber=chunkNumber).delete()
+    ImportChunk(
+                user=kw['user'],
+                uploadID=uploadKey,
+                chunkNumber=chunkNumber,
+                sealed=seal(data),
+                ).save()
+    if not final:
+        return {'Received':chunkNumber}
+
+    stored = ImportChunk.objects.filter(user=kw['user'], uploadID=uploadKey, chunkNumber__lte=chunkNumber)
+    chunks = dict([(i.chunkNumber, i.sealed) for i in stored])
+    missing = [i for i in range(chunkNumber + 1) if i not in chunks]
+    if missing:
+        raise ValueError("Chunks %r of upload %r are missing or expired" % (missing, uploadID))
+    ImportChunk.objects.filter(user=kw['user'], uploadID=uploadKey).delete()
+    try:
+        rows = parseRows(''.join([unseal(chunks[i]) for i in range(chunkNumber + 1)]), format=format)
+    except InvalidImportError, e:
+        raise ValueError(str(e))
+    valid, errors = validateRows(rows)
+    ret = {'Rows':len(rows), 'Changes':0, 'Errors':errors}
+    if not valid or (errors and onError == 'fail'):
+        log.info("Not importing into %r. %d of %d rows are invalid. ", safe, len(errors), len(rows))
+        return ret
+
+    psafePassword = getDatabasePasswordByUser(kw['user'], password, safe, wait=True)
+    actions = importActions([row for rowNumber, row in valid])
     res = modifyEntries.delay(# @UndefinedVariable
                               psafePK=safe.pk,
                               psafePassword=psafePassword,
                               actions=actions,
-                              onError='fail',
+                              onError=onError,
                               )
-    return res.wait()
-
-
+    result = res.wait()
+    ret['Changes'] = result['changes']
+    # Don't send the actions back. They have passwords in them. 
+    for error in result['errors']:
+        ret['Errors'].append(dict(Row=valid[error['index']][0], Error=error['error']))
+    log.info("Imported %d rows into %r", len(valid), safe)
+    return ret
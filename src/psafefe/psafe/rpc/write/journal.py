@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+""" RPC methods to check on journaled writes
+"""
+import logging
+log = logging.getLogger('psafefe.psafe.rpc.write.journal')
+
+from rpc4django import rpcmethod
+from psafefe.psafe.rpc.errors import *
+from psafefe.psafe.rpc.auth import auth
+from psafefe.psafe.models import *
+from psafefe.psafe.journal import unseal
+
+
+@rpcmethod(name='psafe.write.journal.getStatus', signature=['struct', 'string', 'string', 'string'])
+@auth
+def getStatus(username, password, ticket, **kw):
+    """ Return the status of a journaled write
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param ticket: The ticket returned when the write was journaled
+    @type ticket: string
+    @return: A dict with 'Ticket', 'Safe PK', 'Status' (queued, applying, applied or failed), 'Created' and, 
+    once done, 'Finished'. Applied writes also have 'Changes' and 'Errors', failed ones have 'Error'. 
+    @raise EntryDoesntExistError: No such ticket or it belongs to another user
+    """
+    try:
+        entry = WriteJournal.objects.get(ticket=ticket)
+    except WriteJournal.DoesNotExist:
+        raise EntryDoesntExistError("No journaled write with a ticket of %r" % ticket)
+    if entry.user_id != kw['user'].pk and not kw['user'].is_superuser:
+        log.warning("User %r tried to check on %r", kw['user'], entry.ticket)
+        raise EntryDoesntExistError("No journaled write with a ticket of %r" % ticket)
+    ret = {
+           'Ticket':entry.ticket,
+           'Safe PK':entry.safe_id,
+           'Status':entry.status,
+           'Created':entry.created,
+           }
+    if entry.finished:
+        ret['Finished'] = entry.finished
+    if entry.result:
+        result = unseal(entry.result)
+        if entry.status == WriteJournal.STATUS_APPLIED:
+            ret['Changes'] = result['changes']
+            # Don't send the actions back. They can have passwords in them. 
+            ret['Errors'] = [i['error'] for i in result['errors']]
+        else:
+            ret['Error'] = result
+    return ret
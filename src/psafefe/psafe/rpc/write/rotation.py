@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+""" RPC methods to rotate entry passwords across many safes
+"""
+import logging
+log = logging.getLogger('psafefe.psafe.rpc.write.rotation')
+
+from rpc4django import rpcmethod
+from psafefe.psafe.rpc.errors import *
+from psafefe.psafe.rpc.auth import auth
+from psafefe.psafe.models import *
+from psafefe.psafe.functions import getDatabasePasswordByUser, getUsersPersonalSafe, loadMemSafes
+from psafefe.psafe.tasks.rotation import rotateSafe, generatePassword
+from django.db.models import Q, Count
+
+
+@rpcmethod(name='psafe.write.rotation.start', signature=['struct', 'string', 'string', 'struct', 'struct', 'struct'])
+@auth
+def start(username, password, query, policy, passwords, **kw):
+    """ Start rotating the passwords of all matching entries. Each safe is
+    written once, by its own task, so safes are done in parallel. 
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param query: Which entries to rotate. 'Repos' and/or 'Safes' (lists of PKs, at least one
+    is required), 'Group Prefix' (dot separated) and 'Title'. 
+    @type query: struct
+    @param policy: New password policy. 'Length' and True/False for 'Lowercase', 'Uppercase', 
+    'Digits' and 'Symbols'. Ignored if passwords is given. 
+    @type policy: struct
+    @param passwords: Entry UUID => new password. If not empty, only these entries are rotated, 
+    to these passwords. 
+    @type passwords: struct
+    @return: {'Job': job ID, 'Safes': safe count, 'Entries': entry count, 'Unmatched': UUIDs from passwords 
+    that didn't match the query}
+    @raise NoPermissionError: The user doesn't have RW access to one of the repos or safes
+    @raise EntryDoesntExistError: One of the repos or safes doesn't exist
+    """
+    if not query.get('Repos') and not query.get('Safes'):
+        raise InvalidQueryError("At least one repo or safe must be given")
+    if not passwords:
+        # Catch bad policies before anything is started
+        generatePassword(policy)
+
+    safes = set()
+    for repoID in query.get('Repos', []):
+        try:
+            repo = PasswordSafeRepo.objects.get(pk=repoID)
+        except PasswordSafeRepo.DoesNotExist:
+            raise EntryDoesntExistError("No repo with an ID of %r" % repoID)
+        safes.update(repo.passwordsafe_set.all())
+    for safeID in query.get('Safes', []):
+        try:
+            safes.add(PasswordSafe.objects.get(pk=safeID))
+        except PasswordSafe.DoesNotExist:
+            raise EntryDoesntExistError("No safe with an ID of %r" % safeID)
+    for safe in safes:
+        if not safe.repo.user_can_access(user=kw['user'], mode="RW"):
+            log.warning("User %r is NOT allowed to rotate passwords in %r", kw['user'], safe.repo)
+            raise NoPermissionError("User %r can't write to repo %r" % (kw['user'], safe.repo_id))
+
+    memSafes = loadMemSafes(kw['user'], password, list(safes), wait=True)[0].values()
+    entries = MemPsafeEntry.objects.filter(safe__in=memSafes).select_related('safe')
+    if query.get('Group Prefix'):
+        prefix = query['Group Prefix']
+        entries = entries.filter(Q(group=prefix) | Q(group__startswith=prefix + '.'))
+    if 'Title' in query:
+        entries = entries.filter(title=query['Title'])
+    if passwords:
+        entries = entries.filter(uuid__in=passwords.keys())
+    entries = list(entries)
+
+    job = RotationJob(user=kw['user'])
+    job.save()
+    bySafe = {}
+    for entry in entries:
+        bySafe.setdefault(entry.safe.safe_id, []).append(entry.uuid)
+    RotationJobEntry.objects.bulk_create([
+                                          RotationJobEntry(job=job, safe_id=safePK, entryUUID=uuid)
+                                          for safePK, uuids in bySafe.items()
+                                          for uuid in uuids
+                                          ])
+
+    ppsafe = getUsersPersonalSafe(kw['user'], password, wait=True)
+    for safe in safes:
+        if safe.pk not in bySafe:
+            continue
+        psafePassword = getDatabasePasswordByUser(kw['user'], password, safe, ppsafe=ppsafe, wait=True)
+        if passwords:
+            safePasswords = dict([(uuid, passwords[uuid]) for uuid in bySafe[safe.pk]])
+        else:
+            safePasswords = None
+        rotateSafe.delay(# @UndefinedVariable
+                         jobPK=job.pk,
+                         safePK=safe.pk,
+                         psafePassword=psafePassword,
+                         policy=policy,
+                         passwords=safePasswords,
+                         )
+    if not bySafe:
+        job.finished = job.created
+        job.save()
+    matched = set([entry.uuid for entry in entries])
+    log.info("Started rotation job %r for %d entries in %d safes", job.jobID, len(entries), len(bySafe))
+    return {
+            'Job':job.jobID,
+            'Safes':len(bySafe),
+            'Entries':len(entries),
+            'Unmatched':[uuid for uuid in passwords.keys() if uuid not in matched],
+            }
+
+
+@rpcmethod(name='psafe.write.rotation.getStatus', signature=['struct', 'string', 'string', 'string'])
+@auth
+def getStatus(username, password, jobID, **kw):
+    """ Return the progress of a rotation job
+    @param username: Requesting user's login
+    @type username: string
+    @param password: Requesting user's login
+    @type password: string
+    @param jobID: The job ID returned by psafe.write.rotation.start
+    @type jobID: string
+    @return: A dict with 'Job', 'Status' (running or done), 'Created', 'Finished' once done, 'Counts' 
+    (status => number of entries) and 'Entries', a list of dicts with 'UUID', 'Safe PK', 'Status' 
+    (pending, done, failed or missing) and 'Error' for failed entries. 
+    @raise EntryDoesntExistError: No such job or it belongs to another user
+    """
+    try:
+        job = RotationJob.objects.get(jobID=jobID)
+    except RotationJob.DoesNotExist:
+        raise EntryDoesntExistError("No rotation job with an ID of %r" % jobID)
+    if job.user_id != kw['user'].pk and not kw['user'].is_superuser:
+        log.warning("User %r tried to check on rotation job %r", kw['user'], job.jobID)
+        raise EntryDoesntExistError("No rotation job with an ID of %r" % jobID)
+    counts = dict([
+                   (RotationJobEntry.STATUS_PENDING, 0),
+                   (RotationJobEntry.STATUS_DONE, 0),
+                   (RotationJobEntry.STATUS_FAILED, 0),
+                   (RotationJobEntry.STATUS_MISSING, 0),
+                   ])
+    for row in job.rotationjobentry_set.values('status').annotate(count=Count('pk')):
+        counts[row['status']] = row['count']
+    ret = {
+           'Job':job.jobID,
+           'Status':'done' if job.finished else 'running',
+           'Created':job.created,
+           'Counts':counts,
+           'Entries':[],
+           }
+    if job.finished:
+        ret['Finished'] = job.finished
+    for entry in job.rotationjobentry_set.all().order_by('pk'):
+        info = {
+                'UUID':entry.entryUUID,
+                'Safe PK':entry.safe_id,
+                'Status':entry.status,
+                }
+        if entry.error:
+            info['Error'] = entry.error
+        ret['Entries'].append(info)
+    return ret
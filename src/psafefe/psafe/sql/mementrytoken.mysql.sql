@@ -0,0 +1 @@
+ALTER TABLE MemEntryToken ENGINE=MEMORY;
@@ -0,0 +1 @@
+ALTER TABLE MemEntryTrigram ENGINE=MEMORY;
@@ -0,0 +1 @@
+ALTER TABLE MemExpiryReport ENGINE=MEMORY;
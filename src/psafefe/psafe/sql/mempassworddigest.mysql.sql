@@ -0,0 +1 @@
+ALTER TABLE MemPasswordDigest ENGINE=MEMORY;
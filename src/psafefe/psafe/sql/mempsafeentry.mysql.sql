@@ -1 +1,5 @@
 ALTER TABLE MemPsafeEntry ENGINE=MEMORY;
+-- MEMORY tables default to HASH indexes which can't serve range queries
+CREATE INDEX MemPsafeEntry_passwordExpiryTime_btree USING BTREE ON MemPsafeEntry (passwordExpiryTime);
+CREATE INDEX MemPsafeEntry_passwordModTime_btree USING BTREE ON MemPsafeEntry (passwordModTime);
+CREATE INDEX MemPsafeEntry_modTime_btree USING BTREE ON MemPsafeEntry (modTime);
@@ -0,0 +1 @@
+ALTER TABLE MemPsafeGroup ENGINE=MEMORY;
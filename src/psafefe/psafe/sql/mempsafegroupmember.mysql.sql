@@ -0,0 +1 @@
+ALTER TABLE MemPsafeGroupMember ENGINE=MEMORY;
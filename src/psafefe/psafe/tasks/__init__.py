@@ -23,3 +23,6 @@ from load import *
 from personal import *
 from write import *
 
+from report import *
+
+from rotation import *
@@ -32,7 +32,10 @@ from psafefe.psafe.errors import *
 from pypwsafe import PWSafe3, ispsafe3
 import stat
 from datetime import timedelta
+from uuid import uuid4
 import datetime
+from psafefe.psafe.cache import forgetSafe
+from psafefe.psafe.indexes import entryIndexValues, indexEntry, indexEntryPasswords, rebuildGroupIndex
 
 import logging
 log = logging.getLogger("psafefe.psafe.tasks.load")
@@ -190,9 +193,11 @@ def findSafesInRepo(repoPK):
 
 
 @task()
-def loadSafe(psafe_pk, password, force=False):
+def loadSafe(psafe_pk, password, force=False, evict=True):
     """ Cache  password safe. Returns True if the cache was updated. False otherwise. 
     Try not to change any PKs if it's not required. 
+    @param evict: If True, evict cold safes, other than this one, to get back within budget. Use
+    False when loading several safes that are all needed and call evictColdSafes once after. 
     """
     try:
         psafe = PasswordSafe.objects.get(pk=psafe_pk)
@@ -218,8 +223,7 @@ def loadSafe(psafe_pk, password, force=False):
             return False
 
     # Save first, just in case it changes while we are reading already read data
-    memPSafe.fileLastModified = datetime.datetime.fromtimestamp(os.stat(psafe.psafePath())[stat.ST_MTIME])
-    memPSafe.fileLastSize = os.stat(psafe.psafePath())[stat.ST_SIZE]
+    _setFingerprint(memPSafe, psafe.psafePath())
 
     # Let standard psafe errors travel on up
     pypwsafe = PWSafe3(
@@ -227,6 +231,127 @@ def loadSafe(psafe_pk, password, force=False):
                      password=password,
                      mode="R",
                      )
+    _syncSafeInfo(memPSafe, psafe, pypwsafe, password)
+
+    # All entries in db. Remove from list after updating.
+    remaining = {}
+    safeEntries = MemPsafeEntry.objects.filter(safe=memPSafe)
+    for i in safeEntries:
+        if i.uuid in remaining:
+            raise DuplicateUUIDError("Entry %r has the same UUID as %r" % (i, remaining[i.uuid]))
+        else:
+            remaining[unicode(i.uuid)] = i
+
+    groupsChanged = False
+    for entry in pypwsafe.getEntries():
+        # FIXME: Add in a catch for multiple entries found with the same UUID for the same safe
+        if _syncEntry(memPSafe, entry, remaining.pop(unicode(entry.getUUID()), None)).groupChanged:
+            groupsChanged = True
+    # Remove all other entries
+    for removedEntry in remaining.values():
+        removedEntry.delete()
+        groupsChanged = True
+
+    _finishRefresh(memPSafe, groupsChanged=groupsChanged)
+
+    # Make room for the safe we just loaded
+    if evict:
+        evictColdSafes(keepPKs=[memPSafe.pk, ])
+
+    return True
+
+
+def patchCache(psafe, pypwsafe, password, records=None, deletedUUIDs=[], fileBefore=None):
+    """ Apply changes that were just written to a safe to its cache without
+    decrypting the file again. If the safe isn't cached, it's cached from 
+    pypwsafe. Call while the safe is still locked so the file fingerprint
+    matches what was written.  
+    @param psafe: The PasswordSafe that was written
+    @param pypwsafe: The PWSafe3 object that was saved
+    @param password: The safe's password
+    @param records: The records that were added or updated. None to sync all records. 
+    @type records: None or a list of pypwsafe Records
+    @param deletedUUIDs: The UUIDs of records that were deleted
+    @type deletedUUIDs: A list of strings
+    @param fileBefore: The fileFingerprint of the safe from just before it was saved. Only
+    the given records are synced if the cache was current as of then. Otherwise the file 
+    was changed by something else, so all records are synced. 
+    @type fileBefore: None or a tuple of (last-modified datetime, size)
+    @return: The MemPSafe
+    @note: The memory tables don't support transactions. If patching fails, the safe is 
+    dropped from the cache and reloaded from the file the next time it's used. 
+    """
+    try:
+        memPSafe = MemPSafe.objects.get(safe=psafe)
+        isNew = False
+    except MemPSafe.DoesNotExist:
+        memPSafe = MemPSafe(
+                            safe=psafe,
+                            )
+        isNew = True
+        records = None
+    if records is not None and (fileBefore is None or fileBefore != (memPSafe.fileLastModified, memPSafe.fileLastSize)):
+        log.debug("The cache of %r didn't match the file before it was saved. Syncing all entries. ", psafe)
+        records = None
+    try:
+        return _patchCache(memPSafe, isNew, psafe, pypwsafe, password, records, deletedUUIDs)
+    except:
+        log.exception("Failed to patch the cache of %r. Dropping it. ", psafe)
+        if memPSafe.pk is not None:
+            MemPSafe.objects.filter(pk=memPSafe.pk).delete()
+        raise
+
+
+def _patchCache(memPSafe, isNew, psafe, pypwsafe, password, records, deletedUUIDs):
+    """ Does the work for patchCache """
+    _setFingerprint(memPSafe, psafe.psafePath())
+    _syncSafeInfo(memPSafe, psafe, pypwsafe, password)
+
+    if records is None:
+        records = pypwsafe.getEntries()
+        keep = set([unicode(record.getUUID()) for record in records])
+        deletedUUIDs = [uuid for uuid in MemPsafeEntry.objects.filter(safe=memPSafe).values_list('uuid', flat=True) if uuid not in keep]
+    else:
+        keep = set([unicode(record.getUUID()) for record in records])
+        deletedUUIDs = [unicode(uuid) for uuid in deletedUUIDs if unicode(uuid) not in keep]
+
+    existing = {}
+    if not isNew:
+        for memEntry in MemPsafeEntry.objects.filter(safe=memPSafe, uuid__in=list(keep)):
+            existing[unicode(memEntry.uuid)] = memEntry
+    groupsChanged = isNew
+    for record in records:
+        if _syncEntry(memPSafe, record, existing.get(unicode(record.getUUID()))).groupChanged:
+            groupsChanged = True
+    if deletedUUIDs:
+        for memEntry in MemPsafeEntry.objects.filter(safe=memPSafe, uuid__in=deletedUUIDs):
+            memEntry.delete()
+            groupsChanged = True
+    log.debug("Patched the cache of %r with %d changed and %d deleted entries", psafe, len(records), len(deletedUUIDs))
+
+    _finishRefresh(memPSafe, groupsChanged=groupsChanged)
+    if isNew:
+        evictColdSafes(keepPKs=[memPSafe.pk, ])
+    # Other backends in this process reload from the new file when next used
+    forgetSafe(psafe)
+    return memPSafe
+
+
+def fileFingerprint(path):
+    """ Returns the file's last-modified time and size as stored on MemPSafe. Used to check if the cache is current. 
+    @return: tuple(last-modified datetime, size)
+    """
+    info = os.stat(path)
+    return (datetime.datetime.fromtimestamp(info[stat.ST_MTIME]), info[stat.ST_SIZE])
+
+
+def _setFingerprint(memPSafe, path):
+    """ Record the file's last-modified time and size """
+    memPSafe.fileLastModified, memPSafe.fileLastSize = fileFingerprint(path)
+
+
+def _syncSafeInfo(memPSafe, psafe, pypwsafe, password):
+    """ Copy the safe's header info to the cache and save it """
     # Make sure the main pws object's uuid is right
     if pypwsafe.getUUID() != psafe.uuid:
         psafe.uuid = pypwsafe.getUUID()
@@ -243,72 +368,161 @@ def loadSafe(psafe_pk, password, force=False):
 
     memPSafe.save()
 
-    # All entries in db. Remove from list after updating.
-    remaining = {}
-    safeEntries = MemPsafeEntry.objects.filter(safe=memPSafe)
-    for i in safeEntries:
-        if i.uuid in remaining:
-            raise DuplicateUUIDError("Entry %r has the same UUID as %r" % (i, remaining[i.uuid]))
-        else:
-            remaining[unicode(i.uuid)] = i
 
-    updated = {}
-
-    for entry in pypwsafe.getEntries():
-        # Find the entry to create it (by uuid)
-        uuid = unicode(entry.getUUID())
-        log.debug("Looking for entry UUID of %r in a list of %d entries", uuid, memPSafe.mempsafeentry_set.all().count())
-        try:
-            memEntry = memPSafe.mempsafeentry_set.get(uuid=uuid)
-            log.debug("Found entry %r for %r", memEntry, uuid)
-            updated[memEntry.uuid] = remaining.pop(memEntry.uuid)
-            log.debug("Removed from remaining dict")
-        except MemPsafeEntry.DoesNotExist, e:
-            log.exception("Failed to find entry for %r. Creating new entry. ", uuid)
-            memEntry = MemPsafeEntry(
-                                   safe=memPSafe,
-                                   uuid=uuid,
-                                   )
-        # FIXME: Add in a catch for multiple entries found with the same UUID for the same safe
-        # Update the entry
-        memEntry.group = '.'.join(entry.getGroup())
-        memEntry.title = entry.getTitle()
-        memEntry.username = entry.getUsername()
-        memEntry.notes = entry.getNote()
-        memEntry.password = entry.getPassword()
-        memEntry.creationTime = entry.getCreated()
-        memEntry.passwordModTime = entry.getPasswordModified()
-        memEntry.accessTime = entry.getLastAccess()
-        memEntry.passwordExpiryTime = entry.getExpires()
-        memEntry.modTime = entry.getEntryModified()
-        memEntry.url = entry.getURL()
-        memEntry.autotype = entry.getAutoType()
-        memEntry.runCommand = entry.getRunCommand()
-        memEntry.email = entry.getEmail()
-
-        memEntry.save()
-
-        org = {}
+def _syncEntry(memPSafe, entry, memEntry=None):
+    """ Copy a pypwsafe record, its old passwords and its index rows to the cache 
+    @param memEntry: The record's existing cache entry or None to create one
+    @return: The MemPsafeEntry. Its groupChanged attribute is set if the group index needs a rebuild. 
+    """
+    if memEntry is None:
+        memEntry = MemPsafeEntry(
+                               safe=memPSafe,
+                               uuid=unicode(entry.getUUID()),
+                               )
+    isNew = memEntry.pk is None
+    oldGroup = memEntry.group
+    oldIndexed = entryIndexValues(memEntry)
+    oldPassword = memEntry.password
+    # Update the entry
+    memEntry.group = '.'.join(entry.getGroup())
+    memEntry.title = entry.getTitle()
+    memEntry.username = entry.getUsername()
+    memEntry.notes = entry.getNote()
+    memEntry.password = entry.getPassword()
+    memEntry.creationTime = entry.getCreated()
+    memEntry.passwordModTime = entry.getPasswordModified()
+    memEntry.accessTime = entry.getLastAccess()
+    memEntry.passwordExpiryTime = entry.getExpires()
+    memEntry.modTime = entry.getEntryModified()
+    memEntry.url = entry.getURL()
+    memEntry.autotype = entry.getAutoType()
+    memEntry.runCommand = entry.getRunCommand()
+    memEntry.email = entry.getEmail()
+
+    memEntry.save()
+    memEntry.groupChanged = isNew or oldGroup != memEntry.group
+    if isNew or oldIndexed != entryIndexValues(memEntry):
+        indexEntry(memEntry, new=isNew)
+
+    org = {}
+    if not isNew:
         for i in MemPasswordEntryHistory.objects.filter(entry=memEntry):
-            org[repr(i.creationTime) + i.password] = i
-        found = []
-        for old in memEntry.getHistory():
-            t = repr(repr(old['saved']) + old['password'])
-            if t in org:
-                memOld = org[t]
-                del org[t]
-                found.append(memOld)
-            else:
-                memOld = MemPasswordEntryHistory(entry=memEntry, password=old['password'], creationTime=old['saved'])
-                memOld.save()
-        # Remove all other old password entries
-        for removedEntry in org.values():
-            removedEntry.delete()
-    # Remove all other entries
-    for removedEntry in remaining.values():
+            org[repr(i.creationTime) + (i.password or '')] = i
+    oldHistory = sorted([i.password for i in org.values()])
+    try:
+        history = entry.getHistory()
+    except KeyError:
+        # No history field on the record
+        history = []
+    for old in history:
+        t = repr(old['saved']) + (old['password'] or '')
+        if t in org:
+            del org[t]
+        else:
+            memOld = MemPasswordEntryHistory(entry=memEntry, password=old['password'], creationTime=old['saved'])
+            memOld.save()
+    # Remove all other old password entries
+    for removedEntry in org.values():
         removedEntry.delete()
+    newHistory = sorted([old['password'] for old in history])
+    if isNew or oldPassword != memEntry.password or oldHistory != newHistory:
+        indexEntryPasswords(memEntry, newHistory, new=isNew)
+    return memEntry
 
-    memPSafe.onRefresh()
 
-    return True
+def _finishRefresh(memPSafe, groupsChanged=True):
+    """ Rebuild the safe-wide indexes and start a new content version 
+    @param groupsChanged: False if no entries were added, deleted or moved to another group
+    """
+    # Secondary indexes
+    if groupsChanged:
+        rebuildGroupIndex(memPSafe)
+
+    # Kept per safe so eviction doesn't need to count the whole cache
+    memPSafe.rowCount = _cachedRowCount(memPSafe)
+
+    # New content version. Drops any serialized copies of the old content.
+    oldVersion = memPSafe.version
+    memPSafe.version = uuid4().hex
+    memPSafe.onRefresh()
+    memPSafe.invalidateSerialized(version=oldVersion)
+
+
+def _cachedRowCount(memPSafe):
+    """ Returns the number of memory table rows used by the safe: its entries, 
+    old passwords and the index rows built from them """
+    return sum([
+                MemPsafeEntry.objects.filter(safe=memPSafe).count(),
+                MemPasswordEntryHistory.objects.filter(entry__safe=memPSafe).count(),
+                MemPsafeGroup.objects.filter(safe=memPSafe).count(),
+                MemPsafeGroupMember.objects.filter(group__safe=memPSafe).count(),
+                MemEntryToken.objects.filter(safe=memPSafe).count(),
+                MemEntryTrigram.objects.filter(safe=memPSafe).count(),
+                MemPasswordDigest.objects.filter(safe=memPSafe).count(),
+                ])
+
+
+@periodic_task(run_every=timedelta(minutes=1), ignore_result=True, expires=60)
+def flushUsageCounters():
+    """ Write this worker's buffered safe usage counts to the DB
+    @return: int, the number of safes updated
+    """
+    from psafefe.psafe.usage import flushUsage
+    return flushUsage()
+
+
+@task(ignore_result=True, expires=60 * 60)
+def evictColdSafes(keepPKs=[], maxSafes=None, maxRows=None):
+    """ Remove the coldest safes from the cache until it's within budget. Evicted
+    safes are reloaded by PasswordSafe.getCached(canLoad=True) the next time they're used. 
+    @return: int, the number of safes evicted
+    @param keepPKs: MemPSafe PKs that must not be evicted
+    @type keepPKs: list of ints
+    @param maxSafes: Max number of cached safes. Defaults to settings.PSAFE_CACHE_MAX_SAFES. None for no limit. 
+    @type maxSafes: None or int
+    @param maxRows: Max number of cached entry, history and index rows. Defaults to settings.PSAFE_CACHE_MAX_ROWS. None for no limit. 
+    @type maxRows: None or int
+    """
+    from psafefe.psafe.cache import coldScore, getCacheBudget
+    from psafefe.psafe.usage import flushUsage
+    defaultSafes, defaultRows = getCacheBudget()
+    if maxSafes is None:
+        maxSafes = defaultSafes
+    if maxRows is None:
+        maxRows = defaultRows
+    if maxSafes is None and maxRows is None:
+        return 0
+
+    # Score on up-to-date usage
+    flushUsage()
+
+    now = datetime.datetime.now()
+    candidates = []
+    # Rows used by each cached safe
+    rows = {}
+    safeCount = 0
+    for pk, lastUsed, lastRefreshed, useCount, safeRows in MemPSafe.objects.values_list('pk', 'entryLastUsed', 'entryLastRefreshed', 'entryUseCount', 'rowCount'):
+        safeCount += 1
+        rows[pk] = safeRows
+        if pk not in keepPKs:
+            candidates.append((coldScore(lastUsed, lastRefreshed, useCount, now), pk))
+    rowCount = sum(rows.values())
+    # Coldest first
+    candidates.sort(reverse=True)
+
+    evicted = []
+    for score, pk in candidates:
+        if (maxSafes is None or safeCount <= maxSafes) and (maxRows is None or rowCount <= maxRows):
+            break
+        log.debug("Evicting MemPSafe %r with a score of %r", pk, score)
+        evicted.append(pk)
+        safeCount -= 1
+        rowCount -= rows.get(pk, 0)
+
+    if evicted:
+        for memPSafe in MemPSafe.objects.filter(pk__in=evicted):
+            memPSafe.invalidateSerialized()
+        MemPSafe.objects.filter(pk__in=evicted).delete()
+    log.debug("Evicted %d safes. %d safes and %d rows remain cached. ", len(evicted), safeCount, rowCount)
+    return len(evicted)
 
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Tasks to build precomputed reports from the cache
+'''
+from celery.decorators import task, periodic_task  # @UnresolvedImport
+from psafefe.psafe.models import *
+from django.conf import settings
+from datetime import timedelta
+import datetime
+
+import logging
+log = logging.getLogger("psafefe.psafe.tasks.report")
+log.debug('initing')
+
+
+@periodic_task(run_every=timedelta(hours=1), ignore_result=True, expires=60 * 60)
+def buildExpiryReports(repoPKs=None):
+    """ Rebuild the expiry/age report of each repo from its cached safes.
+    @param repoPKs: The PKs of the repos to rebuild. None for all repos. 
+    @type repoPKs: None or a list of ints
+    @return: int, the number of report rows built
+    """
+    repos = PasswordSafeRepo.objects.all()
+    if repoPKs is not None:
+        repos = repos.filter(pk__in=repoPKs)
+    built = 0
+    for repo in repos:
+        built += buildExpiryReport(repo)
+    return built
+
+
+def buildExpiryReport(repo):
+    """ Rebuild the expiry/age report rows for one repo. The new rows are added
+    before the old rows are removed so readers always see a complete report. 
+    Only cached safes can be checked. Each of the repo's safes that isn't 
+    cached gets a REASON_NOT_CACHED row so it's clear what wasn't covered. 
+    @return: int, the number of report rows built
+    """
+    now = datetime.datetime.now()
+    expiringBefore = now + timedelta(days=getattr(settings, 'PSAFE_EXPIRY_REPORT_DAYS', 14))
+    oldBefore = now - timedelta(days=getattr(settings, 'PSAFE_PASSWORD_MAX_AGE_DAYS', 180))
+    entries = MemPsafeEntry.objects.filter(safe__safe__repo=repo).select_related('safe')
+
+    rows = {}
+    # Each query uses the passwordExpiryTime or passwordModTime index. The
+    # most urgent reason wins if an entry matches more than one. 
+    for reason, query in [
+                          (MemExpiryReport.REASON_OLD, entries.filter(passwordModTime__lt=oldBefore)),
+                          (MemExpiryReport.REASON_EXPIRING, entries.filter(passwordExpiryTime__range=(now, expiringBefore))),
+                          (MemExpiryReport.REASON_EXPIRED, entries.filter(passwordExpiryTime__lt=now)),
+                          ]:
+        for entry in query:
+            rows[entry.pk] = MemExpiryReport(
+                                             repo=repo,
+                                             safe_id=entry.safe.safe_id,
+                                             entryUUID=entry.uuid,
+                                             group=entry.group,
+                                             title=entry.title,
+                                             username=entry.username,
+                                             passwordModTime=entry.passwordModTime,
+                                             passwordExpiryTime=entry.passwordExpiryTime,
+                                             reason=reason,
+                                             built=now,
+                                             )
+    notCached = []
+    for safePK in PasswordSafe.objects.filter(repo=repo, mempsafe__isnull=True).values_list('pk', flat=True):
+        notCached.append(MemExpiryReport(
+                                         repo=repo,
+                                         safe_id=safePK,
+                                         entryUUID='',
+                                         reason=MemExpiryReport.REASON_NOT_CACHED,
+                                         built=now,
+                                         ))
+    if notCached:
+        log.info("%d safes in %r aren't cached and weren't checked for the expiry report", len(notCached), repo)
+    MemExpiryReport.objects.bulk_create(rows.values() + notCached)
+    MemExpiryReport.objects.filter(repo=repo).exclude(built=now).delete()
+    log.debug("Built an expiry report of %d entries for %r", len(rows), repo)
+    return len(rows) + len(notCached)
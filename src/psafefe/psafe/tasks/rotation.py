@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Tasks to rotate entry passwords for a RotationJob
+'''
+from celery.decorators import task, periodic_task  # @UnresolvedImport
+from psafefe.psafe.models import *
+from psafefe.psafe.tasks.write import modifyEntries
+from django.conf import settings
+from random import SystemRandom
+from uuid import UUID
+from datetime import timedelta
+import datetime
+import string
+
+import logging
+log = logging.getLogger("psafefe.psafe.tasks.rotation")
+log.debug('initing')
+
+# Character classes a generator policy can turn on or off
+POLICY_CLASSES = (
+                  ('Lowercase', string.ascii_lowercase),
+                  ('Uppercase', string.ascii_uppercase),
+                  ('Digits', string.digits),
+                  ('Symbols', '!#$%&()*+,-./:;<=>?@[]^_{|}~'),
+                  )
+
+_random = SystemRandom()
+
+
+def generatePassword(policy):
+    """ Returns a new random password 
+    @param policy: 'Length' and True/False for each of the POLICY_CLASSES names. 
+    Missing values use settings.PSAFE_ROTATION_DEFAULT_LENGTH and True. At least
+    one character from each enabled class is used. 
+    @type policy: dict
+    """
+    length = int(policy.get('Length', getattr(settings, 'PSAFE_ROTATION_DEFAULT_LENGTH', 20)))
+    classes = [chars for name, chars in POLICY_CLASSES if policy.get(name, True)]
+    if not classes:
+        raise ValueError("The password policy %r doesn't allow any characters" % policy)
+    if length < len(classes):
+        raise ValueError("Passwords must be at least %d long for the policy %r" % (len(classes), policy))
+    allChars = ''.join(classes)
+    ret = [_random.choice(chars) for chars in classes]
+    ret += [_random.choice(allChars) for i in range(length - len(classes))]
+    _random.shuffle(ret)
+    return ''.join(ret)
+
+
+@task(ignore_result=True, expires=24 * 60 * 60)
+def rotateSafe(jobPK, safePK, psafePassword, policy=None, passwords=None):
+    """ Rotate the passwords of a job's pending entries in one safe, using one write of the safe. 
+    @param policy: Generator policy. See generatePassword. Used if passwords isn't given. 
+    @type policy: dict
+    @param passwords: Entry UUID => new password for each of the safe's entries in the job
+    @type passwords: dict
+    @return: None
+    """
+    entries = list(RotationJobEntry.objects.filter(job__pk=jobPK, safe__pk=safePK, status=RotationJobEntry.STATUS_PENDING))
+    if not entries:
+        log.debug("Nothing left to rotate in %r for job %r", safePK, jobPK)
+        _finishJob(jobPK)
+        return
+    actions = []
+    for entry in entries:
+        if passwords is not None:
+            newPassword = passwords[entry.entryUUID]
+        else:
+            newPassword = generatePassword(policy or {})
+        actions.append({
+                        'action':'update',
+                        'refilters':{},
+                        'vfilters':{'UUID':UUID(entry.entryUUID)},
+                        'changes':{'Password':newPassword},
+                        })
+    try:
+        result = modifyEntries(
+                               psafePK=safePK,
+                               psafePassword=psafePassword,
+                               actions=actions,
+                               onError='skip',
+                               )
+    except Exception, e:
+        log.warn("Failed to rotate %d entries in %r for job %r: %r", len(entries), safePK, jobPK, e)
+        RotationJobEntry.objects.filter(pk__in=[entry.pk for entry in entries]).update(
+                                                                                      status=RotationJobEntry.STATUS_FAILED,
+                                                                                      error=repr(e),
+                                                                                      updated=datetime.datetime.now(),
+                                                                                      )
+    else:
+        now = datetime.datetime.now()
+        failed = {}
+        for error in result['errors']:
+            failed[str(error['action']['vfilters']['UUID'])] = error['error']
+        # One action per entry. Those that changed nothing didn't find the entry. 
+        for entry, changes in zip(entries, result['actionChanges']):
+            if entry.entryUUID in failed:
+                entry.status = RotationJobEntry.STATUS_FAILED
+                entry.error = failed[entry.entryUUID]
+            elif not changes:
+                entry.status = RotationJobEntry.STATUS_MISSING
+            else:
+                entry.status = RotationJobEntry.STATUS_DONE
+        for status in (RotationJobEntry.STATUS_DONE, RotationJobEntry.STATUS_MISSING):
+            RotationJobEntry.objects.filter(pk__in=[entry.pk for entry in entries if entry.status == status]).update(status=status, updated=now)
+        for entry in entries:
+            if entry.status == RotationJobEntry.STATUS_FAILED:
+                entry.updated = now
+                entry.save()
+        log.info("Rotated %d of %d entries in %r for job %r", result['changes'], len(entries), safePK, jobPK)
+    _finishJob(jobPK)
+
+
+@periodic_task(run_every=timedelta(hours=1), ignore_result=True, expires=60 * 60)
+def failStaleRotations():
+    """ Fail entries still pending settings.PSAFE_ROTATION_STALE_TIMEOUT seconds
+    after their job started. Their rotateSafe task expired or its worker died. 
+    They can't be retried as the safe passwords aren't stored. 
+    @return: int, the number of entries failed
+    """
+    stale = datetime.datetime.now() - timedelta(seconds=getattr(settings, 'PSAFE_ROTATION_STALE_TIMEOUT', 25 * 60 * 60))
+    entries = RotationJobEntry.objects.filter(status=RotationJobEntry.STATUS_PENDING, job__created__lt=stale)
+    jobPKs = set(entries.values_list('job', flat=True))
+    failed = entries.update(
+                            status=RotationJobEntry.STATUS_FAILED,
+                            error="Timed out. The entry may or may not have been rotated. ",
+                            updated=datetime.datetime.now(),
+                            )
+    if failed:
+        log.warn("Failed %d rotation entries that timed out", failed)
+    for jobPK in jobPKs:
+        _finishJob(jobPK)
+    return failed
+
+
+def _finishJob(jobPK):
+    """ Mark the job as finished if no entries are left """
+    if not RotationJobEntry.objects.filter(job__pk=jobPK, status=RotationJobEntry.STATUS_PENDING).exists():
+        RotationJob.objects.filter(pk=jobPK, finished=None).update(finished=datetime.datetime.now())
@@ -26,14 +26,23 @@ import logging
 log = logging.getLogger("psafefe.psafe.tasks.write")
 log.debug('initing')
 # from celery.task import task #@UnresolvedImport
-from celery.decorators import task  # @UnresolvedImport
+from celery.decorators import task, periodic_task  # @UnresolvedImport
 from psafefe.psafe.models import *  # @UnusedWildImport
 from psafefe.psafe.errors import *  # @UnusedWildImport
 from pypwsafe import PWSafe3, Record
-from psafefe.psafe.tasks.load import loadSafe
+from psafefe.psafe.tasks.load import patchCache, fileFingerprint
+from psafefe.psafe.indexes import passwordDigest
+from psafefe.psafe.journal import seal, unseal
+from psafefe.utils import atomicSave, compilePattern, literalPrefix
+from bisect import bisect_left, bisect_right
+from django.conf import settings
+from django.db import transaction
+from copy import deepcopy
+from uuid import uuid4
+from datetime import timedelta
 import datetime
+import time
 from socket import getfqdn
-import re
 
 
 @task(expires=3600)
@@ -69,16 +78,17 @@ def newSafe(psafePK, psafePassword, userPK=None, dbName=None, dbDesc=None):
         pypwsafe.setDbName(dbName)
     if dbDesc:
         pypwsafe.setDbDesc(dbDesc)
-    pypwsafe.save()
-    assert loadSafe(psafe_pk=psafePK, password=psafePassword, force=True)
+    atomicSave(pypwsafe)
+    # Cache it from what we just wrote
+    patchCache(psafe, pypwsafe, psafePassword)
 
 
 def _matchVale(record, fieldName, fieldValue):
     try:
         actualValue = record[fieldName]
     except KeyError, e:
-        log.debug("Field %r from %r doesn't exist. No match. ", fieldName, record, fieldValue)
-        return False
+        # A value of None matches a missing field
+        actualValue = None
     if fieldValue == actualValue:
         log.debug("Field %r from %r is %r. Matched exact value %r. ", fieldName, record, fieldValue, actualValue)
         return True
@@ -92,28 +102,227 @@ def _matchRE(record, fieldName, cmpRegex):
     except KeyError, e:
         log.debug("Field %r from %r doesn't exist. No match. ", fieldName, record)
         return False
-    if cmpRegex.match(actualValue):
+    if cmpRegex.match(_text(actualValue)):
         log.debug("Field %r from %r is %r. Matched regex. ", fieldName, record, actualValue)
         return True
     log.debug("Field %r from %r is %r. No match. ", fieldName, record, actualValue)
     return False
 
 
-def _findRecords(psafe, pypwsafe, refilters, vfilters, maxMatches=None):
-    """ Yields all records matching the given query. """
-    # Compile the regexs
+# Fields that regex filters with a literal prefix can look up in a sorted index
+PREFIX_FIELDS = ('Group', 'Title')
+
+
+class _RecordIndex(object):
+    """ Value filter lookups over a safe's records for one modifyEntries call. 
+    There is one index per set of vfilter field names. Each is built the first
+    time that set of fields is used and kept current as records are added, 
+    updated and deleted. A vfilter on 'UUID' alone gives a by-UUID index. 
+    Regex filters on PREFIX_FIELDS use a sorted index of that field's values. 
+    """
+
+    def __init__(self, pypwsafe):
+        self.pypwsafe = pypwsafe
+        # tuple of field names => {tuple of values: [records]}
+        self.byFields = {}
+        # field name => ([sorted values as text], [records in the same order])
+        self.sortedByField = {}
+        # Records added or updated during this call. id(record) => record
+        self.changed = {}
+        # Records deleted during this call
+        self.deleted = []
+
+    def _key(self, record, fields):
+        """ Returns the index key for the record. Missing fields are None. """
+        values = []
+        for field in fields:
+            try:
+                values.append(_hashable(record[field]))
+            except KeyError:
+                values.append(None)
+        return tuple(values)
+
+    def _index(self, fields):
+        """ Returns the index for the given field names, building it if needed """
+        if fields not in self.byFields:
+            index = {}
+            for record in self.pypwsafe.getEntries():
+                index.setdefault(self._key(record, fields), []).append(record)
+            log.debug("Built record index on %r with %d keys", fields, len(index))
+            self.byFields[fields] = index
+        return self.byFields[fields]
+
+    def _sorted(self, field):
+        """ Returns the sorted index for the field, building it if needed """
+        if field not in self.sortedByField:
+            pairs = []
+            for record in self.pypwsafe.getEntries():
+                try:
+                    pairs.append((_text(record[field]), record))
+                except KeyError:
+                    continue
+            pairs.sort(key=lambda pair: pair[0])
+            self.sortedByField[field] = ([pair[0] for pair in pairs], [pair[1] for pair in pairs])
+            log.debug("Built sorted record index on %r with %d values", field, len(pairs))
+        return self.sortedByField[field]
+
+    def findPrefix(self, field, prefix):
+        """ Returns a list of the records whose field starts with prefix """
+        values, records = self._sorted(field)
+        start = bisect_left(values, prefix)
+        end = start
+        while end < len(values) and values[end].startswith(prefix):
+            end += 1
+        return records[start:end]
+
+    def find(self, vfilters):
+        """ Returns a list of the records matching all vfilters """
+        if not vfilters:
+            return list(self.pypwsafe.getEntries())
+        fields = tuple(sorted(vfilters.keys()))
+        key = tuple([_hashable(vfilters[field]) for field in fields])
+        return list(self._index(fields).get(key, []))
+
+    def add(self, record):
+        """ Add a new or updated record to all built indexes """
+        for fields, index in self.byFields.items():
+            index.setdefault(self._key(record, fields), []).insert(0, record)
+        for field, (values, records) in self.sortedByField.items():
+            try:
+                value = _text(record[field])
+            except KeyError:
+                continue
+            i = bisect_right(values, value)
+            values.insert(i, value)
+            records.insert(i, record)
+        self.changed[id(record)] = record
+
+    def delete(self, record):
+        """ Remove a deleted record from all built indexes """
+        self.remove(record)
+        self.changed.pop(id(record), None)
+        self.deleted.append(record)
+
+    def remove(self, record):
+        """ Remove a record from all built indexes. Call before changing a record's fields. """
+        for fields, index in self.byFields.items():
+            key = self._key(record, fields)
+            if key in index:
+                index[key] = [i for i in index[key] if i is not record]
+                if not index[key]:
+                    del index[key]
+        for field, (values, records) in self.sortedByField.items():
+            try:
+                value = _text(record[field])
+            except KeyError:
+                continue
+            i = bisect_left(values, value)
+            while i < len(values) and values[i] == value:
+                if records[i] is record:
+                    del values[i]
+                    del records[i]
+                    break
+                i += 1
+
+
+class _UndoLog(object):
+    """ What one batch did to a safe's records, so a failed batch can be rolled
+    back without copying every record. Holds a copy of each record from before
+    the batch first changed it and the records it added and deleted, in order. 
+    """
+
+    def __init__(self):
+        # Records as they were before the batch updated them. id(record) => copy
+        self.originals = {}
+        # Tuples of ('add', None, record) or ('delete', position, record) in the order they were done
+        self.steps = []
+
+    def updating(self, record):
+        """ Call before changing a record's fields """
+        if id(record) not in self.originals:
+            self.originals[id(record)] = deepcopy(record)
+
+    def added(self, record):
+        """ Call after adding a record """
+        self.steps.append(('add', None, record))
+
+    def deleting(self, records, record):
+        """ Call before removing the record from records """
+        for position, i in enumerate(records):
+            if i is record:
+                self.steps.append(('delete', position, record))
+                return
+
+    def rollback(self, records):
+        """ Undo the batch's changes to the given list of records """
+        for step, position, record in reversed(self.steps):
+            if step == 'add':
+                for i, other in enumerate(records):
+                    if other is record:
+                        del records[i]
+                        break
+            else:
+                records.insert(position, record)
+        records[:] = [self.originals.get(id(record), record) for record in records]
+
+
+def _hashable(value):
+    """ Returns the value in a form that can be used in an index key """
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def _text(value):
+    """ Returns the value as regex filters see it. Groups are dot separated. """
+    if isinstance(value, (list, tuple)):
+        return '.'.join(value)
+    return value
+
+
+def _findRecords(psafe, pypwsafe, refilters, vfilters, maxMatches=None, index=None, onMaxMatches='stop'):
+    """ Yields all records matching the given query. 
+    @param maxMatches: Stop after this many matches. None for no limit. 
+    @param index: If given, the value filters are resolved using this _RecordIndex instead of a scan. 
+    @param onMaxMatches: 'stop' to stop at maxMatches. 'fail' to keep looking and raise
+    TooManyMatchesError if there are more than maxMatches matches. 
+    @raise TooManyMatchesError: onMaxMatches is 'fail' and more than maxMatches records matched
+    """
+    if onMaxMatches not in ('stop', 'fail'):
+        raise ValueError("onMaxMatches must be 'stop' or 'fail', not %r" % onMaxMatches)
+    # For errors. vfilters is emptied if the index is used. Values are left out as they may be passwords. 
+    query = sorted(refilters.keys() + vfilters.keys())
     refiltersCmp = {}
     for name, raw in refilters.items():
-        log.debug("Compiling %r for %r", raw, name)
-        refiltersCmp[name] = re.compile(refilters)
+        refiltersCmp[name] = compilePattern(raw)
+
+    # Narrow things down with the cheapest lookup available. Exact values
+    # first, then a regex's literal prefix. Regexes run on what's left. 
+    candidates = None
+    if index is not None:
+        if vfilters:
+            candidates = index.find(vfilters)
+            log.debug("Index returned %d candidates for %r", len(candidates), vfilters.keys())
+            vfilters = {}
+        else:
+            prefixes = [(literalPrefix(raw), name) for name, raw in refilters.items() if name in PREFIX_FIELDS]
+            prefixes = [i for i in prefixes if i[0]]
+            if prefixes:
+                prefix, name = max(prefixes, key=lambda i: len(i[0]))
+                candidates = index.findPrefix(name, prefix)
+                log.debug("Prefix index returned %d candidates for %r", len(candidates), name)
+    if candidates is None:
+        candidates = pypwsafe.getEntries()
 
+    # Per-record logging is expensive with large safes so only do it if it will be seen
+    trace = log.isEnabledFor(5)
     matchCount = 0
-    for record in pypwsafe.getEntries():
-        log.log(5, "Checking %r", record)
+    for record in candidates:
+        if trace:
+            log.log(5, "Checking %r", record)
         matched = True
         for field, mvalue in vfilters.items():
             if not _matchVale(record=record, fieldName=field, fieldValue=mvalue):
-                log.log(5, "Value match for %r failed", field)
                 matched = False
                 break
         # Skip slow stuff, if possible
@@ -125,51 +334,68 @@ def _findRecords(psafe, pypwsafe, refilters, vfilters, maxMatches=None):
                 break
         # Found one
         if matched:
+            if maxMatches is not None and matchCount >= maxMatches:
+                if onMaxMatches == 'fail':
+                    raise TooManyMatchesError("More than %r records matched %r" % (maxMatches, query))
+                break
             matchCount += 1
-            if maxMatches is None or matchCount < maxMatches:
-                log.debug("Match %r: %r", matchCount, record)
-                yield record
-            else:
-                log.debug("%r matched but over maxMatches", record)
+            if trace:
+                log.log(5, "Match %r: %r", matchCount, record)
+            yield record
+            if maxMatches is not None and matchCount >= maxMatches and onMaxMatches == 'stop':
+                log.debug("Hit maxMatches of %r. Stopping. ", maxMatches)
                 break
     log.debug("Done finding records. Found %r", matchCount)
 
 
-def _update(psafe, pypwsafe, action, refilters, vfilters, changes, maxMatches=None):
+def _update(psafe, pypwsafe, action, refilters, vfilters, changes, maxMatches=None, index=None, onMaxMatches='stop', undo=None):
     """ Update the matching records 
     @return: The number of records that were updated. 
     """
     assert action == "update"
-    toUpdate = list(_findRecords(psafe=psafe, pypwsafe=pypwsafe, refilters=refilters, vfilters=vfilters, maxMatches=None))
+    toUpdate = list(_findRecords(psafe=psafe, pypwsafe=pypwsafe, refilters=refilters, vfilters=vfilters, maxMatches=maxMatches, index=index, onMaxMatches=onMaxMatches))
     for record in toUpdate:
-        for fieldName, newValue in changes.items():
-            if fieldName == "Password":
-                record.setPassword(newValue)
-            else:
-                try:
-                    record[fieldName] = newValue
-                except KeyError, e:
-                    log.info("Couldn't set field %r on %r to %r", fieldName, record, newValue)
+        if undo is not None:
+            undo.updating(record)
+        if index is not None:
+            index.remove(record)
+        try:
+            for fieldName, newValue in changes.items():
+                if fieldName == "Password":
+                    record.setPassword(newValue)
+                else:
+                    try:
+                        record[fieldName] = newValue
+                    except KeyError, e:
+                        log.info("Couldn't set field %r on %r to %r", fieldName, record, newValue)
+        finally:
+            if index is not None:
+                index.add(record)
     return len(toUpdate)
 
 
-def _delete(psafe, pypwsafe, action, refilters, vfilters, maxMatches=None):
+def _delete(psafe, pypwsafe, action, refilters, vfilters, maxMatches=None, index=None, onMaxMatches='stop', undo=None):
     """ Delete the matching records 
     @return: The number of records that were deleted. 
     """
     assert action == "delete"
-    toUpdate = _findRecords(psafe=psafe, pypwsafe=pypwsafe, refilters=refilters, vfilters=vfilters, maxMatches=None)
+    # Find them all first. Don't remove records while iterating over them. 
+    toUpdate = list(_findRecords(psafe=psafe, pypwsafe=pypwsafe, refilters=refilters, vfilters=vfilters, maxMatches=maxMatches, index=index, onMaxMatches=onMaxMatches))
     deleteCount = 0
     for record in toUpdate:
+        if undo is not None:
+            undo.deleting(pypwsafe.records, record)
         try:
             pypwsafe.records.remove(record)
             deleteCount += 1
         except ValueError, e:
             log.warn("Failed to find and delete record %r in %r", record, pypwsafe)
+        if index is not None:
+            index.delete(record)
     return deleteCount
 
 
-def _add(psafe, pypwsafe, action, changes):
+def _add(psafe, pypwsafe, action, changes, index=None, undo=None):
     """ Add the given record
     @return: The newly created Record 
     """
@@ -184,10 +410,14 @@ def _add(psafe, pypwsafe, action, changes):
             except KeyError, e:
                 log.warn("Failed to update %r with %r=%r", record, fieldName, fieldValue)
     pypwsafe.records.insert(0, record)
+    if undo is not None:
+        undo.added(record)
+    if index is not None:
+        index.add(record)
     return record
 
 
-def _addUpdate(psafe, pypwsafe, action, refilters, vfilters, changes, maxMatches=None):
+def _addUpdate(psafe, pypwsafe, action, refilters, vfilters, changes, maxMatches=None, index=None, onMaxMatches='stop', undo=None):
     """ Update the matching records 
     @return: dict(
             updated = The number of records updated. Includes the one added if no updates are made. 
@@ -196,28 +426,28 @@ def _addUpdate(psafe, pypwsafe, action, refilters, vfilters, changes, maxMatches
     """
     assert action == "add-update"
     log.debug("Going to add-update %r", pypwsafe)
-    updatedCount = _update(psafe=psafe, pypwsafe=pypwsafe, action="update", refilters=refilters, vfilters=vfilters, changes=changes, maxMatches=maxMatches)
+    updatedCount = _update(psafe=psafe, pypwsafe=pypwsafe, action="update", refilters=refilters, vfilters=vfilters, changes=changes, maxMatches=maxMatches, index=index, onMaxMatches=onMaxMatches, undo=undo)
     if updatedCount == 0:
         log.debug("Didn't update any records. Creating a new one")
-        record = _add(psafe=psafe, pypwsafe=pypwsafe, action="add", changes=changes)
+        record = _add(psafe=psafe, pypwsafe=pypwsafe, action="add", changes=changes, index=index, undo=undo)
         return dict(updated=1, newRecord=record)
     return dict(updated=updatedCount, newRecord=None)
 
 
-def _action(psafe, pypwsafe, **kw):
+def _action(psafe, pypwsafe, index=None, undo=None, **kw):
     """ Run the requested action. Returns the number of changes made. """
     if not 'action' in kw:
         raise KeyError, "The 'action' isn't specified"
     if kw['action'] == 'add':
-        r = _add(psafe=psafe, pypwsafe=pypwsafe, **kw)
+        r = _add(psafe=psafe, pypwsafe=pypwsafe, index=index, undo=undo, **kw)
         return 1
     if kw['action'] == 'add-update':
-        r = _addUpdate(psafe=psafe, pypwsafe=pypwsafe, **kw)
+        r = _addUpdate(psafe=psafe, pypwsafe=pypwsafe, index=index, undo=undo, **kw)
         return r['updated']
     if kw['action'] == 'delete':
-        return _delete(psafe=psafe, pypwsafe=pypwsafe, **kw)
+        return _delete(psafe=psafe, pypwsafe=pypwsafe, index=index, undo=undo, **kw)
     if kw['action'] == 'update':
-        return _update(psafe=psafe, pypwsafe=pypwsafe, **kw)
+        return _update(psafe=psafe, pypwsafe=pypwsafe, index=index, undo=undo, **kw)
     raise ValueError("%r isn't a valid action" % kw['action'])
 
 
@@ -237,6 +467,9 @@ def modifyEntries(
                   updateCache=True,
                   ):
     """ Add/update/delete/etc multiple password safe entries.
+    @note: If settings.PSAFE_WRITE_COALESCE_WINDOW is set, calls for the same safe and safe password that 
+    arrive within that many seconds of each other are applied in one write of the safe. Each call still gets its own result. If a 
+    batch with an onError of 'fail' raises, only that batch's changes are dropped. 
     @note: If no actions are given, then the safe will be opened and then saved. Post-save may be slightly different than pre-save in such cases, if the pypwsafe api "corrects" anything or does anything differently. 
 
     Valid actions: 
@@ -248,9 +481,12 @@ def modifyEntries(
     The <Options> are <field name>:<new field value> pairs as used in MemPsafeEntry's todict method. 
     The <Regex Filters> are <Field Name>:<Uncompiled Regex> pairs. 
     The <Value Filters> are <Field Name>:<Field Value> pairs. The field value must be EXACTLY the same. 
+        A value of None matches entries that don't have the field. 
     All regex and value filters must match for the entry to be updated. 
     The 'maxMatches' field indicates the maximum number of entries to change/delete/etc. Defaults to None, 
-        which means no limit.
+        which means no limit. Matching stops as soon as the limit is reached. 
+    The 'onMaxMatches' field is 'stop' (the default) to change the first maxMatches entries or 'fail' to 
+        raise TooManyMatchesError, without changing anything, if more entries match. 
 
     Example actions: 
     actions=[
@@ -266,6 +502,7 @@ def modifyEntries(
                 'refilters':{ <Regex Filters>, },
                 'vfilters':{ <Value Filters>, },
                 'maxMatches': 5, 
+                'onMaxMatches': 'fail', 
                 },
                 
                 # Update matching entries.
@@ -288,42 +525,292 @@ def modifyEntries(
             ]
     """
     psafe = PasswordSafe.objects.get(pk=psafePK)
+    window = getattr(settings, 'PSAFE_WRITE_COALESCE_WINDOW', 0)
+    if not window:
+        return _applyBatches(psafe, psafePassword, [(actions, onError)], updateCache=updateCache)[0]
+
+    # Queue the batch then, after a short wait for others to arrive, either
+    # apply every queued batch for the safe or wait for whoever did. 
+    digest = passwordDigest(psafePassword)
+    pending = PendingWrite(
+                           safe=psafe,
+                           passwordDigest=digest,
+                           actions=seal(actions),
+                           onError=onError,
+                           )
+    pending.save()
+    try:
+        time.sleep(window)
+        leader = uuid4().hex
+        PendingWrite.objects.filter(
+                                    safe=psafe,
+                                    passwordDigest=digest,
+                                    status=PendingWrite.STATUS_PENDING,
+                                    ).update(status=PendingWrite.STATUS_CLAIMED, leader=leader)
+        claimed = list(PendingWrite.objects.filter(leader=leader).order_by('created', 'pk'))
+        if pending.pk in [i.pk for i in claimed]:
+            log.debug("Applying %d merged batches to %r", len(claimed), psafe)
+            try:
+                results = _applyBatches(
+                                        psafe,
+                                        psafePassword,
+                                        [(unseal(i.actions), i.onError) for i in claimed],
+                                        updateCache=updateCache,
+                                        )
+            except Exception, e:
+                # Nothing was saved
+                for i in claimed:
+                    if i.pk != pending.pk:
+                        PendingWrite.objects.filter(pk=i.pk).update(status=PendingWrite.STATUS_FAILED, result=seal(repr(e)))
+                raise
+            ret = None
+            for i, result in zip(claimed, results):
+                if i.pk == pending.pk:
+                    ret = result
+                elif isinstance(result, Exception):
+                    PendingWrite.objects.filter(pk=i.pk).update(status=PendingWrite.STATUS_FAILED, result=seal(repr(result)))
+                else:
+                    PendingWrite.objects.filter(pk=i.pk).update(status=PendingWrite.STATUS_DONE, result=seal(result))
+            if isinstance(ret, Exception):
+                raise ret
+            return ret
+        return _waitForBatch(pending)
+    finally:
+        PendingWrite.objects.filter(pk=pending.pk).delete()
+
+
+def _waitForBatch(pending):
+    """ Wait for another task to apply the given PendingWrite. Returns its result. 
+    @raise BatchedWriteError: The batch failed
+    """
+    timeout = getattr(settings, 'PSAFE_WRITE_COALESCE_TIMEOUT', 5 * 60)
+    started = time.time()
+    while time.time() - started < timeout:
+        # End the last poll's transaction. Otherwise, under REPEATABLE READ, 
+        # the leader's update would never be seen. 
+        transaction.commit_unless_managed()
+        try:
+            pending = PendingWrite.objects.get(pk=pending.pk)
+        except PendingWrite.DoesNotExist:
+            raise BatchedWriteError("The write batch for %r was lost" % pending.safe_id)
+        if pending.status == PendingWrite.STATUS_DONE:
+            return unseal(pending.result)
+        if pending.status == PendingWrite.STATUS_FAILED:
+            raise BatchedWriteError(unseal(pending.result))
+        time.sleep(0.05)
+    raise BatchedWriteError("Timed out waiting for the write batch for %r to be applied" % pending.safe_id)
+
+
+def _applyBatches(psafe, psafePassword, batches, updateCache=True):
+    """ Apply one or more action lists to a safe in a single decrypt-save pass. 
+    If a batch with an onError of 'fail' raises, its changes are rolled back
+    and the other batches are still saved. 
+    @param batches: A list of tuples of (actions, onError)
+    @return: A list with the result dict or the exception for each batch. Result dicts have the
+    total 'changes', the 'actionChanges' made by each action, in order, and the 'errors' of skipped actions. 
+    Each error has the 'action', its 'index' in the batch and the 'error'. 
+    """
     log.debug("Going to change entries from %r", psafe)
     pypwsafe = PWSafe3(
                      filename=psafe.psafePath(),
                      password=psafePassword,
                      mode="RW",
                      )
-    ret = dict(errors=[], changes=0)
+    results = []
     log.debug("Going to lock safe")
     pypwsafe.lock()
     try:
         log.debug("Lock acquired")
-        for action in actions:
-            log.debug("Going to %r", action['action'])
-            if onError == "fail":
-                ret['changes'] += _action(psafe=psafe, pypwsafe=pypwsafe, **action)
-            elif onError == "skip":
-                try:
-                    ret['changes'] += _action(psafe=psafe, pypwsafe=pypwsafe, **action)
-                except Exception, e:
-                    log.warn("There was an error while updating %r per %r", pypwsafe, action)
-                    ret['errors'].append(
-                                         dict(
-                                              action=action,
-                                              error=repr(e),
-                                              traceback=None,  # TODO: Add traceback
-                                              )
-                                         )
-        pypwsafe.save()
+        # Built once and shared by all of the actions
+        index = _RecordIndex(pypwsafe)
+        # Set if a batch was rolled back. The changed records are no longer known. 
+        syncAll = False
+        for actions, onError in batches:
+            ret = dict(errors=[], changes=0, actionChanges=[])
+            # Only needed to roll back a failed batch without failing the others
+            undo = None
+            if onError == "fail" and len(batches) > 1:
+                undo = _UndoLog()
+            try:
+                for actionIndex, action in enumerate(actions):
+                    log.debug("Going to %r", action['action'])
+                    changes = 0
+                    if onError == "fail":
+                        changes = _action(psafe=psafe, pypwsafe=pypwsafe, index=index, undo=undo, **action)
+                    elif onError == "skip":
+                        try:
+                            changes = _action(psafe=psafe, pypwsafe=pypwsafe, index=index, **action)
+                        except Exception, e:
+                            log.warn("There was an error while updating %r per %r", pypwsafe, action)
+                            ret['errors'].append(
+                                                 dict(
+                                                      action=action,
+                                                      index=actionIndex,
+                                                      error=repr(e),
+                                                      traceback=None,  # TODO: Add traceback
+                                                      )
+                                                 )
+                    ret['changes'] += changes
+                    ret['actionChanges'].append(changes)
+            except Exception, e:
+                if len(batches) == 1:
+                    raise
+                log.warn("Batch failed. Rolling back its changes to %r. Error: %r", pypwsafe, e)
+                undo.rollback(pypwsafe.records)
+                index = _RecordIndex(pypwsafe)
+                syncAll = True
+                results.append(e)
+                continue
+            results.append(ret)
+        fileBefore = fileFingerprint(psafe.psafePath())
+        atomicSave(pypwsafe)
+        if updateCache:
+            # Patch in what was changed while the file still matches what we wrote
+            log.debug("Going to update the ram cache for %r", pypwsafe)
+            if syncAll:
+                patchCache(psafe, pypwsafe, psafePassword)
+            else:
+                patchCache(
+                           psafe,
+                           pypwsafe,
+                           psafePassword,
+                           records=index.changed.values(),
+                           deletedUUIDs=[record.getUUID() for record in index.deleted],
+                           fileBefore=fileBefore,
+                           )
     finally:
         log.debug("Going to unlock safe")
         pypwsafe.unlock()
 
-    if updateCache:
-        log.debug("Going to update the ram cache for %r", pypwsafe)
-        assert loadSafe(psafe_pk=psafePK, password=psafePassword, force=True)
+    return results
+
 
-    return ret
+@task(ignore_result=True, expires=60 * 60)
+def applyWriteJournal(psafePK):
+    """ Apply a safe's queued WriteJournal batches in the order they were 
+    journaled. Batches are claimed in the DB, so only one applier per safe
+    works at a time, even across hosts. 
+    @return: int, the number of batches applied or failed
+    """
+    done = 0
+    while True:
+        applied = _applyQueuedJournal(psafePK)
+        done += applied
+        # Batches journaled while we were applying
+        if not applied or not WriteJournal.objects.filter(safe__pk=psafePK, status=WriteJournal.STATUS_QUEUED).exists():
+            return done
 
 
+def _applyQueuedJournal(psafePK):
+    """ Claim and apply all queued batches for the safe. Consecutive batches
+    with the same safe password are applied in one pass. If another applier
+    still holds earlier batches, ours are queued again for it to pick up. 
+    @return: int, the number of batches applied or failed
+    """
+    token = uuid4().hex
+    WriteJournal.objects.filter(
+                                safe__pk=psafePK,
+                                status=WriteJournal.STATUS_QUEUED,
+                                ).update(
+                                         status=WriteJournal.STATUS_APPLYING,
+                                         claimToken=token,
+                                         claimed=datetime.datetime.now(),
+                                         )
+    queued = list(WriteJournal.objects.filter(claimToken=token, status=WriteJournal.STATUS_APPLYING).order_by('pk'))
+    if not queued:
+        return 0
+    if WriteJournal.objects.filter(
+                                   safe__pk=psafePK,
+                                   status=WriteJournal.STATUS_APPLYING,
+                                   pk__lt=queued[0].pk,
+                                   ).exclude(claimToken=token).exists():
+        log.debug("Another task is applying earlier journaled batches for %r", psafePK)
+        WriteJournal.objects.filter(
+                                    claimToken=token,
+                                    status=WriteJournal.STATUS_APPLYING,
+                                    ).update(
+                                             status=WriteJournal.STATUS_QUEUED,
+                                             claimToken=None,
+                                             claimed=None,
+                                             )
+        return 0
+    psafe = PasswordSafe.objects.get(pk=psafePK)
+
+    groups = []
+    for entry in queued:
+        try:
+            batch = unseal(entry.sealed)
+        except Exception, e:
+            log.warn("Couldn't read journaled batch %r: %r", entry.ticket, e)
+            groups.append((None, [(entry, e)]))
+            continue
+        if groups and groups[-1][0] == batch['password']:
+            groups[-1][1].append((entry, batch))
+        else:
+            groups.append((batch['password'], [(entry, batch)]))
+
+    done = 0
+    for psafePassword, members in groups:
+        # Skip any that were requeued because we took too long
+        mine = set(WriteJournal.objects.filter(
+                                               pk__in=[entry.pk for entry, batch in members],
+                                               claimToken=token,
+                                               status=WriteJournal.STATUS_APPLYING,
+                                               ).values_list('pk', flat=True))
+        if len(mine) != len(members):
+            log.warn("Lost the claim on %d journaled batches for %r", len(members) - len(mine), psafe)
+            members = [(entry, batch) for entry, batch in members if entry.pk in mine]
+            if not members:
+                continue
+        if psafePassword is None:
+            results = [batch for entry, batch in members]
+        else:
+            try:
+                results = _applyBatches(
+                                        psafe,
+                                        psafePassword,
+                                        [(batch['actions'], batch['onError']) for entry, batch in members],
+                                        )
+            except Exception, e:
+                log.warn("Failed to apply %d journaled batches to %r: %r", len(members), psafe, e)
+                results = [e] * len(members)
+        for (entry, batch), result in zip(members, results):
+            if isinstance(result, Exception):
+                status = WriteJournal.STATUS_FAILED
+                result = repr(result)
+            else:
+                status = WriteJournal.STATUS_APPLIED
+            done += WriteJournal.objects.filter(pk=entry.pk, claimToken=token).update(
+                                                                                      status=status,
+                                                                                      result=seal(result),
+                                                                                      finished=datetime.datetime.now(),
+                                                                                      )
+    return done
+
+
+@periodic_task(run_every=timedelta(minutes=1), ignore_result=True, expires=60)
+def applyAllWriteJournals():
+    """ Apply any queued journal batches, including ones from appliers that
+    died. Claims held longer than settings.PSAFE_JOURNAL_STALE_TIMEOUT are 
+    queued again. 
+    @note: A requeued batch may be applied twice if its applier was only slow. Journaled 'add' 
+    actions are stored as 'add-update' actions on a new UUID so repeating them is harmless. 
+    @return: int, the number of batches applied or failed
+    """
+    stale = datetime.datetime.now() - timedelta(seconds=getattr(settings, 'PSAFE_JOURNAL_STALE_TIMEOUT', 10 * 60))
+    requeued = 0
+    for token in set(WriteJournal.objects.filter(status=WriteJournal.STATUS_APPLYING, claimed__lt=stale).values_list('claimToken', flat=True)):
+        requeued += WriteJournal.objects.filter(
+                                                claimToken=token,
+                                                status=WriteJournal.STATUS_APPLYING,
+                                                ).update(
+                                                         status=WriteJournal.STATUS_QUEUED,
+                                                         claimToken=None,
+                                                         claimed=None,
+                                                         )
+    if requeued:
+        log.warn("Requeued %d stale journaled batches", requeued)
+    done = 0
+    for psafePK in set(WriteJournal.objects.filter(status=WriteJournal.STATUS_QUEUED).values_list('safe', flat=True)):
+        done += applyWriteJournal(psafePK)
+    return done
@@ -21,4 +21,12 @@
 # Need to import all other modules in tests dir
 import tasks
 import functions
+import cache
+import indexes
 
+import journal
+import importer
+import rotation
+import utils
+import report
+import usage
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Tests for the psafe cache backends
+'''
+from django.test import TestCase
+import datetime
+
+
+class FakeRecord(object):
+    """ Quacks like a pypwsafe Record """
+    def __init__(self, uuid, group, title, username, password, history=[]):
+        self.uuid = uuid
+        self.group = group
+        self.title = title
+        self.username = username
+        self.password = password
+        self.history = history
+
+    def getUUID(self):
+        return self.uuid
+
+    def getGroup(self):
+        return self.group
+
+    def getTitle(self):
+        return self.title
+
+    def getUsername(self):
+        return self.username
+
+    def getPassword(self):
+        return self.password
+
+    def getHistory(self):
+        return self.history
+
+    def getNote(self):
+        return None
+    getCreated = getPasswordModified = getLastAccess = getExpires = getEntryModified = getNote
+    getURL = getAutoType = getRunCommand = getEmail = getNote
+
+
+class FakePWSafe(object):
+    """ Quacks like a pypwsafe PWSafe3 """
+    def __init__(self, records):
+        self.records = records
+
+    def getEntries(self):
+        return self.records
+
+    def getUUID(self):
+        return '6a5b4e1c-8d0f-4b6e-9b4a-0d2f1e3c5a7b'
+
+    def getDbName(self):
+        return 'Test Safe'
+
+    def getTimeStampOfLastSave(self):
+        return datetime.datetime(2012, 10, 14)
+
+    def getDbDesc(self):
+        return None
+    getLastSaveApp = getLastSaveHost = getLastSaveUser = getDbDesc
+
+
+class CompactCacheTests(TestCase):
+    """ CompactSafe tests. Don't need any psafe files. """
+
+    def _makeSafe(self):
+        from psafefe.psafe.cache.compact import CompactSafe
+        saved = datetime.datetime(2012, 1, 1)
+        records = [
+                   FakeRecord(u'11111111-1111-1111-1111-111111111111', ['Datacenter', 'East'], 'Logins', 'root', 'pw1', [dict(password='old1', saved=saved), ]),
+                   FakeRecord(u'22222222-2222-2222-2222-222222222222', ['Datacenter', 'East'], 'Logins', u'sadm', 'pw2'),
+                   FakeRecord(u'33333333-3333-3333-3333-333333333333', ['Datacenter', 'West'], u'Logins', 'root', 'pw3'),
+                   ]
+        return CompactSafe(
+                           safePK=5,
+                           pypwsafe=FakePWSafe(records),
+                           password='bogus12345',
+                           fileLastModified=saved,
+                           fileLastSize=1024,
+                           )
+
+    def test_todict(self):
+        safe = self._makeSafe()
+        ret = safe.todict(getEntries=True, getEntryHistory=True)
+        self.assertEqual(ret['PK'], 5)
+        self.assertEqual(ret['Name'], 'Test Safe')
+        self.assertFalse('Description' in ret, "Null fields should be removed")
+        self.assertEqual(len(ret['Entries']), 3)
+        self.assertEqual(ret['Entries'][0]['Group'], 'Datacenter.East')
+        self.assertEqual(ret['Entries'][0]['History'][0]['Password'], 'old1')
+        self.assertFalse('Notes' in ret['Entries'][0], "Null fields should be removed")
+
+        ret = safe.todict(getEntries=False)
+        self.assertFalse('Entries' in ret)
+
+    def test_lookups(self):
+        safe = self._makeSafe()
+        found = safe.getEntriesByGroup('Datacenter.East', history=False)
+        self.assertEqual(sorted([i['Username'] for i in found]), ['root', 'sadm'])
+        self.assertEqual(safe.getEntriesByGroup('Datacenter'), [])
+        found = safe.getEntriesByUUID('33333333-3333-3333-3333-333333333333')
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0]['Password'], 'pw3')
+
+    def test_interning(self):
+        safe = self._makeSafe()
+        self.assertTrue(safe.entries[0].group is safe.entries[1].group)
+        self.assertTrue(safe.entries[0].title is safe.entries[2].title)
+        self.assertTrue(safe.entries[0].username is safe.entries[2].username)
+
+    def test_evict(self):
+        from django.test.utils import override_settings
+        from psafefe.psafe.cache.compact import CompactCacheBackend
+        backend = CompactCacheBackend()
+        for pk in range(4):
+            backend.safes[pk] = self._makeSafe()
+            backend.safes[pk].entryLastRefreshed -= datetime.timedelta(hours=1)
+        # Safe 2 is the only warm one
+        backend.safes[2].onUse()
+        with override_settings(PSAFE_CACHE_MAX_SAFES=2, PSAFE_CACHE_MAX_ROWS=None):
+            self.assertEqual(backend.evict(keepPKs=[0, ]), 2)
+        self.assertEqual(sorted(backend.safes.keys()), [0, 2])
+
+    def test_entryParity(self):
+        from psafefe.psafe.models import MemPsafeEntry
+        entry = self._makeSafe().entries[0]
+        memEntry = MemPsafeEntry(
+                                 uuid=entry.uuid,
+                                 group=entry.group,
+                                 title=entry.title,
+                                 username=entry.username,
+                                 password=entry.password,
+                                 )
+        self.assertEqual(entry.todict(history=False), memEntry.todict(history=False))
+        # The only key compact entries don't have is the row's PK
+        memEntry.pk = 7
+        self.assertEqual(set(memEntry.todict(history=False).keys()) - set(entry.todict(history=False).keys()), set(['PK', ]))
+
+    def test_isCurrent(self):
+        import os, tempfile
+        from psafefe.psafe.cache.compact import CompactCacheBackend
+
+        class FakePSafe(object):
+            def psafePath(self):
+                return path
+
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, 'x' * 1024)
+            os.close(fd)
+            os.utime(path, (0, 0))
+            safe = self._makeSafe()
+            safe.fileLastModified = datetime.datetime.fromtimestamp(0)
+            backend = CompactCacheBackend()
+            self.assertTrue(backend.isCurrent(FakePSafe(), safe))
+            # Written by something other than this process
+            with open(path, 'a') as f:
+                f.write('y')
+            self.assertFalse(backend.isCurrent(FakePSafe(), safe))
+            os.remove(path)
+            self.assertFalse(backend.isCurrent(FakePSafe(), safe))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class SerializedCacheTests(TestCase):
+    """ MemPSafe.todict output in the secret cache """
+
+    def setUp(self):
+        from psafefe.psafe.cache import getSecretCache
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, MemPSafe, MemPsafeEntry
+        getSecretCache().clear()
+        repo = PasswordSafeRepo(name='Serialized Tests', path='/tmp')
+        repo.save()
+        self.safe = PasswordSafe(filename='serialized.psafe3', repo=repo)
+        self.safe.save()
+        self.memSafe = MemPSafe(safe=self.safe, fileLastModified=datetime.datetime.now(), fileLastSize=0)
+        self.memSafe.save()
+        self.entry = MemPsafeEntry(safe=self.memSafe, title='web1', password='secret')
+        self.entry.save()
+
+    def _rename(self, title):
+        """ Change the entry without starting a new content version """
+        self.entry.title = title
+        self.entry.save()
+
+    def test_cacheHit(self):
+        from django.core.cache import cache
+        from psafefe.psafe.cache import getSecretCache
+        self.assertEqual([i['Title'] for i in self.memSafe.todict()['Entries']], ['web1'])
+        self._rename('web2')
+        self.assertEqual([i['Title'] for i in self.memSafe.todict()['Entries']], ['web1'])
+        # Not kept in the default cache
+        key = self.memSafe._serializedKey(True, True)
+        self.assertNotEqual(getSecretCache().get(key), None)
+        self.assertEqual(cache.get(key), None)
+        # Output without entries isn't cached
+        self.memSafe.dbName = 'Renamed'
+        self.assertEqual(self.memSafe.todict(getEntries=False)['Name'], 'Renamed')
+
+    def test_versionChange(self):
+        from psafefe.psafe.cache import getSecretCache
+        from psafefe.psafe.tasks.load import _finishRefresh
+        self.memSafe.todict()
+        self._rename('web2')
+        oldKey = self.memSafe._serializedKey(True, True)
+        _finishRefresh(self.memSafe)
+        self.assertEqual([i['Title'] for i in self.memSafe.todict()['Entries']], ['web2'])
+        self.assertEqual(getSecretCache().get(oldKey), None)
+
+    def test_invalidateSerialized(self):
+        self.memSafe.todict()
+        self._rename('web2')
+        self.memSafe.invalidateSerialized()
+        self.assertEqual([i['Title'] for i in self.memSafe.todict()['Entries']], ['web2'])
+
+    def test_evict(self):
+        from psafefe.psafe.cache import getSecretCache
+        from psafefe.psafe.tasks.load import evictColdSafes
+        self.memSafe.todict()
+        key = self.memSafe._serializedKey(True, True)
+        self.assertEqual(evictColdSafes(maxSafes=0), 1)
+        self.assertEqual(getSecretCache().get(key), None)
+
+    def test_noSecretCache(self):
+        from django.test.utils import override_settings
+        with override_settings(PSAFE_SECRET_CACHE='psafe-missing'):
+            self.memSafe.todict()
+            self._rename('web2')
+            self.assertEqual([i['Title'] for i in self.memSafe.todict()['Entries']], ['web2'])
+            self.memSafe.invalidateSerialized()
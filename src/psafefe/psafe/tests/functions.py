@@ -176,3 +176,210 @@ class FunctionsPsafeTests(LivePsafeTestCase):
         
     
     
+
+
+class LoadMemSafesTests(TestCase):
+    """ loadMemSafes with the personal safe lookups and loadSafe replaced. Doesn't need any psafe files. """
+
+    def setUp(self):
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, MemPSafe
+        from psafefe.psafe import functions
+        from psafefe.psafe.tasks import load
+        from psafefe.psafe.errors import NoPasswordForPasswordSafe
+        repo = PasswordSafeRepo(name = 'Load Tests', path = '/tmp')
+        repo.save()
+        self.safes = []
+        for i in range(5):
+            safe = PasswordSafe(filename = 'load%d.psafe3' % i, repo = repo)
+            safe.save()
+            self.safes.append(safe)
+        # Safe 0 is already cached
+        MemPSafe(safe = self.safes[0], fileLastModified = datetime.datetime.now(), fileLastSize = 0).save()
+        self.noPassword = set()
+        self.running = []
+        self.maxRunning = 0
+        test = self
+
+        def getDatabasePasswordByUser(user, userPassword, psafe, ppsafe = None, wait = True):
+            if psafe.pk in test.noPassword:
+                raise NoPasswordForPasswordSafe("No password for %r" % psafe)
+            return 'bogus12345'
+
+        class FakeResult(object):
+            """ Finishes after being polled a few times """
+            def __init__(self, safe, polls):
+                self.safe = safe
+                self.polls = polls
+
+            def ready(self):
+                self.polls -= 1
+                if self.polls <= 0 and self in test.running:
+                    test.running.remove(self)
+                    MemPSafe(safe = self.safe, fileLastModified = datetime.datetime.now(), fileLastSize = 0).save()
+                return self.polls <= 0
+
+            def get(self):
+                return True
+
+        class FakeLoadSafe(object):
+            def delay(self, psafe_pk, password, force = False, evict = True):
+                assert not evict
+                result = FakeResult(PasswordSafe.objects.get(pk = psafe_pk), polls = psafe_pk % 3 + 1)
+                test.running.append(result)
+                test.maxRunning = max(test.maxRunning, len(test.running))
+                return result
+
+        self.saved = (functions.getUsersPersonalSafe, functions.getDatabasePasswordByUser, load.loadSafe)
+        functions.getUsersPersonalSafe = lambda user, userPassword, wait = True: None
+        functions.getDatabasePasswordByUser = getDatabasePasswordByUser
+        load.loadSafe = FakeLoadSafe()
+
+    def tearDown(self):
+        from psafefe.psafe import functions
+        from psafefe.psafe.tasks import load
+        functions.getUsersPersonalSafe, functions.getDatabasePasswordByUser, load.loadSafe = self.saved
+
+    def test_cachedNeedsPassword(self):
+        from psafefe.psafe.functions import loadMemSafes
+        from psafefe.psafe.errors import NoPasswordForPasswordSafe
+        self.noPassword.add(self.safes[0].pk)
+        self.assertRaises(NoPasswordForPasswordSafe, loadMemSafes, None, 'bogus', self.safes[:1])
+
+    def test_parallelLoads(self):
+        from psafefe.psafe.functions import loadMemSafes
+        with override_settings(PSAFE_SEARCH_MAX_PARALLEL_LOADS = 2):
+            memSafes, loading = loadMemSafes(None, 'bogus', self.safes)
+        self.assertEqual(sorted(memSafes.keys()), sorted([safe.pk for safe in self.safes]))
+        self.assertEqual(loading, [])
+        self.assertEqual(self.maxRunning, 2)
+
+    def test_readableNeedsPassword(self):
+        from django.contrib.auth.models import User
+        from psafefe.psafe import functions
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, MemPSafe, MemPsafeEntry
+        user = User.objects.create_superuser('loadadmin', 'loadadmin@localhost', 'bogus12345')
+        personalRepo = PasswordSafeRepo(name = 'Load Tests Personal', path = '/tmp')
+        personalRepo.save()
+        ppsafe = PasswordSafe(filename = 'personal.psafe3', repo = personalRepo, owner = user)
+        ppsafe.save()
+        personal = MemPSafe(safe = ppsafe, fileLastModified = datetime.datetime.now(), fileLastSize = 0)
+        personal.save()
+        safe = self.safes[1]
+        MemPsafeEntry(
+                      safe = personal,
+                      group = "Password Safe Passwords.%d" % safe.repo_id,
+                      title = "PSafe id %d" % safe.pk,
+                      username = safe.filename,
+                      password = 'bogus12345',
+                      ).save()
+        MemPSafe(safe = safe, fileLastModified = datetime.datetime.now(), fileLastSize = 0).save()
+        functions.getUsersPersonalSafe = lambda user, userPassword, wait = True: ppsafe
+
+        self.assertEqual(functions.getSafesWithPasswordsByUser(user, 'bogus12345', self.safes), [safe, ])
+        # Safe 0 is cached and readable but the user doesn't have its password
+        self.assertEqual([memSafe.safe_id for memSafe in functions.getReadableMemSafes(user, 'bogus12345')], [safe.pk, ])
+
+    def test_searchCacheNeedsPassword(self):
+        from django.contrib.auth.models import User
+        from psafefe.psafe.rpc.search import _filterComplex
+        from psafefe.psafe.errors import NoPasswordForPasswordSafe
+        user = User.objects.create_superuser('searchadmin', 'searchadmin@localhost', 'bogus12345')
+        safeIDs = [self.safes[0].pk, ]
+        self.assertEqual(_filterComplex('searchadmin', 'bogus12345', safeIDs, {}, {}, user = user), ([], []))
+        # The result is cached now but the user no longer has the safe's password
+        self.noPassword.add(self.safes[0].pk)
+        self.assertRaises(NoPasswordForPasswordSafe, _filterComplex, 'searchadmin', 'bogus12345', safeIDs, {}, {}, user = user)
+
+    def test_searchCache(self):
+        from uuid import uuid4
+        from django.contrib.auth.models import User
+        from psafefe.psafe.cache import getSecretCache
+        from psafefe.psafe.models import MemPSafe, MemPsafeEntry
+        from psafefe.psafe.rpc.search import _filterComplex
+        getSecretCache().clear()
+        user = User.objects.create_superuser('searchadmin', 'searchadmin@localhost', 'bogus12345')
+        memSafe = MemPSafe.objects.get(safe = self.safes[0])
+        web1 = MemPsafeEntry(safe = memSafe, title = 'web1')
+        web1.save()
+        MemPsafeEntry(safe = memSafe, title = 'web2').save()
+        safeIDs = [self.safes[0].pk, ]
+
+        def titles(include):
+            found, loading = _filterComplex('searchadmin', 'bogus12345', safeIDs, include, {}, user = user)
+            return [i['Title'] for i in found]
+        self.assertEqual(titles({'Title':['web1']}), ['web1'])
+        # Different filters don't share results
+        self.assertEqual(titles({'Title':['web2']}), ['web2'])
+        # Served from the cache until the content version changes
+        web1.title = 'web3'
+        web1.save()
+        self.assertEqual(titles({'Title':['web1']}), ['web1'])
+        memSafe.version = uuid4().hex
+        memSafe.save()
+        self.assertEqual(titles({'Title':['web1']}), [])
+        self.assertEqual(titles({'Title':['web3']}), ['web3'])
+        # Nothing is cached without the secret cache
+        with override_settings(PSAFE_SECRET_CACHE = 'psafe-missing'):
+            web1.title = 'web4'
+            web1.save()
+            self.assertEqual(titles({'Title':['web3']}), [])
+
+    def test_oldPasswordFilters(self):
+        from django.contrib.auth.models import User
+        from psafefe.psafe.cache import getSecretCache
+        from psafefe.psafe.indexes import indexEntryPasswords
+        from psafefe.psafe.models import MemPSafe, MemPsafeEntry
+        from psafefe.psafe.rpc.search import _filterComplex
+        getSecretCache().clear()
+        user = User.objects.create_superuser('searchadmin', 'searchadmin@localhost', 'bogus12345')
+        memSafe = MemPSafe.objects.get(safe = self.safes[0])
+        for title, old in (('web1', ['pw1', ]), ('web2', ['pw2', 'pw4']), ('web3', ['pw3', ])):
+            entry = MemPsafeEntry(safe = memSafe, title = title, password = 'current')
+            entry.save()
+            indexEntryPasswords(entry, old, new = True)
+        safeIDs = [self.safes[0].pk, ]
+
+        def titles(include, exclude = {}):
+            found, loading = _filterComplex('searchadmin', 'bogus12345', safeIDs, include, exclude, user = user)
+            return sorted([i['Title'] for i in found])
+        # Any of the values matches
+        self.assertEqual(titles({'Old Passwords':['pw1', 'pw2']}), ['web1', 'web2'])
+        self.assertEqual(titles({'Old Passwords':['pw4']}), ['web2', ])
+        # Current passwords aren't old passwords
+        self.assertEqual(titles({'Old Passwords':['current']}), [])
+        self.assertEqual(titles({}, {'Old Passwords':['pw1', 'pw3']}), ['web2', ])
+
+    def test_passwordReuseNeedsPassword(self):
+        from django.contrib.auth.models import User
+        from psafefe.psafe import functions
+        from psafefe.psafe.indexes import indexEntryPasswords
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, MemPSafe, MemPsafeEntry
+        from psafefe.psafe.rpc.search import passwordReuse
+        user = User.objects.create_superuser('reuseadmin', 'reuseadmin@localhost', 'bogus12345')
+        personalRepo = PasswordSafeRepo(name = 'Reuse Tests Personal', path = '/tmp')
+        personalRepo.save()
+        ppsafe = PasswordSafe(filename = 'personal.psafe3', repo = personalRepo, owner = user)
+        ppsafe.save()
+        personal = MemPSafe(safe = ppsafe, fileLastModified = datetime.datetime.now(), fileLastSize = 0)
+        personal.save()
+        functions.getUsersPersonalSafe = lambda user, userPassword, wait = True: ppsafe
+        # The user only has the password for safe 1
+        safe = self.safes[1]
+        MemPsafeEntry(
+                      safe = personal,
+                      group = "Password Safe Passwords.%d" % safe.repo_id,
+                      title = "PSafe id %d" % safe.pk,
+                      username = safe.filename,
+                      password = 'bogus12345',
+                      ).save()
+        memSafe = MemPSafe(safe = safe, fileLastModified = datetime.datetime.now(), fileLastSize = 0)
+        memSafe.save()
+        for owner, title in ((memSafe, 'web1'), (memSafe, 'web2'), (MemPSafe.objects.get(safe = self.safes[0]), 'web3')):
+            entry = MemPsafeEntry(safe = owner, title = title, password = 'shared')
+            entry.save()
+            indexEntryPasswords(entry, [], new = True)
+
+        report = passwordReuse('reuseadmin', 'bogus12345', safe.repo_id, 2, user = user)
+        self.assertEqual([i['Count'] for i in report], [2, ])
+        self.assertEqual(sorted([i['Title'] for i in report[0]['Entries']]), ['web1', 'web2'])
+        self.assertEqual(passwordReuse('reuseadmin', 'bogus12345', safe.repo_id, 3, user = user), [])
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Tests for bulk entry imports
+'''
+from django.test import TestCase
+
+
+class ImporterTests(TestCase):
+    """ Import parsing and validation. Doesn't need the DB. """
+
+    def test_parse(self):
+        from psafefe.psafe.importer import parseRows
+        from psafefe.psafe.errors import InvalidImportError
+        rows = parseRows("Group,Title,Username,Password\nServers.Web,Logins,root,bogus12345\n,Logins,,bogus\n")
+        self.assertEqual(rows, [
+                                {'Group':'Servers.Web', 'Title':'Logins', 'Username':'root', 'Password':'bogus12345'},
+                                {'Title':'Logins', 'Password':'bogus'},
+                                ])
+        self.assertEqual(parseRows('[{"Title":"a"}]', format='json'), [{'Title':'a'}])
+        self.assertEqual(parseRows('{"Title":"a"}\n{"Title":"b"}\n', format='json'), [{'Title':'a'}, {'Title':'b'}])
+        self.assertRaises(InvalidImportError, parseRows, '[1]', format='json')
+        self.assertRaises(InvalidImportError, parseRows, '', format='xml')
+
+    def test_validate(self):
+        from psafefe.psafe.importer import validateRows, importActions
+        from uuid import UUID
+        uuid = '3f2504e0-4f89-11d3-9a0c-0305e82c3301'
+        valid, errors = validateRows([
+                                      {'Group':'Servers.Web', 'Title':'Logins', 'Username':'root', 'Password':'a'},
+                                      {'UUID':uuid, 'Title':'Info', 'Password':'b'},
+                                      {'Title':'Logins', 'Password':'c'},
+                                      {'Group':['Servers', 'Web'], 'Title':'Logins', 'Username':'root', 'Password':'d'},
+                                      {'Title':'Logins', 'Password':'e', 'Color':'red'},
+                                      {'UUID':'nope', 'Title':'Logins', 'Password':'f'},
+                                      {'Title':'Logins'},
+                                      ])
+        self.assertEqual([i[0] for i in valid], [1, 2, 3])
+        self.assertEqual([i['Row'] for i in errors], [4, 5, 6, 7])
+        actions = importActions([row for rowNumber, row in valid])
+        self.assertEqual(actions[0]['vfilters'], {'Group':['Servers', 'Web'], 'Title':'Logins', 'Username':'root'})
+        self.assertEqual(actions[1]['vfilters'], {'UUID':UUID(uuid)})
+        # Only entries without a group or username
+        self.assertEqual(actions[2]['vfilters'], {'Group':None, 'Title':'Logins', 'Username':None})
+        self.assertEqual(set([i['action'] for i in actions]), set(['add-update']))
+
+
+    def test_nonAscii(self):
+        from psafefe.psafe.importer import parseRows, validateRows
+        data = "Group,Title,Password\nCaf\xc3\xa9.Web,Caf\xc3\xa9,bogus\n"
+        for upload in (data, data.decode('utf-8')):
+            valid, errors = validateRows(parseRows(upload))
+            self.assertEqual(errors, [])
+            self.assertEqual(valid, [(1, {'Group':[u'Caf\xe9', u'Web'], 'Title':u'Caf\xe9', 'Password':u'bogus'})])
+        valid, errors = validateRows(parseRows('[{"Group":"Caf\xc3\xa9", "Title":"Caf\\u00e9", "Password":"bogus"}]', format='json'))
+        self.assertEqual(errors, [])
+        self.assertEqual(valid, [(1, {'Group':[u'Caf\xe9'], 'Title':u'Caf\xe9', 'Password':u'bogus'})])
+        # Not UTF-8
+        valid, errors = validateRows(parseRows("Title,Password\nCaf\xe9,bogus\n"))
+        self.assertEqual(valid, [])
+        self.assertEqual([i['Row'] for i in errors], [1, ])
+
+    def test_badTypes(self):
+        from psafefe.psafe.importer import parseRows, validateRows
+        valid, errors = validateRows(parseRows(
+                                               '{"Group":5, "Title":"a", "Password":"x"}\n'
+                                               '{"Group":[1, 2], "Title":"b", "Password":"x"}\n'
+                                               '{"Group":null, "Notes":null, "Title":"c", "Password":"x"}\n'
+                                               '{"Title":{"a":1}, "Password":"x"}\n'
+                                               '{"Title":"e", "Password":12345}\n',
+                                               format='json'))
+        self.assertEqual([i['Row'] for i in errors], [1, 2, 4])
+        self.assertEqual(valid, [
+                                 (3, {'Title':u'c', 'Password':u'x'}),
+                                 (5, {'Title':u'e', 'Password':u'12345'}),
+                                 ])
+
+
+class ImportEntriesTests(TestCase):
+    """ Chunked import uploads. Doesn't need any psafe files. """
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe
+        from psafefe.psafe.rpc.write import entry
+        self.user = User.objects.create_superuser('importadmin', 'importadmin@localhost', 'bogus12345')
+        self.repo = PasswordSafeRepo(name='Import Tests', path='/tmp')
+        self.repo.save()
+        self.safe = PasswordSafe(filename='import.psafe3', repo=self.repo)
+        self.safe.save()
+        self.calls = []
+        self.errors = []
+        test = self
+
+        class FakeResult(object):
+            def wait(self):
+                return dict(changes=len(test.calls[-1]['actions']), errors=test.errors)
+
+        class FakeModifyEntries(object):
+            def delay(self, **kw):
+                test.calls.append(kw)
+                return FakeResult()
+        self.patched = (entry.modifyEntries, entry.getDatabasePasswordByUser)
+        entry.modifyEntries = FakeModifyEntries()
+        entry.getDatabasePasswordByUser = lambda user, password, safe, wait=True: 'safepw'
+
+    def tearDown(self):
+        from psafefe.psafe.rpc.write import entry
+        entry.modifyEntries, entry.getDatabasePasswordByUser = self.patched
+
+    def _import(self, chunkNumber, data, final, uploadID='upload1', onError='fail'):
+        from psafefe.psafe.rpc.write.entry import importEntries
+        return importEntries('importadmin', 'bogus12345', self.repo.pk, self.safe.pk, uploadID, chunkNumber, data, final, 'csv', onError)
+
+    def test_actionErrors(self):
+        # Errors are reported by the position of the action, which skips invalid rows
+        data = "Title,Password\nweb1,secret1\n,\nweb2,secret2\n"
+        self.errors = [dict(action=None, index=1, error="ValueError('Bad')"), ]
+        ret = self._import(0, data, True, onError='skip')
+        self.assertEqual(ret['Errors'], [dict(Row=2, Error="Missing fields ['Title', 'Password']"), dict(Row=3, Error="ValueError('Bad')")])
+
+    def test_chunks(self):
+        from psafefe.psafe.models import ImportChunk
+        self.assertEqual(self._import(0, "Title,Password\nweb1,secret1\n", False), {'Received':0})
+        self.assertEqual(self._import(1, "web2,secret2\n", False), {'Received':1})
+        # Chunks are stored encrypted
+        self.assertEqual(ImportChunk.objects.count(), 2)
+        for chunk in ImportChunk.objects.all():
+            self.assertFalse('secret' in chunk.sealed)
+        ret = self._import(2, "web3,secret3\n", True)
+        self.assertEqual(ret, {'Rows':3, 'Changes':3, 'Errors':[]})
+        self.assertEqual([i['changes']['Password'] for i in self.calls[0]['actions']], ['secret1', 'secret2', 'secret3'])
+        self.assertEqual(self.calls[0]['psafePassword'], 'safepw')
+        self.assertEqual(ImportChunk.objects.count(), 0)
+
+    def test_missing(self):
+        from psafefe.psafe.models import ImportChunk
+        self._import(0, "Title,Password\nweb1,secret1\n", False)
+        self.assertRaises(ValueError, self._import, 2, "web3,secret3\n", True)
+        self.assertEqual(self.calls, [])
+        # Other uploads aren't mixed in
+        self._import(1, "web2,secret2\n", False, uploadID='upload2')
+        self.assertRaises(ValueError, self._import, 2, "web3,secret3\n", True)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(ImportChunk.objects.filter(chunkNumber=1).count(), 1)
+
+    def test_limits(self):
+        from django.test.utils import override_settings
+        from psafefe.psafe.models import ImportChunk
+        with override_settings(PSAFE_IMPORT_MAX_CHUNKS=2, PSAFE_IMPORT_MAX_CHUNK_SIZE=20):
+            self.assertRaises(ValueError, self._import, 2, "web3,secret3\n", False)
+            self.assertRaises(ValueError, self._import, -1, "web3,secret3\n", False)
+            self.assertRaises(ValueError, self._import, 0, "Title,Password\nweb1,secret1\n", False)
+        self.assertEqual(ImportChunk.objects.count(), 0)
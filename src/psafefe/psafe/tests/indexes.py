@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Tests for the cache's secondary indexes
+'''
+from django.test import TestCase
+
+
+class GroupIndexTests(TestCase):
+    """ Group path helpers. Don't need any psafe files. """
+
+    def test_groupAncestors(self):
+        from psafefe.psafe.indexes import groupAncestors
+        self.assertEqual(groupAncestors('Datacenter.East.Web'), ['Datacenter', 'Datacenter.East', 'Datacenter.East.Web'])
+        self.assertEqual(groupAncestors('Datacenter'), ['Datacenter'])
+        self.assertEqual(groupAncestors(''), [])
+        self.assertEqual(groupAncestors(None), [])
+
+    def test_groupHash(self):
+        from psafefe.psafe.indexes import groupHash
+        self.assertEqual(groupHash(u'Datacenter.East'), groupHash('Datacenter.East'))
+        self.assertEqual(groupHash(None), groupHash(''))
+        self.assertNotEqual(groupHash('Datacenter'), groupHash('Datacenter.East'))
+
+
+class TextIndexTests(TestCase):
+    """ Text index helpers. Don't need any psafe files. """
+
+    def test_tokenize(self):
+        from psafefe.psafe.indexes import tokenize
+        self.assertEqual(tokenize('db-prod-01.Example.com'), set(['db', 'prod', '01', 'example', 'com']))
+        self.assertEqual(tokenize('root_login  root'), set(['root', 'login']))
+        self.assertEqual(tokenize(u'caf\xe9 bar'), set([u'caf\xe9', u'bar']))
+        self.assertEqual(tokenize(''), set())
+        self.assertEqual(tokenize(None), set())
+
+
+class TrigramIndexTests(TestCase):
+    """ Trigram helpers and the fuzzy search """
+
+    def test_trigrams(self):
+        from psafefe.psafe.indexes import trigrams
+        self.assertEqual(trigrams('DB1'), set([u'  d', u' db', u'db1', u'b1 ']))
+        self.assertEqual(trigrams(''), set())
+        self.assertEqual(trigrams(None), set())
+
+    def test_searchFuzzy(self):
+        import datetime
+        from psafefe.psafe.indexes import searchFuzzy, indexEntryTrigrams
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, MemPSafe, MemPsafeEntry
+        repo = PasswordSafeRepo(name='Fuzzy Tests', path='/tmp')
+        repo.save()
+        safe = PasswordSafe(filename='fuzzy.psafe3', repo=repo)
+        safe.save()
+        memSafe = MemPSafe(safe=safe, fileLastModified=datetime.datetime.now(), fileLastSize=0)
+        memSafe.save()
+        # Share every query trigram but are mostly other text
+        for i in range(21):
+            entry = MemPsafeEntry(safe=memSafe, title='webserver01 old decommissioned host number %d in the east datacenter' % i)
+            entry.save()
+            indexEntryTrigrams(entry, new=True)
+        best = MemPsafeEntry(safe=memSafe, title='WebServer02')
+        best.save()
+        indexEntryTrigrams(best, new=True)
+        exact = MemPsafeEntry(safe=memSafe, title='webserver01')
+        exact.save()
+        indexEntryTrigrams(exact, new=True)
+
+        found = searchFuzzy([memSafe, ], 'webserver01', limit=2)
+        self.assertEqual([(entry.pk, field) for entry, score, field in found], [(exact.pk, 'Title'), (best.pk, 'Title')])
+        self.assertEqual(found[0][1], 1.0)
+        self.assertAlmostEqual(found[1][1], 10.0 / 14)
+        self.assertEqual(searchFuzzy([memSafe, ], 'mailhost'), [])
+
+    def test_typeahead(self):
+        import datetime
+        from django.contrib.auth.models import User, Group, AnonymousUser
+        from django.test.client import RequestFactory
+        from django.test.utils import override_settings
+        from django.utils import simplejson
+        from psafefe.psafe.ajax import typeahead
+        from psafefe.psafe.indexes import indexEntryTrigrams
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, MemPSafe, MemPsafeEntry
+        readers = Group(name='Typeahead Readers')
+        readers.save()
+        user = User.objects.create_user('typeahead', 'typeahead@localhost', 'bogus12345')
+        user.groups.add(readers)
+        safes = []
+        for name, group in (('Readable', readers), ('Hidden', None)):
+            repo = PasswordSafeRepo(name='Typeahead %s' % name, path='/tmp')
+            repo.save()
+            if group:
+                repo.readAllowGroups.add(group)
+            safe = PasswordSafe(filename='typeahead.psafe3', repo=repo)
+            safe.save()
+            memSafe = MemPSafe(safe=safe, fileLastModified=datetime.datetime.now(), fileLastSize=0)
+            memSafe.save()
+            for i in range(3):
+                entry = MemPsafeEntry(safe=memSafe, title='webserver0%d' % i)
+                entry.save()
+                indexEntryTrigrams(entry, new=True)
+            safes.append(safe)
+        request = RequestFactory().get('/')
+        request.user = user
+
+        def found(limit):
+            # Neither repo is the personal safe repo, which nobody can read
+            with override_settings(PSAFE_PERSONAL_PK=-1):
+                return simplejson.loads(typeahead(request, 'webserver', limit=limit))
+        # Only safes in readable repos are searched
+        self.assertEqual(len(found(10)), 3)
+        self.assertEqual(set([i['Safe PK'] for i in found(10)]), set([safes[0].pk, ]))
+        self.assertEqual(len(found(2)), 2)
+        self.assertEqual(len(found('bogus')), 3)
+        self.assertEqual(found(0), [])
+        with override_settings(PSAFE_SEARCH_MAX_RESULTS=1):
+            self.assertEqual(len(found(10)), 1)
+        request.user = AnonymousUser()
+        self.assertEqual(found(10), [])
+
+
+class PasswordIndexTests(TestCase):
+    """ Password digest helpers """
+
+    def test_passwordDigest(self):
+        from psafefe.psafe.indexes import passwordDigest
+        self.assertEqual(passwordDigest(u'hunter2'), passwordDigest('hunter2'))
+        self.assertNotEqual(passwordDigest('hunter2'), passwordDigest('hunter3'))
+        self.assertEqual(len(passwordDigest('hunter2')), 64)
+        self.assertFalse('hunter2' in passwordDigest('hunter2'))
+
+
+class GroupTreeTests(TestCase):
+    """ Group tree built from the memory table cache. Doesn't need any psafe files. """
+
+    def setUp(self):
+        import datetime
+        from django.contrib.auth.models import User
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, MemPSafe, MemPsafeEntry
+        self.user = User.objects.create_superuser('treeadmin', 'treeadmin@localhost', 'bogus12345')
+        repo = PasswordSafeRepo(name='Tree Tests', path='/tmp')
+        repo.save()
+        self.safe = PasswordSafe(filename='tree.psafe3', repo=repo)
+        self.safe.save()
+        self.memSafe = MemPSafe(safe=self.safe, fileLastModified=datetime.datetime.now(), fileLastSize=0)
+        self.memSafe.save()
+        for group, title in (
+                             ('Datacenter.East.Web', 'web1'),
+                             ('Datacenter.East.Web', 'web2'),
+                             ('Datacenter.East.DB', 'db1'),
+                             ('Datacenter.West', 'mail1'),
+                             ('Office', 'printer'),
+                             ):
+            MemPsafeEntry(safe=self.memSafe, group=group, title=title).save()
+
+    def test_rebuildGroupIndex(self):
+        from psafefe.psafe.indexes import rebuildGroupIndex, getChildGroups, getGroupTreeEntries
+        from psafefe.psafe.models import MemPsafeGroup, MemPsafeEntry
+        self.assertEqual(rebuildGroupIndex(self.memSafe), 6)
+        self.assertEqual([(i.path, i.entryCount) for i in getChildGroups(self.memSafe, '')], [('Datacenter', 4), ('Office', 1)])
+        self.assertEqual([(i.name, i.depth, i.entryCount) for i in getChildGroups(self.memSafe, 'Datacenter.East')], [('DB', 3, 1), ('Web', 3, 2)])
+        self.assertEqual(list(getChildGroups(self.memSafe, 'Datacenter.East.Web')), [])
+        self.assertEqual(sorted([i.title for i in getGroupTreeEntries(self.memSafe, 'Datacenter.East')]), ['db1', 'web1', 'web2'])
+        self.assertEqual(getGroupTreeEntries(self.memSafe, '').count(), 5)
+        # A prefix that isn't a whole group doesn't match
+        self.assertEqual(getGroupTreeEntries(self.memSafe, 'Datacenter.Ea').count(), 0)
+
+        # Moved entries and emptied groups are picked up by the next rebuild
+        MemPsafeEntry.objects.filter(safe=self.memSafe, title='db1').update(group='Datacenter.West')
+        self.assertEqual(rebuildGroupIndex(self.memSafe), 5)
+        self.assertFalse(MemPsafeGroup.objects.filter(safe=self.memSafe, path='Datacenter.East.DB').exists())
+        self.assertEqual(sorted([i.title for i in getGroupTreeEntries(self.memSafe, 'Datacenter.West')]), ['db1', 'mail1'])
+
+    def test_treeRPC(self):
+        from psafefe.psafe.indexes import rebuildGroupIndex
+        from psafefe.psafe.rpc.read import getChildGroups, getEntriesByGroupTree
+        rebuildGroupIndex(self.memSafe)
+        children = getChildGroups('treeadmin', 'bogus12345', self.safe.pk, 'Datacenter')
+        self.assertEqual(children, [
+                                    {'Group':'Datacenter.East', 'Name':'East', 'Depth':2, 'Entry Count':3},
+                                    {'Group':'Datacenter.West', 'Name':'West', 'Depth':2, 'Entry Count':1},
+                                    ])
+        entries = getEntriesByGroupTree('treeadmin', 'bogus12345', self.safe.pk, 'Datacenter.East')
+        self.assertEqual(sorted([i['Title'] for i in entries]), ['db1', 'web1', 'web2'])
+        self.assertTrue(all([i['Group'].startswith('Datacenter.East.') for i in entries]))
+
+    def test_rowCount(self):
+        from psafefe.psafe.indexes import indexEntry, indexEntryPasswords
+        from psafefe.psafe.models import MemPsafeEntry, MemPsafeGroup, MemPsafeGroupMember, MemEntryToken, MemEntryTrigram, MemPasswordDigest
+        from psafefe.psafe.tasks.load import _finishRefresh
+        for entry in MemPsafeEntry.objects.filter(safe=self.memSafe):
+            indexEntry(entry, new=True)
+            indexEntryPasswords(entry, ['old'], new=True)
+        _finishRefresh(self.memSafe)
+        indexRows = sum([model.objects.count() for model in (MemPsafeGroup, MemPsafeGroupMember, MemEntryToken, MemEntryTrigram, MemPasswordDigest)])
+        self.assertTrue(indexRows > 0)
+        self.assertEqual(self.memSafe.rowCount, 5 + indexRows)
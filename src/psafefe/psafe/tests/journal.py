@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Tests for the write journal
+'''
+from django.test import TestCase
+
+
+class JournalTests(TestCase):
+    """ Journal helpers that don't need the DB """
+
+    def test_seal(self):
+        from psafefe.psafe.journal import seal, unseal
+        from psafefe.psafe.errors import JournalIntegrityError
+        from base64 import b64encode, b64decode
+        value = dict(password='bogus12345', actions=[dict(action='add', changes={'Title':'web1'})])
+        sealed = seal(value)
+        self.assertFalse('bogus12345' in b64decode(sealed))
+        self.assertEqual(unseal(sealed), value)
+        raw = b64decode(sealed)
+        tampered = b64encode(raw[:20] + chr(ord(raw[20]) ^ 1) + raw[21:])
+        self.assertRaises(JournalIntegrityError, unseal, tampered)
+
+    def test_matches(self):
+        from psafefe.psafe.journal import _matches
+        entry = {'Group':'Servers.Web', 'Title':'Logins', 'Username':'root'}
+        self.assertTrue(_matches(entry, dict(vfilters={'Group':['Servers', 'Web'], 'Username':'root'})))
+        self.assertTrue(_matches(entry, dict(refilters={'Title':'^Log'})))
+        self.assertFalse(_matches(entry, dict(vfilters={'Username':'sadm'})))
+        self.assertFalse(_matches(entry, dict(refilters={'URL':'.*'})))
+
+    def test_repeatable(self):
+        from psafefe.psafe.journal import _repeatable, _matches
+        from uuid import UUID
+        actions = [
+                   dict(action='add', changes={'Title':'web1'}),
+                   dict(action='delete', refilters={}, vfilters={'Title':'web2'}),
+                   ]
+        ret = _repeatable(actions)
+        self.assertEqual(ret[0]['action'], 'add-update')
+        uuid = ret[0]['changes']['UUID']
+        self.assertTrue(isinstance(uuid, UUID))
+        self.assertEqual(ret[0]['vfilters'], {'UUID':uuid})
+        self.assertEqual(ret[1], actions[1])
+        # The original isn't changed
+        self.assertEqual(actions[0], dict(action='add', changes={'Title':'web1'}))
+        self.assertTrue(_matches({'UUID':unicode(uuid)}, ret[0]))
+
+
+class ApplyJournalTests(TestCase):
+    """ Claiming and applying journaled batches. Doesn't need any psafe files. """
+
+    def setUp(self):
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe
+        from psafefe.psafe.tasks import write
+        self.repo = PasswordSafeRepo(name='Journal Tests', path='/tmp')
+        self.repo.save()
+        self.safe = PasswordSafe(filename='journal.psafe3', repo=self.repo)
+        self.safe.save()
+        self.applied = []
+        self.onApply = None
+        self._applyBatches = write._applyBatches
+        write._applyBatches = self._fakeApplyBatches
+
+    def tearDown(self):
+        from psafefe.psafe.tasks import write
+        write._applyBatches = self._applyBatches
+
+    def _fakeApplyBatches(self, psafe, psafePassword, batches, updateCache=True):
+        self.applied.append([actions for actions, onError in batches])
+        if self.onApply:
+            self.onApply()
+        return [dict(errors=[], changes=len(actions)) for actions, onError in batches]
+
+    def _journal(self, title, **kw):
+        from psafefe.psafe.models import WriteJournal
+        from psafefe.psafe.journal import seal
+        entry = WriteJournal(
+                             safe=self.safe,
+                             sealed=seal(dict(password='bogus', actions=[dict(action='delete', vfilters={'Title':title}), ], onError='fail')),
+                             **kw
+                             )
+        entry.save()
+        return entry
+
+    def _status(self, entry):
+        from psafefe.psafe.models import WriteJournal
+        return WriteJournal.objects.get(pk=entry.pk).status
+
+    def test_apply(self):
+        from psafefe.psafe.tasks.write import applyWriteJournal
+        from psafefe.psafe.models import WriteJournal
+        first = self._journal('web1')
+        second = self._journal('web2')
+        self.assertEqual(applyWriteJournal(self.safe.pk), 2)
+        # One pass, in order
+        self.assertEqual(len(self.applied), 1)
+        self.assertEqual([i[0]['vfilters']['Title'] for i in self.applied[0]], ['web1', 'web2'])
+        self.assertEqual(self._status(first), WriteJournal.STATUS_APPLIED)
+        self.assertEqual(self._status(second), WriteJournal.STATUS_APPLIED)
+        self.assertEqual(applyWriteJournal(self.safe.pk), 0)
+
+    def test_earlierClaim(self):
+        import datetime
+        from psafefe.psafe.tasks.write import applyWriteJournal
+        from psafefe.psafe.models import WriteJournal
+        # Another applier is working on an earlier batch
+        first = self._journal('web1', status=WriteJournal.STATUS_APPLYING, claimToken='other', claimed=datetime.datetime.now())
+        second = self._journal('web2')
+        self.assertEqual(applyWriteJournal(self.safe.pk), 0)
+        self.assertEqual(self.applied, [])
+        self.assertEqual(self._status(second), WriteJournal.STATUS_QUEUED)
+        self.assertEqual(WriteJournal.objects.get(pk=second.pk).claimToken, None)
+
+    def test_staleClaim(self):
+        import datetime
+        from psafefe.psafe.tasks.write import applyAllWriteJournals
+        from psafefe.psafe.models import WriteJournal
+        old = datetime.datetime.now() - datetime.timedelta(days=1)
+        first = self._journal('web1', status=WriteJournal.STATUS_APPLYING, claimToken='dead', claimed=old)
+        self.assertEqual(applyAllWriteJournals(), 1)
+        self.assertEqual(self._status(first), WriteJournal.STATUS_APPLIED)
+        self.assertNotEqual(WriteJournal.objects.get(pk=first.pk).claimToken, 'dead')
+
+    def test_lostClaim(self):
+        from psafefe.psafe.tasks.write import applyWriteJournal
+        from psafefe.psafe.models import WriteJournal
+        first = self._journal('web1')
+        def requeue():
+            # Taken over by another applier while this one was slow
+            WriteJournal.objects.filter(pk=first.pk).update(claimToken='other')
+        self.onApply = requeue
+        self.assertEqual(applyWriteJournal(self.safe.pk), 0)
+        self.assertEqual(self._status(first), WriteJournal.STATUS_APPLYING)
+        self.assertEqual(WriteJournal.objects.get(pk=first.pk).claimToken, 'other')
+
+
+class OverlayReadTests(TestCase):
+    """ The psafe.read RPCs show a user their own journaled writes. Doesn't need any psafe files. """
+
+    def setUp(self):
+        import datetime
+        from uuid import uuid4
+        from django.contrib.auth.models import User
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, MemPSafe, MemPsafeEntry, WriteJournal
+        from psafefe.psafe.journal import seal, _repeatable
+        self.user = User.objects.create_superuser('overlayadmin', 'overlayadmin@localhost', 'bogus12345')
+        self.other = User.objects.create_superuser('overlayother', 'overlayother@localhost', 'bogus12345')
+        repo = PasswordSafeRepo(name='Overlay Tests', path='/tmp')
+        repo.save()
+        self.safe = PasswordSafe(filename='overlay.psafe3', repo=repo)
+        self.safe.save()
+        self.memSafe = MemPSafe(safe=self.safe, fileLastModified=datetime.datetime.now(), fileLastSize=0)
+        self.memSafe.save()
+        self.entries = {}
+        for title, group in (('web1', 'Datacenter.East'), ('web2', 'Office')):
+            entry = MemPsafeEntry(safe=self.memSafe, uuid=str(uuid4()), title=title, group=group, password='old')
+            entry.save()
+            self.entries[title] = entry
+        self.added = uuid4()
+        actions = _repeatable([
+                               dict(action='update', vfilters={'Title':'web1'}, changes={'Password':'new'}),
+                               dict(action='delete', vfilters={'Title':'web2'}),
+                               dict(action='add', changes={'UUID':self.added, 'Title':'web3', 'Group':'Datacenter.West'}),
+                               ])
+        WriteJournal(safe=self.safe, user=self.user, sealed=seal(dict(password='bogus', actions=actions, onError='fail'))).save()
+
+    def test_getEntryByPK(self):
+        from psafefe.psafe.rpc.read import getEntryByPK
+        from psafefe.psafe.rpc.errors import EntryDoesntExistError
+        self.assertEqual(getEntryByPK('overlayadmin', 'bogus12345', self.entries['web1'].pk, user=self.user)['Password'], 'new')
+        self.assertRaises(EntryDoesntExistError, getEntryByPK, 'overlayadmin', 'bogus12345', self.entries['web2'].pk, user=self.user)
+        # Other users don't see the pending writes
+        self.assertEqual(getEntryByPK('overlayother', 'bogus12345', self.entries['web1'].pk, user=self.other)['Password'], 'old')
+
+    def test_getEntryByUUID(self):
+        from psafefe.psafe.rpc.read import getEntryByUUID, getEntriesByUUID
+        from psafefe.psafe.rpc.errors import EntryDoesntExistError
+        self.assertEqual(getEntryByUUID('overlayadmin', 'bogus12345', self.entries['web1'].uuid, user=self.user)['Password'], 'new')
+        self.assertEqual(getEntryByUUID('overlayadmin', 'bogus12345', unicode(self.added), user=self.user)['Title'], 'web3')
+        self.assertEqual(getEntriesByUUID('overlayadmin', 'bogus12345', self.entries['web2'].uuid, user=self.user), [])
+        self.assertRaises(EntryDoesntExistError, getEntryByUUID, 'overlayother', 'bogus12345', unicode(self.added), user=self.other)
+        self.assertEqual(len(getEntriesByUUID('overlayother', 'bogus12345', self.entries['web2'].uuid, user=self.other)), 1)
+
+    def test_getEntriesByGroupTree(self):
+        from psafefe.psafe.rpc.read import getEntriesByGroupTree
+        entries = getEntriesByGroupTree('overlayadmin', 'bogus12345', self.safe.pk, 'Datacenter', user=self.user)
+        self.assertEqual(sorted([(i['Title'], i.get('Password')) for i in entries]), [('web1', 'new'), ('web3', None)])
+        self.assertEqual(sorted([i['Title'] for i in getEntriesByGroupTree('overlayadmin', 'bogus12345', self.safe.pk, '', user=self.user)]), ['web1', 'web3'])
+        self.assertEqual(getEntriesByGroupTree('overlayadmin', 'bogus12345', self.safe.pk, 'Office', user=self.user), [])
+
+    def test_overlaySafe(self):
+        from psafefe.psafe.journal import overlaySafe
+        ret = overlaySafe(self.safe, self.user, self.memSafe.todict())
+        self.assertEqual(sorted([i['Title'] for i in ret['Entries']]), ['web1', 'web3'])
+        # Nothing to do without entries or pending writes
+        safe = self.memSafe.todict(getEntries=False)
+        self.assertTrue(overlaySafe(self.safe, self.user, safe) is safe)
+        safe = self.memSafe.todict()
+        self.assertTrue(overlaySafe(self.safe, self.other, safe) is safe)
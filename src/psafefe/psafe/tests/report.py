@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html 
+#===============================================================================
+''' Tests for the expiry report and datetime range filters
+'''
+from django.test import TestCase
+import datetime
+
+
+class ExpiryReportTests(TestCase):
+    """ Expiry/age report and range filters over the memory table cache. Doesn't need any psafe files. """
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, MemPSafe, MemPsafeEntry
+        self.user = User.objects.create_superuser('reportadmin', 'reportadmin@localhost', 'bogus12345')
+        self.repo = PasswordSafeRepo(name='Report Tests', path='/tmp')
+        self.repo.save()
+        self.safe = PasswordSafe(filename='report.psafe3', repo=self.repo)
+        self.safe.save()
+        self.uncached = PasswordSafe(filename='uncached.psafe3', repo=self.repo)
+        self.uncached.save()
+        self.memSafe = MemPSafe(safe=self.safe, fileLastModified=datetime.datetime.now(), fileLastSize=0)
+        self.memSafe.save()
+        now = datetime.datetime.now()
+        self.entries = {}
+        for title, modTime, expiry in (
+                                       ('expired', now - datetime.timedelta(days=1), now - datetime.timedelta(days=1)),
+                                       ('expiring', now - datetime.timedelta(days=1), now + datetime.timedelta(days=2)),
+                                       ('old', now - datetime.timedelta(days=400), None),
+                                       # Both old and expired. Expired wins. 
+                                       ('oldExpired', now - datetime.timedelta(days=400), now - datetime.timedelta(days=3)),
+                                       ('fine', now - datetime.timedelta(days=1), now + datetime.timedelta(days=100)),
+                                       ):
+            entry = MemPsafeEntry(safe=self.memSafe, title=title, passwordModTime=modTime, passwordExpiryTime=expiry)
+            entry.save()
+            self.entries[title] = entry
+
+    def test_buildExpiryReport(self):
+        from django.test.utils import override_settings
+        from psafefe.psafe.tasks.report import buildExpiryReport
+        from psafefe.psafe.rpc.read import getExpiryReport
+        self.assertEqual(getExpiryReport('reportadmin', 'bogus12345', self.repo.pk), {'Entries':[], 'Not Cached':[]})
+        with override_settings(PSAFE_EXPIRY_REPORT_DAYS=14, PSAFE_PASSWORD_MAX_AGE_DAYS=180):
+            self.assertEqual(buildExpiryReport(self.repo), 5)
+        report = getExpiryReport('reportadmin', 'bogus12345', self.repo.pk)
+        self.assertEqual(sorted([(i['Title'], i['Reason']) for i in report['Entries']]), [
+                                                                                         ('expired', 'Expired'),
+                                                                                         ('expiring', 'Expiring'),
+                                                                                         ('old', 'Old Password'),
+                                                                                         ('oldExpired', 'Expired'),
+                                                                                         ])
+        self.assertEqual(report['Not Cached'], [self.uncached.pk, ])
+
+        # Rebuilding replaces the old rows
+        self.entries['expired'].delete()
+        with override_settings(PSAFE_EXPIRY_REPORT_DAYS=14, PSAFE_PASSWORD_MAX_AGE_DAYS=180):
+            buildExpiryReport(self.repo)
+        report = getExpiryReport('reportadmin', 'bogus12345', self.repo.pk)
+        self.assertEqual(len(report['Entries']), 3)
+
+    def test_rangeFilters(self):
+        from psafefe.psafe.models import MemPsafeEntry
+        from psafefe.psafe.rpc.search import _fieldFilter
+        now = datetime.datetime.now()
+
+        def titles(field, values):
+            return sorted(MemPsafeEntry.objects.filter(safe=self.memSafe).filter(_fieldFilter(field, values)).values_list('title', flat=True))
+        self.assertEqual(titles('Password Expiry', {'lt':now}), ['expired', 'oldExpired'])
+        self.assertEqual(titles('Password Expiry', {'gt':now}), ['expiring', 'fine'])
+        self.assertEqual(titles('Password Expiry', {'between':[now, now + datetime.timedelta(days=14)]}), ['expiring', ])
+        # Operators are ANDed
+        self.assertEqual(titles('Password Last Modification Time', {'lt':now, 'gt':now - datetime.timedelta(days=30)}), ['expired', 'expiring', 'fine'])
+        # Between includes both ends
+        expiry = self.entries['fine'].passwordExpiryTime
+        self.assertEqual(titles('Password Expiry', {'between':[expiry, expiry]}), ['fine', ])
+
+    def test_rangeFilterValidation(self):
+        from psafefe.psafe.rpc.search import _filterComplex
+        from psafefe.psafe.rpc.errors import InvalidQueryError
+        now = datetime.datetime.now()
+        for include in (
+                        {'Password Expiry':{'before':now}},
+                        {'Password Expiry':{'between':[now, ]}},
+                        {'Password Expiry':{'lt':'yesterday'}},
+                        # Only datetime fields take range operators
+                        {'Title':{'lt':'web'}},
+                        ):
+            self.assertRaises(InvalidQueryError, _filterComplex, 'reportadmin', 'bogus12345', [self.safe.pk, ], include, {}, user=self.user)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Tests for password rotation jobs
+'''
+from django.test import TestCase
+
+
+class RotationTests(TestCase):
+    """ Rotation helpers that don't need the DB """
+
+    def test_generatePassword(self):
+        from psafefe.psafe.tasks.rotation import generatePassword, POLICY_CLASSES
+        import string
+        pw = generatePassword({'Length':30})
+        self.assertEqual(len(pw), 30)
+        for name, chars in POLICY_CLASSES:
+            self.assertTrue([i for i in pw if i in chars], "No %s in %r" % (name, pw))
+        pw = generatePassword({'Length':8, 'Symbols':False, 'Uppercase':False})
+        self.assertEqual(len(pw), 8)
+        self.assertFalse([i for i in pw if i not in string.ascii_lowercase + string.digits])
+        self.assertNotEqual(generatePassword({}), generatePassword({}))
+        self.assertRaises(ValueError, generatePassword, {'Length':3})
+        self.assertRaises(ValueError, generatePassword, dict([(name, False) for name, chars in POLICY_CLASSES]))
+
+
+class RotateSafeTests(TestCase):
+    """ rotateSafe and its clean up. Doesn't need any psafe files. """
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, RotationJob, RotationJobEntry
+        from psafefe.psafe.tasks import rotation
+        self.user = User.objects.create_user('rotationuser', 'rotationuser@localhost', 'bogus12345')
+        self.repo = PasswordSafeRepo(name='Rotation Tests', path='/tmp')
+        self.repo.save()
+        self.safe = PasswordSafe(filename='rotation.psafe3', repo=self.repo)
+        self.safe.save()
+        self.job = RotationJob(user=self.user)
+        self.job.save()
+        self.uuids = ['%d0000000-0000-0000-0000-000000000000' % i for i in range(3)]
+        for uuid in self.uuids:
+            RotationJobEntry(job=self.job, safe=self.safe, entryUUID=uuid).save()
+        self.calls = []
+        self.result = None
+        self.modifyEntries = rotation.modifyEntries
+        rotation.modifyEntries = self._fakeModifyEntries
+
+    def tearDown(self):
+        from psafefe.psafe.tasks import rotation
+        rotation.modifyEntries = self.modifyEntries
+
+    def _fakeModifyEntries(self, **kw):
+        self.calls.append(kw)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+    def _statuses(self):
+        from psafefe.psafe.models import RotationJobEntry
+        return dict(RotationJobEntry.objects.filter(job=self.job).values_list('entryUUID', 'status'))
+
+    def _finished(self):
+        from psafefe.psafe.models import RotationJob
+        return RotationJob.objects.get(pk=self.job.pk).finished is not None
+
+    def test_rotateSafe(self):
+        from psafefe.psafe.tasks.rotation import rotateSafe
+        from uuid import UUID
+        self.result = dict(
+                           changes=1,
+                           actionChanges=[1, 0, 0],
+                           errors=[dict(action=dict(vfilters={'UUID':UUID(self.uuids[2])}), error="ValueError('Bad')", traceback=None), ],
+                           )
+        rotateSafe(self.job.pk, self.safe.pk, 'safepw', passwords=dict([(uuid, 'new' + uuid) for uuid in self.uuids]))
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0]['psafePassword'], 'safepw')
+        self.assertEqual([i['changes']['Password'] for i in self.calls[0]['actions']], ['new' + uuid for uuid in self.uuids])
+        self.assertEqual(self._statuses(), {
+                                            self.uuids[0]:'done',
+                                            self.uuids[1]:'missing',
+                                            self.uuids[2]:'failed',
+                                            })
+        self.assertTrue(self._finished())
+        # Nothing left to do
+        rotateSafe(self.job.pk, self.safe.pk, 'safepw')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_writeFailed(self):
+        from psafefe.psafe.tasks.rotation import rotateSafe
+        self.result = IOError("Disk full")
+        rotateSafe(self.job.pk, self.safe.pk, 'safepw', policy={'Length':10})
+        self.assertEqual(set(self._statuses().values()), set(['failed']))
+        self.assertTrue(self._finished())
+
+    def test_failStaleRotations(self):
+        import datetime
+        from psafefe.psafe.tasks.rotation import failStaleRotations
+        from psafefe.psafe.models import RotationJob
+        self.assertEqual(failStaleRotations(), 0)
+        self.assertFalse(self._finished())
+        RotationJob.objects.filter(pk=self.job.pk).update(created=datetime.datetime.now() - datetime.timedelta(days=2))
+        self.assertEqual(failStaleRotations(), 3)
+        self.assertEqual(set(self._statuses().values()), set(['failed']))
+        self.assertTrue(self._finished())
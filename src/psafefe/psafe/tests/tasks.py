@@ -337,6 +337,393 @@ class LoadPsafeTests(LivePsafeTestCase):
                            force = True,
                            )
             self.assertTrue(res, "Failed forcibly reload safe %r" % safe)
-            
-            
-    
+
+    def test_loadSafe_evict(self):
+        from psafefe.psafe.models import *
+        from psafefe.psafe.tasks.load import loadSafe, evictColdSafes
+        testSafeRepo = self.groupsByRepo['testsafes']['repo']
+        testSafes = filter(lambda fil: fil.endswith('.psafe3'), os.listdir(testSafeRepo.path))
+        self.assertTrue(len(testSafes) > 1, "Need at least two test safes")
+        with override_settings(PSAFE_CACHE_MAX_SAFES = 1, PSAFE_CACHE_MAX_ROWS = None):
+            for safe in testSafes:
+                psafeObj = PasswordSafe(
+                                        filename = os.path.join(testSafeRepo.path, safe),
+                                        repo = testSafeRepo,
+                                        )
+                psafeObj.save()
+                self.assertTrue(loadSafe(psafe_pk = psafeObj.pk, password = 'bogus12345', force = True, evict = False))
+            # Nothing evicted while loading a set of safes
+            self.assertEqual(MemPSafe.objects.count(), len(testSafes))
+            for memPSafe in MemPSafe.objects.all():
+                rows = MemPsafeEntry.objects.filter(safe = memPSafe).count() + MemPasswordEntryHistory.objects.filter(entry__safe = memPSafe).count()
+                # Index rows count too
+                self.assertTrue(memPSafe.rowCount > rows)
+            # Whole set protected
+            self.assertEqual(evictColdSafes(keepPKs = list(MemPSafe.objects.values_list('pk', flat = True))), 0)
+            self.assertEqual(evictColdSafes(), len(testSafes) - 1)
+            self.assertEqual(MemPSafe.objects.count(), 1)
+
+
+
+
+class RecordIndexTests(TestCase):
+    """ modifyEntries' per-call record index. Doesn't need any psafe files. """
+
+    def _index(self):
+        from psafefe.psafe.tasks.write import _RecordIndex
+        from psafefe.psafe.tests.cache import FakePWSafe
+        self.records = [
+                        dict(UUID='1', Group=['Servers', 'Web'], Title='web1'),
+                        dict(UUID='2', Group=['Servers', 'Web'], Title='web2'),
+                        dict(UUID='3', Group=['Servers', 'DB'], Title='db1'),
+                        ]
+        return _RecordIndex(FakePWSafe(self.records))
+
+    def test_find(self):
+        index = self._index()
+        self.assertEqual(index.find(dict(UUID='2')), [self.records[1], ])
+        self.assertEqual(index.find(dict(Group=['Servers', 'Web'])), self.records[:2])
+        self.assertEqual(index.find(dict(Group=['Servers', 'Web'], Title='web2')), [self.records[1], ])
+        self.assertEqual(index.find(dict(Title='mail1')), [])
+        self.assertEqual(index.find({}), self.records)
+        # None matches a missing field
+        self.assertEqual(index.find(dict(Group=['Servers', 'Web'], Username=None)), self.records[:2])
+        self.assertEqual(index.find(dict(Title=None)), [])
+
+    def test_addRemove(self):
+        index = self._index()
+        index.find(dict(Title='web1'))
+        record = self.records[0]
+        index.remove(record)
+        record['Title'] = 'web3'
+        index.add(record)
+        self.assertEqual(index.find(dict(Title='web1')), [])
+        self.assertEqual(index.find(dict(Title='web3')), [record, ])
+        new = dict(UUID='4', Title='web1')
+        index.add(new)
+        self.assertEqual(index.find(dict(Title='web1')), [new, ])
+
+    def test_findPrefix(self):
+        index = self._index()
+        self.assertEqual(index.findPrefix('Group', 'Servers.Web'), self.records[:2])
+        self.assertEqual(index.findPrefix('Title', 'db'), self.records[2:])
+        self.assertEqual(index.findPrefix('Title', 'mail'), [])
+        record = self.records[0]
+        index.remove(record)
+        record['Group'] = ['Servers', 'DB']
+        index.add(record)
+        self.assertEqual(index.findPrefix('Group', 'Servers.Web'), self.records[1:2])
+        self.assertEqual(len(index.findPrefix('Group', 'Servers.DB')), 2)
+
+
+class FindRecordsTests(TestCase):
+    """ modifyEntries' record matching. Doesn't need any psafe files. """
+
+    def setUp(self):
+        from psafefe.psafe.tests.cache import FakePWSafe
+        self.records = [dict(UUID=str(i), Group=['Servers', 'Web'], Title='web%d' % i) for i in range(5)]
+        self.pypwsafe = FakePWSafe(self.records)
+
+    def _find(self, **kw):
+        from psafefe.psafe.tasks.write import _findRecords
+        return list(_findRecords(psafe=None, pypwsafe=self.pypwsafe, refilters={}, vfilters={'Group':['Servers', 'Web']}, **kw))
+
+    def test_maxMatches(self):
+        self.assertEqual(self._find(), self.records)
+        self.assertEqual(self._find(maxMatches=1), self.records[:1])
+        self.assertEqual(self._find(maxMatches=3), self.records[:3])
+        self.assertEqual(self._find(maxMatches=0), [])
+        self.assertEqual(self._find(maxMatches=5, onMaxMatches='fail'), self.records)
+
+    def test_earlyExit(self):
+        from psafefe.psafe.tasks.write import _findRecords
+        checked = []
+        class Counting(list):
+            def __iter__(self):
+                for i in list.__iter__(self):
+                    checked.append(i)
+                    yield i
+        self.pypwsafe.records = Counting(self.records)
+        self.assertEqual(self._find(maxMatches=1), self.records[:1])
+        self.assertEqual(checked, self.records[:1])
+
+    def test_regexPrefix(self):
+        from psafefe.psafe.tasks.write import _findRecords, _RecordIndex
+        index = _RecordIndex(self.pypwsafe)
+        found = list(_findRecords(psafe=None, pypwsafe=self.pypwsafe, refilters={'Title':r'web[13]$', 'Group':r'^Servers\.W'}, vfilters={}, index=index))
+        self.assertEqual(found, [self.records[1], self.records[3]])
+        self.assertEqual(index.sortedByField.keys(), ['Group'])
+
+    def test_missingField(self):
+        from psafefe.psafe.tasks.write import _findRecords
+        self.records[1]['Username'] = 'root'
+        found = list(_findRecords(psafe=None, pypwsafe=self.pypwsafe, refilters={}, vfilters={'Username':None}))
+        self.assertEqual(found, [self.records[0], ] + self.records[2:])
+        found = list(_findRecords(psafe=None, pypwsafe=self.pypwsafe, refilters={}, vfilters={'Username':'root'}))
+        self.assertEqual(found, self.records[1:2])
+
+    def test_onMaxMatchesFail(self):
+        from psafefe.psafe.errors import TooManyMatchesError
+        self.assertRaises(TooManyMatchesError, self._find, maxMatches=4, onMaxMatches='fail')
+        self.assertRaises(ValueError, self._find, onMaxMatches='bogus')
+
+
+class PatchCacheTests(TestCase):
+    """ patchCache. Uses fake safes written to a temp dir. """
+
+    def setUp(self):
+        import tempfile
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe
+        from psafefe.psafe.tests.cache import FakeRecord, FakePWSafe
+        self.dir = tempfile.mkdtemp()
+        self.repo = PasswordSafeRepo(name='Patch Tests', path=self.dir)
+        self.repo.save()
+        self.safe = PasswordSafe(filename='patch.psafe3', repo=self.repo)
+        self.safe.save()
+        self.records = [FakeRecord(u'%d0000000-0000-0000-0000-000000000000' % i, ['Servers'], 'web%d' % i, 'root', 'pw%d' % i) for i in range(3)]
+        self.pypwsafe = FakePWSafe(self.records)
+        self._write('x')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def _write(self, data):
+        with open(self.safe.psafePath(), 'a') as f:
+            f.write(data)
+
+    def _passwords(self):
+        from psafefe.psafe.models import MemPsafeEntry
+        return dict([(e.title, e.password) for e in MemPsafeEntry.objects.filter(safe__safe=self.safe)])
+
+    def test_partial(self):
+        from psafefe.psafe.tasks.load import patchCache, fileFingerprint
+        patchCache(self.safe, self.pypwsafe, 'bogus')
+        self.assertEqual(self._passwords(), {'web0':'pw0', 'web1':'pw1', 'web2':'pw2'})
+
+        # Only the given records are synced when the cache matches the file
+        self.records[0].password = 'new0'
+        self.records[1].password = 'new1'
+        fileBefore = fileFingerprint(self.safe.psafePath())
+        self._write('x')
+        patchCache(self.safe, self.pypwsafe, 'bogus', records=[self.records[0], ], deletedUUIDs=[self.records[2].getUUID(), ], fileBefore=fileBefore)
+        self.assertEqual(self._passwords(), {'web0':'new0', 'web1':'pw1'})
+
+    def test_fileChanged(self):
+        from psafefe.psafe.tasks.load import patchCache, fileFingerprint
+        patchCache(self.safe, self.pypwsafe, 'bogus')
+        self.records[0].password = 'new0'
+        self.records[1].password = 'new1'
+        # Written by something else since it was cached
+        self._write('y')
+        fileBefore = fileFingerprint(self.safe.psafePath())
+        self._write('x')
+        patchCache(self.safe, self.pypwsafe, 'bogus', records=[self.records[0], ], fileBefore=fileBefore)
+        self.assertEqual(self._passwords(), {'web0':'new0', 'web1':'new1', 'web2':'pw2'})
+        # No fingerprint given
+        self.records[2].password = 'new2'
+        patchCache(self.safe, self.pypwsafe, 'bogus', records=[self.records[0], ])
+        self.assertEqual(self._passwords()['web2'], 'new2')
+
+    def test_failure(self):
+        from psafefe.psafe.tasks.load import patchCache, fileFingerprint
+        from psafefe.psafe.models import MemPSafe
+        patchCache(self.safe, self.pypwsafe, 'bogus')
+        class Broken(object):
+            def __getattr__(self, name):
+                raise RuntimeError("Broken record")
+        fileBefore = fileFingerprint(self.safe.psafePath())
+        self._write('x')
+        self.assertRaises(RuntimeError, patchCache, self.safe, self.pypwsafe, 'bogus', records=[self.records[0], Broken()], fileBefore=fileBefore)
+        # Half patched caches are dropped
+        self.assertEqual(MemPSafe.objects.filter(safe=self.safe).count(), 0)
+
+
+class ModifyEntriesTests(TestCase):
+    """ Merged modifyEntries batches. Uses a fake safe written to a temp dir. """
+
+    def setUp(self):
+        import tempfile
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe
+        from psafefe.psafe.indexes import passwordDigest
+        from psafefe.psafe.tasks import write
+        self.dir = tempfile.mkdtemp()
+        self.repo = PasswordSafeRepo(name='Write Tests', path=self.dir)
+        self.repo.save()
+        self.safe = PasswordSafe(filename='write.psafe3', repo=self.repo)
+        self.safe.save()
+        open(self.safe.psafePath(), 'w').close()
+        self.digest = passwordDigest('bogus')
+        self.applied = []
+        self.results = None
+        self._applyBatches = write._applyBatches
+        write._applyBatches = self._fakeApplyBatches
+
+    def tearDown(self):
+        import shutil
+        from psafefe.psafe.tasks import write
+        write._applyBatches = self._applyBatches
+        shutil.rmtree(self.dir)
+
+    def _fakeApplyBatches(self, psafe, psafePassword, batches, updateCache=True):
+        self.applied.append(batches)
+        if isinstance(self.results, Exception):
+            raise self.results
+        if self.results is not None:
+            return self.results
+        return [dict(errors=[], changes=len(actions)) for actions, onError in batches]
+
+    def _follower(self, digest=None):
+        """ Queue a batch as if another task was waiting to merge it """
+        from psafefe.psafe.models import PendingWrite
+        from psafefe.psafe.journal import seal
+        pending = PendingWrite(
+                               safe=self.safe,
+                               passwordDigest=digest or self.digest,
+                               actions=seal([dict(action='delete', vfilters={'Title':'other'}), ]),
+                               onError='fail',
+                               )
+        pending.save()
+        return pending
+
+    def _modify(self):
+        from django.test.utils import override_settings
+        from psafefe.psafe.tasks.write import modifyEntries
+        with override_settings(PSAFE_WRITE_COALESCE_WINDOW=0.01):
+            return modifyEntries(psafePK=self.safe.pk, psafePassword='bogus', actions=[dict(action='add', changes={'Title':'mine'}), ])
+
+    def test_noWindow(self):
+        from psafefe.psafe.tasks.write import modifyEntries
+        from psafefe.psafe.models import PendingWrite
+        self.assertEqual(modifyEntries(psafePK=self.safe.pk, psafePassword='bogus', actions=[]), dict(errors=[], changes=0))
+        self.assertEqual(len(self.applied), 1)
+        self.assertEqual(PendingWrite.objects.count(), 0)
+
+    def test_coalesce(self):
+        from psafefe.psafe.models import PendingWrite
+        from psafefe.psafe.tasks.write import _waitForBatch
+        follower = self._follower()
+        other = self._follower(digest='0' * 64)
+        self.assertNotIn('other', PendingWrite.objects.get(pk=follower.pk).actions)
+        self.assertEqual(self._modify(), dict(errors=[], changes=1))
+        # Both batches in one write. Batches for another safe password aren't merged. 
+        self.assertEqual(len(self.applied), 1)
+        self.assertEqual(self.applied[0], [
+                                           ([dict(action='delete', vfilters={'Title':'other'}), ], 'fail'),
+                                           ([dict(action='add', changes={'Title':'mine'}), ], 'fail'),
+                                           ])
+        self.assertEqual(_waitForBatch(follower), dict(errors=[], changes=1))
+        self.assertEqual(PendingWrite.objects.get(pk=other.pk).status, PendingWrite.STATUS_PENDING)
+        # Only the caller's own batch is cleaned up
+        self.assertEqual(PendingWrite.objects.count(), 2)
+
+    def test_followerFailure(self):
+        from psafefe.psafe.tasks.write import _waitForBatch
+        from psafefe.psafe.errors import BatchedWriteError
+        follower = self._follower()
+        self.results = [ValueError("Bad batch"), dict(errors=[], changes=1)]
+        self.assertEqual(self._modify(), dict(errors=[], changes=1))
+        self.assertRaises(BatchedWriteError, _waitForBatch, follower)
+
+    def test_leaderFailure(self):
+        from psafefe.psafe.tasks.write import _waitForBatch
+        from psafefe.psafe.errors import BatchedWriteError
+        follower = self._follower()
+        self.results = [dict(errors=[], changes=1), ValueError("Bad batch")]
+        self.assertRaises(ValueError, self._modify)
+        self.assertEqual(_waitForBatch(follower), dict(errors=[], changes=1))
+        # Nothing was saved
+        self.results = IOError("Disk full")
+        follower = self._follower()
+        self.assertRaises(IOError, self._modify)
+        self.assertRaises(BatchedWriteError, _waitForBatch, follower)
+
+
+class ApplyBatchesTests(TestCase):
+    """ Applying several batches in one pass. Uses a fake safe written to a temp dir. """
+
+    def setUp(self):
+        import tempfile
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe
+        from psafefe.psafe.tests.cache import FakePWSafe
+        from psafefe.psafe.tasks import write
+        self.dir = tempfile.mkdtemp()
+        self.repo = PasswordSafeRepo(name='Batch Tests', path=self.dir)
+        self.repo.save()
+        self.safe = PasswordSafe(filename='batch.psafe3', repo=self.repo)
+        self.safe.save()
+        open(self.safe.psafePath(), 'w').close()
+
+        class FakeRecord(dict):
+            def getUUID(self):
+                return self['UUID']
+            def setPassword(self, password):
+                self['Password'] = password
+
+        class FakeSafe(FakePWSafe):
+            def lock(self):
+                pass
+            unlock = lock
+        self.pypwsafe = FakeSafe([FakeRecord(UUID=str(i), Title='web%d' % i, Password='pw%d' % i) for i in range(3)])
+        self.saved = []
+        self.patched = (write.PWSafe3, write.Record, write.atomicSave)
+        write.PWSafe3 = lambda **kw: self.pypwsafe
+        write.Record = FakeRecord
+        write.atomicSave = self.saved.append
+
+    def tearDown(self):
+        import shutil
+        from psafefe.psafe.tasks import write
+        write.PWSafe3, write.Record, write.atomicSave = self.patched
+        shutil.rmtree(self.dir)
+
+    def _passwords(self):
+        return dict([(record['Title'], record['Password']) for record in self.pypwsafe.records])
+
+    def test_rollback(self):
+        from psafefe.psafe.tasks.write import _applyBatches
+        results = _applyBatches(self.safe, 'bogus', [
+                                                     ([dict(action='update', refilters={}, vfilters={'Title':'web0'}, changes={'Password':'new0'}), ], 'fail'),
+                                                     ([
+                                                       dict(action='update', refilters={}, vfilters={'Title':'web1'}, changes={'Password':'new1'}),
+                                                       dict(action='bogus'),
+                                                       ], 'fail'),
+                                                     ([
+                                                       dict(action='update', refilters={}, vfilters={'Title':'web2'}, changes={'Password':'new2'}),
+                                                       dict(action='bogus'),
+                                                       ], 'skip'),
+                                                     ], updateCache=False)
+        self.assertEqual(results[0], dict(errors=[], changes=1, actionChanges=[1, ]))
+        self.assertTrue(isinstance(results[1], ValueError))
+        self.assertEqual(results[2]['changes'], 1)
+        self.assertEqual(len(results[2]['errors']), 1)
+        self.assertEqual(results[2]['actionChanges'], [1, 0])
+        self.assertEqual(results[2]['errors'][0]['index'], 1)
+        # Only the failed batch's changes are dropped
+        self.assertEqual(self._passwords(), {'web0':'new0', 'web1':'pw1', 'web2':'new2'})
+        self.assertEqual(self.saved, [self.pypwsafe, ])
+
+    def test_rollbackUndo(self):
+        from psafefe.psafe.tasks.write import _applyBatches
+        before = list(self.pypwsafe.records)
+        results = _applyBatches(self.safe, 'bogus', [
+                                                     ([dict(action='update', refilters={}, vfilters={'Title':'web0'}, changes={'Password':'new0'}), ], 'fail'),
+                                                     ([
+                                                       dict(action='update', refilters={}, vfilters={'Title':'web1'}, changes={'Password':'new1'}),
+                                                       dict(action='delete', refilters={}, vfilters={'Title':'web2'}),
+                                                       dict(action='add', changes={'UUID':'3', 'Title':'web3', 'Password':'pw3'}),
+                                                       dict(action='update', refilters={}, vfilters={}, changes={'Password':'same'}),
+                                                       dict(action='bogus'),
+                                                       ], 'fail'),
+                                                     ], updateCache=False)
+        self.assertTrue(isinstance(results[1], ValueError))
+        # The records are back in order with the first batch's change kept
+        self.assertEqual([record['Title'] for record in self.pypwsafe.records], ['web0', 'web1', 'web2'])
+        self.assertEqual(self._passwords(), {'web0':'new0', 'web1':'pw1', 'web2':'pw2'})
+        # Only the updated records were copied
+        self.assertTrue(self.pypwsafe.records[2] is before[2])
+
+    def test_single(self):
+        from psafefe.psafe.tasks.write import _applyBatches
+        self.assertRaises(ValueError, _applyBatches, self.safe, 'bogus', [([dict(action='bogus'), ], 'fail'), ], updateCache=False)
+        self.assertEqual(self.saved, [])
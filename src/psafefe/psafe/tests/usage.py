@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Tests for the buffered safe usage counters
+'''
+from django.test import TestCase
+from django.test.utils import override_settings
+import datetime
+
+
+class UsageTests(TestCase):
+    """ recordUse, flushUsage and discardUse. Doesn't need any psafe files. """
+
+    def setUp(self):
+        from psafefe.psafe.models import PasswordSafeRepo, PasswordSafe, MemPSafe
+        from psafefe.psafe.usage import flushUsage
+        # Start with an empty buffer
+        flushUsage()
+        repo = PasswordSafeRepo(name='Usage Tests', path='/tmp')
+        repo.save()
+        self.memSafes = []
+        for i in range(3):
+            safe = PasswordSafe(filename='usage%d.psafe3' % i, repo=repo)
+            safe.save()
+            memSafe = MemPSafe(safe=safe, fileLastModified=datetime.datetime.now(), fileLastSize=0)
+            memSafe.save()
+            self.memSafes.append(memSafe)
+
+    def _counts(self):
+        from psafefe.psafe.models import MemPSafe
+        return [MemPSafe.objects.get(pk=memSafe.pk).entryUseCount for memSafe in self.memSafes]
+
+    def test_recordUse(self):
+        from psafefe.psafe import usage
+        with override_settings(PSAFE_USAGE_FLUSH_INTERVAL=60 * 60):
+            usage.recordUse(self.memSafes[0].pk)
+            self.memSafes[0].onUse()
+            # Only buffered
+            self.assertEqual(usage._pending, {self.memSafes[0].pk:2})
+            self.assertEqual(self._counts(), [0, 0, 0])
+        with override_settings(PSAFE_USAGE_FLUSH_INTERVAL=0):
+            usage.recordUse(self.memSafes[1].pk)
+            # Flushed once the interval has passed
+            self.assertEqual(usage._pending, {})
+            self.assertEqual(self._counts(), [2, 1, 0])
+
+    def test_flushUsage(self):
+        from psafefe.psafe.models import MemPSafe
+        from psafefe.psafe.usage import recordUse, flushUsage
+        MemPSafe.objects.filter(pk=self.memSafes[0].pk).update(entryUseCount=5)
+        with override_settings(PSAFE_USAGE_FLUSH_INTERVAL=60 * 60):
+            recordUse(self.memSafes[0].pk, count=2)
+            recordUse(self.memSafes[1].pk, count=2)
+            recordUse(self.memSafes[2].pk)
+        # One update per distinct count
+        with self.assertNumQueries(2):
+            self.assertEqual(flushUsage(), 3)
+        # Added to the counts already in the DB
+        self.assertEqual(self._counts(), [7, 2, 1])
+        self.assertFalse(MemPSafe.objects.filter(pk__in=[memSafe.pk for memSafe in self.memSafes], entryLastUsed=None).exists())
+        self.assertEqual(flushUsage(), 0)
+
+    def test_discardUse(self):
+        from psafefe.psafe import usage
+        with override_settings(PSAFE_USAGE_FLUSH_INTERVAL=60 * 60):
+            usage.recordUse(self.memSafes[0].pk, count=3)
+            usage.recordUse(self.memSafes[1].pk)
+            # A refresh resets the counters so the buffered uses are dropped
+            self.memSafes[0].onRefresh()
+            self.assertEqual(usage._pending, {self.memSafes[1].pk:1})
+        self.assertEqual(usage.flushUsage(), 1)
+        self.assertEqual(self._counts(), [0, 1, 0])
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Tests for the helpers in psafefe.utils
+'''
+from django.test import TestCase
+
+
+class UtilsTests(TestCase):
+    """ Shared helpers. Doesn't need the DB. """
+
+    def test_compilePattern(self):
+        from psafefe import utils
+        pattern = utils.compilePattern('^web[0-9]+')
+        self.assertTrue(pattern is utils.compilePattern('^web[0-9]+'))
+        self.assertTrue(pattern.match('web12'))
+        for i in range(utils.PATTERN_CACHE_SIZE + 10):
+            utils.compilePattern('x%d' % i)
+        self.assertEqual(len(utils._patterns), utils.PATTERN_CACHE_SIZE)
+        self.assertFalse(('^web[0-9]+', 0) in utils._patterns)
+
+    def test_literalPrefix(self):
+        from psafefe.utils import literalPrefix
+        self.assertEqual(literalPrefix(r'^Servers\.Web\.'), 'Servers.Web.')
+        self.assertEqual(literalPrefix(r'web[0-9]+'), 'web')
+        self.assertEqual(literalPrefix(r'webs?'), 'web')
+        self.assertEqual(literalPrefix(r'web+'), 'web')
+        self.assertEqual(literalPrefix(r'web\d'), 'web')
+        self.assertEqual(literalPrefix(r'web|db'), '')
+        self.assertEqual(literalPrefix(r'(?i)web'), '')
+        self.assertEqual(literalPrefix(r'.*web'), '')
+
+    def _fakeSafe(self, path, data):
+        class FakeSafe(object):
+            def __init__(self):
+                self.filename = path
+                self.savedTo = []
+
+            def save(self):
+                self.savedTo.append(self.filename)
+                if data is None:
+                    raise IOError("Disk full")
+                with open(self.filename, 'wb') as f:
+                    f.write(data)
+        return FakeSafe()
+
+    def test_atomicSave(self):
+        import tempfile, shutil, os, os.path
+        from psafefe.utils import atomicSave, isSaveTempFile
+        dirName = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dirName, 'test.psafe3')
+            safe = self._fakeSafe(path, 'new')
+            atomicSave(safe)
+            self.assertEqual(open(path).read(), 'new')
+            self.assertEqual(safe.filename, path)
+            # Written to a temp file first
+            self.assertNotEqual(safe.savedTo, [path, ])
+            self.assertTrue(isSaveTempFile(safe.savedTo[0]))
+            self.assertEqual(os.listdir(dirName), ['test.psafe3', ])
+
+            os.chmod(path, 0640)
+            atomicSave(self._fakeSafe(path, 'newer'))
+            self.assertEqual(open(path).read(), 'newer')
+            self.assertEqual(os.stat(path).st_mode & 0777, 0640)
+
+            # Failures leave the original alone
+            safe = self._fakeSafe(path, None)
+            self.assertRaises(IOError, atomicSave, safe)
+            self.assertEqual(safe.filename, path)
+            self.assertEqual(open(path).read(), 'newer')
+            self.assertEqual(os.listdir(dirName), ['test.psafe3', ])
+        finally:
+            shutil.rmtree(dirName)
+
+    def test_atomicSaveSymlink(self):
+        import tempfile, shutil, os, os.path
+        from psafefe.utils import atomicSave
+        dirName = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(dirName, 'real'))
+            target = os.path.join(dirName, 'real', 'test.psafe3')
+            open(target, 'w').write('old')
+            link = os.path.join(dirName, 'test.psafe3')
+            os.symlink(target, link)
+            atomicSave(self._fakeSafe(link, 'new'))
+            self.assertTrue(os.path.islink(link))
+            self.assertEqual(open(target).read(), 'new')
+            self.assertEqual(sorted(os.listdir(dirName)), ['real', 'test.psafe3'])
+        finally:
+            shutil.rmtree(dirName)
+
+    def test_isSaveTempFile(self):
+        from psafefe.utils import isSaveTempFile
+        self.assertTrue(isSaveTempFile('/safes/.test.psafe3.x1y2z3.psafefe-save.tmp'))
+        self.assertFalse(isSaveTempFile('/safes/test.psafe3'))
+        self.assertFalse(isSaveTempFile('/safes/.hidden.psafe3'))
+        self.assertFalse(isSaveTempFile('/safes/backup.psafefe-save.tmp'))
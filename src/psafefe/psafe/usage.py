@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Write-behind usage counters for the psafe cache. Uses are counted in
+this process's memory and flushed to MemPSafe in batches. Counts are 
+eventually consistent. 
+'''
+import logging
+log = logging.getLogger("psafefe.psafe.usage")
+log.debug('initing')
+
+import time
+import datetime
+import threading
+import atexit
+
+# Pending uses. MemPSafe PK -> number of uses since the last flush.
+_pending = {}
+_lock = threading.Lock()
+_lastFlush = time.time()
+
+
+def _flushInterval():
+    from django.conf import settings
+    return getattr(settings, 'PSAFE_USAGE_FLUSH_INTERVAL', 30)
+
+
+def recordUse(memPSafePK, count=1):
+    """ Buffer a use of the given MemPSafe. Flushes if the flush interval has passed. """
+    with _lock:
+        _pending[memPSafePK] = _pending.get(memPSafePK, 0) + count
+    if time.time() - _lastFlush >= _flushInterval():
+        flushUsage()
+
+
+def discardUse(memPSafePK):
+    """ Drop any buffered uses of the given MemPSafe. Used when its counters are reset. """
+    with _lock:
+        _pending.pop(memPSafePK, None)
+
+
+def flushUsage():
+    """ Write all buffered uses to the DB. Safes with the same number of 
+    uses are updated with a single query. 
+    @return: int, the number of safes updated
+    """
+    global _pending, _lastFlush
+    from django.db.models import F
+    from psafefe.psafe.models import MemPSafe
+    with _lock:
+        pending = _pending
+        _pending = {}
+        _lastFlush = time.time()
+    if not pending:
+        return 0
+
+    byCount = {}
+    for pk, count in pending.items():
+        byCount.setdefault(count, []).append(pk)
+    now = datetime.datetime.now()
+    for count, pks in byCount.items():
+        MemPSafe.objects.filter(pk__in=pks).update(
+                                                   entryUseCount=F('entryUseCount') + count,
+                                                   entryLastUsed=now,
+                                                   )
+    log.debug("Flushed usage for %d safes in %d queries", len(pending), len(byCount))
+    return len(pending)
+
+
+def _flushAtExit():
+    try:
+        flushUsage()
+    except Exception, e:
+        log.warn("Failed to flush usage counters on exit: %r", e)
+atexit.register(_flushAtExit)
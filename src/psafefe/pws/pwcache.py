@@ -4,84 +4,354 @@ Created on Jul 13, 2012
 @author: Paulson McIntyre (GpMidi) <paul@gpmidi.net>
 '''
 from pypwsafe import PWSafe3, ispsafe3
+from psafefe.utils import isSaveTempFile
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Thread
+import struct
+import hmac
+import mmap
+import time
 import os
 
 import logging
 log = logging.getLogger(__name__)
 
+# Start of a psafe v3 file: tag, salt, key stretch iterations, H(P')
+HEADER_FORMAT = '<4s32sI32s'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Key for the password digests in PWSLocCache.passwordMemo. Random per 
+# process so the memo can't be used to test passwords offline. 
+_memoKey = os.urandom(32)
+
+def readHeader(fil):
+    """ Returns a tuple of (salt, iterations, H(P')) from a psafe v3 file
+    @raise ValueError: Not a psafe v3 file
+    """
+    f = open(fil, 'rb')
+    try:
+        raw = f.read(HEADER_SIZE)
+    finally:
+        f.close()
+    if len(raw) != HEADER_SIZE:
+        raise ValueError("%r is too short to be a psafe v3 file" % fil)
+    tag, salt, iterations, hP = struct.unpack(HEADER_FORMAT, raw)
+    if tag != 'PWS3':
+        raise ValueError("%r isn't a psafe v3 file" % fil)
+    return salt, iterations, hP
+
+def _passwordBytes(password):
+    """ Safe passwords are hashed as UTF-8 """
+    if isinstance(password, unicode):
+        return password.encode('utf-8')
+    return password
+
+def checkPassword(password, header):
+    """ Returns True if password is the safe's password. Only runs the key
+    stretching and compares it to H(P') from the header. Nothing is decrypted. """
+    salt, iterations, hP = header
+    key = sha256(_passwordBytes(password) + salt).digest()
+    for i in xrange(iterations):
+        key = sha256(key).digest()
+    return sha256(key).digest() == hP
+
+def _findPassword(job):
+    """ Returns the index of the password in the (header, passwords) job that
+    opens the safe or None. """
+    header, passwords = job
+    for i, password in enumerate(passwords):
+        try:
+            if checkPassword(password, header):
+                return i
+        except Exception, e:
+            # One bad password or header shouldn't fail the whole batch
+            log.debug("Couldn't check password %d against %r: %r" % (i, header, e))
+    return None
+
+def findPasswords(jobs):
+    """ Run _findPassword for each (header, passwords) job in this process. 
+    Celery worker processes are daemonic and can't start a pool of their own. 
+    @return: A list of password indexes or None, in the same order as jobs
+    """
+    return [_findPassword(job) for job in jobs]
+
+def _passwordDigest(password):
+    return hmac.new(_memoKey, _passwordBytes(password), sha256).digest()
+
+def _passwordSetDigest(passwords):
+    """ Keyed digest of a set of passwords. Changes if any are added or removed. """
+    return hmac.new(_memoKey, '\0'.join(sorted(set([_passwordBytes(i) for i in passwords]))), sha256).digest()
+
+def _fileKey(info):
+    """ The parts of an os.stat result that change if the file does """
+    return (info.st_ino, info.st_mtime, info.st_size)
+
 class CachedPWS(PWSafe3):
     """ A cache-enabled psafe object """
     # Safe's last-modified timestamp
     psafeLastModified = None
     # The psafe file's size
     psafeSize = None
+    # The psafe file's inode. Changes when a save renames a new file into place. 
+    psafeInode = None
+    # Seconds after a check that the safe is trusted without looking at the file again. 
+    # 0 to check the file on every checkUpdate. 
+    freshness = 0
+    # Map the file when reloading it instead of reading it. Only safe if nothing
+    # rewrites safe files in place, e.g. over NFS. A mapped file that's truncated
+    # under us kills the process with SIGBUS. 
+    useMmap = False
+    # When the file was last found to be unchanged
+    checkedAt = None
         
     def __init__(self, filename, password):
         log.debug("Caching safe %r" % filename)
-        PWSafe3.__init__(self, filename = filename, password = password, mode = "RO")
+        # Stat first so a change during the load is seen by the next check
+        info = os.stat(filename)
+        PWSafe3.__init__(self, filename = filename, password = _passwordBytes(password), mode = "RO")
+        # Only the decrypted records are needed from here on
+        self.flfull = None
+        self._setSafeInfo(info)
         log.debug("Safe loading completed for %r" % self)
     
-    def _setSafeInfo(self):
+    def _setSafeInfo(self, info = None):
         """ Update the psafe file info used to check for changes """
         log.debug("Updating safe file stats for %r" % self)
-        assert os.access(self.filename, os.R_OK)
-        info = os.stat(self.filename)
+        if info is None:
+            assert os.access(self.filename, os.R_OK)
+            info = os.stat(self.filename)
         self.psafeLastModified = info.st_mtime
-        self.psafeSize = info.st_size        
+        self.psafeSize = info.st_size
+        self.psafeInode = info.st_ino
+        self.checkedAt = time.time()
     
-    def _changed(self):
-        """ Return true if there have been any changes per quick checks """
-        assert os.access(self.filename, os.R_OK)
-        info = os.stat(self.filename)
+    def _changed(self, info = None):
+        """ Return true if there have been any changes per quick checks 
+        @param info: The file's os.stat result, if already known
+        """
+        if info is None:
+            assert os.access(self.filename, os.R_OK)
+            info = os.stat(self.filename)
         if self.psafeLastModified != info.st_mtime:
             log.debug("Quick info changed st_mtime: %r vs %r" % (self.psafeLastModified, info.st_mtime))
             return True
         if self.psafeSize != info.st_size:
             log.debug("Quick info changed st_size: %r vs %r" % (self.psafeSize, info.st_size))
             return True
+        if self.psafeInode != info.st_ino:
+            log.debug("Quick info changed st_ino: %r vs %r" % (self.psafeInode, info.st_ino))
+            return True
         log.debug("%r hasn't changed" % self)
         return False        
+    
+    def isFresh(self):
+        """ True if the safe was checked within the last freshness seconds """
+        return bool(self.freshness and self.checkedAt is not None and time.time() - self.checkedAt < self.freshness)
         
-    def checkUpdate(self):
-        """ Check common, quick info to make sure the safe doesn't need to be updated """
-        if self._changed():
+    def checkUpdate(self, force = False):
+        """ Check common, quick info to make sure the safe doesn't need to be updated.
+        Does nothing if the safe is still fresh, unless force is True. """
+        if not force and self.isFresh():
+            log.debug("%r is fresh. Not checking. " % self)
+            return
+        info = os.stat(self.filename)
+        if self._changed(info):
             log.debug("Loading existing safe from %r" % self.filename)
             self.fl = open(self.filename, 'rb')
             try:
-                self.flfull = self.fl.read()
+                if self.useMmap:
+                    # Map the file rather than copying it into a string. Saves rename a
+                    # new file into place so the mapped one doesn't change under us. 
+                    try:
+                        self.flfull = mmap.mmap(self.fl.fileno(), 0, access = mmap.ACCESS_READ)
+                    except (mmap.error, ValueError), e:
+                        log.debug("Can't mmap %r. Reading it instead. Error: %r" % (self.filename, e))
+                        self.flfull = self.fl.read()
+                else:
+                    self.flfull = self.fl.read()
                 log.debug("Full data len: %d" % len(self.flfull))                
                 # Read in file
                 self.load()
             finally:
+                if isinstance(self.flfull, mmap.mmap):
+                    self.flfull.close()
+                # Only the decrypted records are needed from here on
+                self.flfull = None
                 self.fl.close()
             # Update file stats
-            self._setSafeInfo()
+            self._setSafeInfo(info)
         else:
+            self.checkedAt = time.time()
             log.debug("%r hasn't changed" % self)
 
 class PWSLocCache(object):
     """ Holds one or more cached psafe objects (read-only)
     
+    At most maxSafes safes and maxBytes of (estimated) safe data are kept. The
+    least recently used safes are dropped first and reloaded when next asked for. 
     """
     # Path to safes
     loc = None
     
-    # Known safe passwords
-    safePasswords = []
-    
     # Psafe password lookup function
     passwordLookup = None
     
-    # Cached safe objects
-    # Full filename path is the key
-    safes = {}
+    # Max number of cached safes. None for no limit. 
+    maxSafes = None
     
-    def __init__(self, loc, safePasswords = [], passwordLookup = None):        
+    # Max estimated bytes of cached safes. None for no limit. 
+    maxBytes = None
+    
+    # Seconds a cached safe is used without checking its file. See CachedPWS.freshness. 
+    freshness = 0
+    
+    # Seconds between background checks of all cached safes' files. 0 for none. 
+    sweepInterval = 0
+    
+    # Map safe files when reloading them. See CachedPWS.useMmap. 
+    useMmap = False
+    
+    def __init__(self, loc, safePasswords = [], passwordLookup = None, maxSafes = None, maxBytes = None, freshness = 0, sweepInterval = 0, useMmap = False):        
         self.loc = loc
-        self.safePasswords = safePasswords
+        # Known safe passwords
+        self.safePasswords = list(safePasswords)
         self.passwordLookup = passwordLookup
+        self.maxSafes = maxSafes
+        self.maxBytes = maxBytes
+        self.freshness = freshness
+        self.sweepInterval = sweepInterval
+        self.useMmap = useMmap
+        self.sweeper = None
+        self.sweeps = 0
+        # (inode, salt) => keyed digest of the password that opened it
+        self.passwordMemo = {}
+        # Files that aren't safes, or that none of the passwords opened. 
+        # filename => _fileKey + (_passwordSetDigest or None for non-safes, )
+        self.negative = {}
+        # Cached safe objects, least recently used first
+        # Full filename path is the key
+        self.safes = OrderedDict()
+        # Estimated size of each cached safe and their total
+        self.sizes = {}
+        self.cachedBytes = 0
+        # Every safe we've been able to open, cached or not
+        self.known = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
         # Check for safes to cache!
         self.checkLoc()
+        self.startSweeper()
+    
+    def _estimateSize(self, safe):
+        """ Estimated memory used by a cached safe. The decrypted records are 
+        about the size of the encrypted file. """
+        return safe.psafeSize or os.path.getsize(safe.filename)
+    
+    def _store(self, fil, safe):
+        """ Cache a newly opened safe, dropping the least recently used safes if over the limits """
+        if fil in self.safes:
+            del self.safes[fil]
+            self.cachedBytes -= self.sizes.pop(fil)
+        safe.freshness = self.freshness
+        safe.useMmap = self.useMmap
+        self.safes[fil] = safe
+        self.sizes[fil] = self._estimateSize(safe)
+        self.cachedBytes += self.sizes[fil]
+        self.known.add(fil)
+        self.negative.pop(fil, None)
+        while len(self.safes) > 1 and (
+                                       (self.maxSafes is not None and len(self.safes) > self.maxSafes)
+                                       or (self.maxBytes is not None and self.cachedBytes > self.maxBytes)
+                                       ):
+            old, oldSafe = self.safes.popitem(last = False)
+            self.cachedBytes -= self.sizes.pop(old)
+            self.evictions += 1
+            log.debug("Evicted %r from the cache of %r" % (old, self.loc))
+    
+    def _get(self, fil):
+        """ Returns the cached safe and marks it as recently used. None if it isn't cached. """
+        safe = self.safes.pop(fil, None)
+        if safe is not None:
+            self.safes[fil] = safe
+        return safe
+    
+    def stats(self):
+        """ Returns a dict of cache sizes, limits and counters """
+        return dict(
+                    loc = self.loc,
+                    safes = len(self.safes),
+                    bytes = self.cachedBytes,
+                    known = len(self.known),
+                    maxSafes = self.maxSafes,
+                    maxBytes = self.maxBytes,
+                    negative = len(self.negative),
+                    freshness = self.freshness,
+                    sweeps = self.sweeps,
+                    hits = self.hits,
+                    misses = self.misses,
+                    evictions = self.evictions,
+                    )
+    
+    def expire(self, fil):
+        """ Make the next lookup of the safe check its file, even if it's fresh. Call after writing it. """
+        safe = self.safes.get(fil)
+        if safe is not None:
+            safe.checkedAt = None
+    
+    def setFreshness(self, freshness):
+        """ Change the freshness window of the loc and its cached safes """
+        self.freshness = freshness
+        for safe in self.safes.values():
+            safe.freshness = freshness
+    
+    def setUseMmap(self, useMmap):
+        """ Change whether the loc's cached safes map their files when reloading """
+        self.useMmap = useMmap
+        for safe in self.safes.values():
+            safe.useMmap = useMmap
+    
+    def sweep(self):
+        """ Check the files of all cached safes in one pass. Unchanged safes are
+        marked as fresh, so lookups within the freshness window don't touch
+        the filesystem. Changed safes are left to be reloaded by their next lookup. 
+        """
+        try:
+            safes = self.safes.items()
+        except (RuntimeError, KeyError), e:
+            # Changed by a lookup while copying. Try again next time. 
+            log.debug("Cache of %r changed during sweep: %r" % (self.loc, e))
+            return
+        for fil, safe in safes:
+            started = time.time()
+            try:
+                info = os.stat(fil)
+            except OSError, e:
+                log.debug("Can't stat %r: %r" % (fil, e))
+                safe.checkedAt = None
+                continue
+            if safe._changed(info):
+                safe.checkedAt = None
+            else:
+                safe.checkedAt = started
+        self.sweeps += 1
+        log.debug("Swept %d safes in %r" % (len(safes), self.loc))
+    
+    def startSweeper(self):
+        """ Start the background sweep thread if sweepInterval is set and it isn't running """
+        if self.sweepInterval and (self.sweeper is None or not self.sweeper.is_alive()):
+            self.sweeper = Thread(target = self._sweepLoop, name = "pwcache sweep of %s" % self.loc)
+            self.sweeper.daemon = True
+            self.sweeper.start()
+    
+    def _sweepLoop(self):
+        while self.sweepInterval:
+            time.sleep(self.sweepInterval)
+            try:
+                self.sweep()
+            except Exception, e:
+                log.warn("Sweep of %r failed: %r" % (self.loc, e))
     
     def addSafePassword(self, passwd, update = False):
         """ Add a safe decryption password to known list. If update
@@ -103,16 +373,36 @@ class PWSLocCache(object):
         """ Check for new, uncached safes in the loc """
         log.debug("Going to check for new safes to cache in %r" % self.loc)
         assert os.access(self.loc, os.R_OK)
+        new = []
+        seen = set()
+        passwordsDigest = _passwordSetDigest(self.safePasswords)
         
         for (dirpath, dirnames, filenames) in os.walk(self.loc):
             log.debug("Checking %r" % dirpath)
             for filename in filenames:
                 fil = os.path.join(self.loc, dirpath, filename)
+                if isSaveTempFile(fil):
+                    log.debug("Skipping save in progress %r" % fil)
+                    continue
                 log.debug("Check file %r" % fil)
                 if self.safes.has_key(fil):
                     log.debug("Safe exists. Updating")
                     self.safes[fil].checkUpdate()
+                elif fil in self.known:
+                    log.debug("Safe was evicted. Will reload when asked for. ")
                 else:
+                    seen.add(fil)
+                    try:
+                        fileKey = _fileKey(os.stat(fil))
+                    except OSError, e:
+                        log.debug("Can't stat %r: %r" % (fil, e))
+                        continue
+                    if self.negative.get(fil) == fileKey + (None, ):
+                        log.debug("Still not a psafe v3")
+                        continue
+                    if not self.passwordLookup and self.negative.get(fil) == fileKey + (passwordsDigest, ):
+                        log.debug("None of the passwords opened %r last time and nothing has changed" % fil)
+                        continue
                     log.debug("Don't have in cache...adding")
                     if ispsafe3(fil):
                         if self.passwordLookup:
@@ -120,19 +410,83 @@ class PWSLocCache(object):
                                 pw = self.passwordLookup(fil)
                                 if not pw in self.safePasswords:
                                     self.safePasswords.append(pw)
+                                    passwordsDigest = _passwordSetDigest(self.safePasswords)
                                     log.debug("Added %r to safe pw list" % (pw))
                             except Exception, e:
                                 log.warn("Tried doing a pw lookup for %r. Error: %r" % (fil, e))
-                        for passwd in self.safePasswords:
-                            log.debug("Trying to open safe %r with %r" % (fil, passwd))
-                            try:
-                                self.safes[fil] = CachedPWS(fil, passwd)
-                                log.debug("Cached %r" % self.safes[fil])
-                            except:
-                                log.debug("Failed to open safe %r with %r" % (fil, passwd))
+                            if self.negative.get(fil) == fileKey + (passwordsDigest, ):
+                                log.debug("None of the passwords opened %r last time and nothing has changed" % fil)
+                                continue
+                        new.append(fil)
                     else:
                         log.debug("Not a psafe v3")
+                        self.negative[fil] = fileKey + (None, )
+        self._openSafes(new, self.safePasswords)
+        # Forget about files that are gone
+        for fil in self.negative.keys():
+            if fil not in seen:
+                del self.negative[fil]
         log.debug("Done walking safe loc")
+    
+    def _open(self, fil, password):
+        """ Load and cache the safe. Returns the CachedPWS or None if it couldn't be opened. """
+        try:
+            safe = CachedPWS(fil, password)
+        except:
+            log.debug("Failed to open safe %r with %r" % (fil, password))
+            return None
+        self._store(fil, safe)
+        log.debug("Cached %r" % fil)
+        return safe
+    
+    def _openSafes(self, files, passwords):
+        """ Open and cache each of the psafe v3 files that one of the passwords works for. 
+        Passwords that opened the same file (by inode and salt) before are tried first. 
+        The others are checked against the file headers. 
+        @return: A dict of filename => CachedPWS for the safes that were opened
+        """
+        ret = {}
+        digests = dict([(_passwordDigest(pw), pw) for pw in passwords])
+        passwordsDigest = _passwordSetDigest(passwords)
+        trials = []
+        for fil in files:
+            try:
+                info = os.stat(fil)
+            except OSError, e:
+                log.debug("Can't stat %r: %r" % (fil, e))
+                continue
+            try:
+                header = readHeader(fil)
+            except (IOError, ValueError), e:
+                log.debug("Can't read the header of %r: %r" % (fil, e))
+                self.negative[fil] = _fileKey(info) + (None, )
+                continue
+            memoKey = (info.st_ino, header[0])
+            pw = digests.get(self.passwordMemo.get(memoKey))
+            if pw is not None:
+                log.debug("Memo has the password for %r" % fil)
+                safe = self._open(fil, pw)
+                if safe is not None:
+                    ret[fil] = safe
+                    continue
+            trials.append((fil, memoKey, header, info))
+        if not trials:
+            return ret
+        passwords = list(passwords)
+        log.debug("Checking %d passwords against %d safes" % (len(passwords), len(trials)))
+        found = findPasswords([(header, passwords) for fil, memoKey, header, info in trials])
+        for (fil, memoKey, header, info), i in zip(trials, found):
+            if i is None:
+                log.debug("None of the passwords work for %r" % fil)
+                self.negative[fil] = _fileKey(info) + (passwordsDigest, )
+                continue
+            self.passwordMemo[memoKey] = _passwordDigest(passwords[i])
+            safe = self._open(fil, passwords[i])
+            if safe is not None:
+                ret[fil] = safe
+            else:
+                self.negative[fil] = _fileKey(info) + (passwordsDigest, )
+        return ret
         
     def checkUpdateAll(self):
         """ Check and, if required, update all safes """
@@ -145,60 +499,83 @@ class PWSLocCache(object):
     def getSafe(self, psafeLoc, passwords = []):
         """ Fetch a psafe object. Safe password MUST be one of the passwords passed in. """
         log.debug("Asked to fetch psafe %r using %r" % (psafeLoc, passwords))
-        if self.safes.has_key(psafeLoc):
-            self.safes[psafeLoc].checkUpdate()
+        safe = self._get(psafeLoc)
+        if safe is not None:
+            self.hits += 1
+            safe.checkUpdate()
             for pw in passwords:
-                if self.safes[psafeLoc].password == pw:
-                    log.debug("Returning safe %r" % self.safes[psafeLoc])
-                    return self.safes[psafeLoc]
+                if safe.password == _passwordBytes(pw):
+                    log.debug("Returning safe %r" % safe)
+                    return safe
             log.debug("No passwords matched")
             return None
+        self.misses += 1
+        if psafeLoc in self.known:
+            log.debug("Evicted. Reloading. ")
+            safe = self._openSafes([psafeLoc], passwords).get(psafeLoc)
+            if safe is None:
+                log.debug("No passwords matched")
+            return safe
         else:
             log.debug("Not cached")
-            update = False
             for pw in passwords:
                 if not pw in self.safePasswords:
                     log.debug("%r isn't already listed" % pw)
-                    update = True
                     self.safePasswords.append(pw)
                 else:
                     log.debug("%r is already in our list. Ignoring. " % pw)
-            if update:
-                self.checkLoc()
-                log.debug("Updated cached safes")
-            # Check again for cached safe
-            if self.safes.has_key(psafeLoc):
-                self.safes[psafeLoc].checkUpdate()
-                for pw in passwords:
-                    if self.safes[psafeLoc].password == pw:
-                        log.debug("Returning safe %r" % self.safes[psafeLoc])
-                        return self.safes[psafeLoc]
-                log.debug("No passwords matched")
-                return None
+            # Only try the requested safe rather than walking the whole loc again. 
+            # Other safes the new passwords open are found by the next checkLoc. 
+            inLoc = os.path.abspath(psafeLoc).startswith(os.path.join(os.path.abspath(self.loc), ''))
+            if inLoc and os.access(psafeLoc, os.R_OK) and ispsafe3(psafeLoc):
+                safe = self._openSafes([psafeLoc], passwords).get(psafeLoc)
+                if safe is not None:
+                    log.debug("Returning safe %r" % safe)
+                    return safe
             log.debug("Couldn't load %r using %r" % (psafeLoc, passwords))
             return None
                 
 # Primary psafe cache object storage
 cache = {}
 
-def addLoc(loc, passwords = [], passwordLookup = None):
-    """ Add psafe loading/cache for the given loc """
+def addLoc(loc, passwords = [], passwordLookup = None, maxSafes = None, maxBytes = None, freshness = None, sweepInterval = None, useMmap = None):
+    """ Add psafe loading/cache for the given loc. maxSafes and maxBytes 
+    limit the size of the loc's cache. freshness and sweepInterval control
+    how often cached safes' files are checked. useMmap maps safe files instead of
+    reading them. See PWSLocCache and CachedPWS. If the loc already exists, options
+    that aren't None replace the current ones. """
     global cache
     if cache.has_key(loc):
         log.debug("Already have %r" % loc)
+        if maxSafes is not None:
+            cache[loc].maxSafes = maxSafes
+        if maxBytes is not None:
+            cache[loc].maxBytes = maxBytes
+        if freshness is not None:
+            cache[loc].setFreshness(freshness)
+        if sweepInterval is not None:
+            cache[loc].sweepInterval = sweepInterval
+            cache[loc].startSweeper()
+        if useMmap is not None:
+            cache[loc].setUseMmap(useMmap)
         for passwd in passwords:
             cache[loc].addSafePassword(passwd, update = True)
     else:
         log.debug("Don't have %r. Adding with %r & %r" % (loc, passwords, passwordLookup))
-        cache[loc] = PWSLocCache(loc, safePasswords = passwords, passwordLookup = passwordLookup)
+        cache[loc] = PWSLocCache(loc, safePasswords = passwords, passwordLookup = passwordLookup, maxSafes = maxSafes, maxBytes = maxBytes, freshness = freshness or 0, sweepInterval = sweepInterval or 0, useMmap = bool(useMmap))
     log.debug("Done adding %r" % loc)
 
-def getSafeList(loc, passwords = []):
-    """ Return a list of known psafe files. Runs an update first. """
-    addLoc(loc = loc, passwords = passwords)
+def getSafeList(loc, passwords = [], **kw):
+    """ Return a list of known psafe files. Runs an update first. Extra kwargs are passed to addLoc. """
+    addLoc(loc = loc, passwords = passwords, **kw)
     global cache
     c = cache[loc]
-    return c.safes.keys()
+    return sorted(c.known)
+
+def getStats():
+    """ Return a list of PWSLocCache.stats() dicts, one per loc """
+    global cache
+    return [c.stats() for c in cache.values()]
 
 def getSafe(loc, psafeLoc, passwords = []):
     """ Return the cached (or freshly loaded) psafe from psafeLoc using 
@@ -211,5 +588,9 @@ def getSafe(loc, psafeLoc, passwords = []):
     
     return cache[loc].getSafe(psafeLoc, passwords)
 
-
-
+def expireSafe(loc, psafeLoc):
+    """ Make this process's next lookup of psafeLoc check the file. Other processes
+    see the change once it's older than their freshness window. """
+    global cache
+    if cache.has_key(loc):
+        cache[loc].expire(psafeLoc)
@@ -28,7 +28,7 @@ import stat
 from datetime import timedelta
 import os, os.path
 import psafefe.pws.pwcache
-import re
+from psafefe.utils import compilePattern, literalPrefix
 
 @task(ignore_result = False, expires = 60 * 60)
 def lookupByUUID(loc, uuid, psafeLoc, passwords = []):
@@ -70,20 +70,20 @@ def lookupByInfo(loc, psafeLoc, passwords = [], title = None, group = None, user
     """
     from safe import getSafe
     safe = getSafe(loc = loc, psafeLoc = psafeLoc, passwords = passwords)
-    if title:
-        title = re.compile(title)
-    if group:
-        group = re.compile(group)
-    if username:
-        username = re.compile(username)
+    selectors = []
+    for field, raw in (('Title', title), ('Group', group), ('Username', username)):
+        if raw:
+            selectors.append((field, literalPrefix(raw), compilePattern(raw)))
     for uuid, entry in safe.items():
         match = True
-        if title:
-            match = match and title.match(entry['Title'])
-        if group:
-            match = match and title.match(entry['Group'])
-        if username:
-            match = match and title.match(entry['UsernameRecordProp'])
+        for field, prefix, pattern in selectors:
+            value = entry.get(field)
+            if isinstance(value, list):
+                value = '.'.join(value)
+            # Cheap prefix check before running the regex
+            if value is None or not value.startswith(prefix) or not pattern.match(value):
+                match = False
+                break
         if match:
             log.debug("Entry %r matches. Keeping. " % uuid)
         else:
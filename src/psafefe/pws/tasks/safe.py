@@ -28,6 +28,17 @@ import stat
 from datetime import timedelta
 import os, os.path
 import psafefe.pws.pwcache
+from django.conf import settings
+
+def _cacheOptions():
+    """ Returns the cache options from the settings as kwargs for pwcache """
+    return dict(
+                maxSafes = getattr(settings, 'PWS_CACHE_MAX_SAFES', None),
+                maxBytes = getattr(settings, 'PWS_CACHE_MAX_BYTES', None),
+                freshness = getattr(settings, 'PWS_CACHE_FRESHNESS', None),
+                sweepInterval = getattr(settings, 'PWS_CACHE_SWEEP_INTERVAL', None),
+                useMmap = getattr(settings, 'PWS_CACHE_MMAP', None),
+                )
 
 @task(ignore_result = False, expires = 24 * 60 * 60)
 def addLoc(loc, passwords = []):
@@ -39,7 +50,7 @@ def addLoc(loc, passwords = []):
     @type passwords: List of strings
     @return: None
     """
-    return psafefe.pws.pwcache.addLoc(loc = loc, passwords = passwords, passwordLookup = None)
+    return psafefe.pws.pwcache.addLoc(loc = loc, passwords = passwords, passwordLookup = None, **_cacheOptions())
 
 @task(ignore_result = False, expires = 60 * 60)
 def getSafeList(loc, passwords = []):
@@ -50,7 +61,7 @@ def getSafeList(loc, passwords = []):
     @type passwords: List of strings
     @return: List of strings/filepaths
     """
-    return psafefe.pws.pwcache.getSafeList(loc = loc, passwords = passwords)
+    return psafefe.pws.pwcache.getSafeList(loc = loc, passwords = passwords, **_cacheOptions())
     
 @task(ignore_result = False, expires = 60 * 60)
 def getSafe(loc, psafeLoc, passwords):
@@ -74,3 +85,12 @@ def getSafe(loc, psafeLoc, passwords):
         return ret
     else:
         return {}
+
+@task(ignore_result = False, expires = 60 * 60)
+def getCacheStats():
+    """ Return the cache stats of the worker that runs this task. Each worker
+    process has its own cache. 
+    @return: A list of dicts, one per repo loc, with the number of cached and known safes, 
+    estimated bytes, limits and hit/miss/eviction counters. 
+    """
+    return psafefe.pws.pwcache.getStats()
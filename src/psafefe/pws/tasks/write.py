@@ -32,6 +32,8 @@ log = logging.getLogger(__name__)
 
 from celery.decorators import task, periodic_task #@UnresolvedImport
 from pypwsafe import PWSafe3, ispsafe3, Record
+from psafefe.utils import atomicSave
+from psafefe.pws.pwcache import expireSafe
 import stat
 from datetime import timedelta
 import os, os.path
@@ -124,7 +126,8 @@ def addUpdateDevice(device, loc, psafeLoc, logins = {}, info = {}, passwords = [
                 log.debug("Added record %r" % r)
         
         log.debug("Saving safe")
-        safe.save()
+        atomicSave(safe)
+        expireSafe(loc, psafeLoc)
         log.debug("Saved safe")
     finally:
         log.debug("Unlocking safe %r" % psafeLoc)
@@ -171,7 +174,8 @@ def addUpdateByUUID(loc, uuid, psafeLoc, passwords = [], info = {}):
             r[name] = val
         
         log.debug("Saving safe")
-        safe.save()
+        atomicSave(safe)
+        expireSafe(loc, psafeLoc)
         log.debug("Saved safe")
     finally:
         log.debug("Unlocking safe %r" % psafeLoc)
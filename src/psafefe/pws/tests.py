@@ -1,16 +1,246 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
-"""
-
-from django.test import TestCase
-
-
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+''' Tests for the pws app
+'''
+from django.test import TestCase
+from hashlib import sha256
+import tempfile
+import shutil
+import struct
+import os, os.path
+
+
+def writeHeader(fil, password, iterations = 16):
+    """ Write just the start of a psafe v3 file for password """
+    salt = os.urandom(32)
+    key = sha256(password + salt).digest()
+    for i in range(iterations):
+        key = sha256(key).digest()
+    open(fil, 'wb').write(struct.pack('<4s32sI32s', 'PWS3', salt, iterations, sha256(key).digest()))
+
+
+class FakeCachedPWS(object):
+    """ Quacks like a CachedPWS. Only checks the password. """
+    opened = 0
+
+    def __init__(self, filename, password):
+        from psafefe.pws.pwcache import readHeader, checkPassword
+        if not checkPassword(password, readHeader(filename)):
+            raise ValueError("Bad password")
+        FakeCachedPWS.opened += 1
+        self.filename = filename
+        self.password = password
+        self.psafeSize = 100
+
+    def checkUpdate(self):
+        pass
+
+
+class PWSLocCacheTests(TestCase):
+    """ Per-loc safe cache limits. Doesn't need real safes. """
+
+    def setUp(self):
+        import psafefe.pws.pwcache as pwcache
+        self.pwcache = pwcache
+        self.oldCachedPWS = pwcache.CachedPWS
+        self.oldIsPsafe3 = pwcache.ispsafe3
+        pwcache.CachedPWS = FakeCachedPWS
+        pwcache.ispsafe3 = lambda fil: True
+        self.loc = tempfile.mkdtemp()
+        self.files = []
+        for i in range(4):
+            fil = os.path.join(self.loc, "safe%d.psafe3" % i)
+            writeHeader(fil, "pw%d" % i)
+            self.files.append(fil)
+
+    def tearDown(self):
+        self.pwcache.CachedPWS = self.oldCachedPWS
+        self.pwcache.ispsafe3 = self.oldIsPsafe3
+        shutil.rmtree(self.loc)
+
+    def test_lru(self):
+        c = self.pwcache.PWSLocCache(self.loc, safePasswords = ['pw0', 'pw1', 'pw2', 'pw3'], maxSafes = 2)
+        self.assertEqual(len(c.safes), 2)
+        self.assertEqual(sorted(c.known), self.files)
+        self.assertEqual(c.evictions, 2)
+        cached = list(c.safes.keys())
+        # Use the older one so the other is evicted next
+        self.assertTrue(c.getSafe(cached[0], ['pw0', 'pw1', 'pw2', 'pw3']))
+        evicted = [i for i in self.files if i not in cached][0]
+        self.assertTrue(c.getSafe(evicted, ['pw%d' % self.files.index(evicted)]))
+        self.assertEqual(list(c.safes.keys()), [cached[0], evicted])
+        stats = c.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 1, 3))
+        self.assertEqual(stats['bytes'], 200)
+
+    def test_maxBytes(self):
+        c = self.pwcache.PWSLocCache(self.loc, safePasswords = ['pw0', 'pw1', 'pw2', 'pw3'], maxBytes = 250)
+        self.assertEqual(len(c.safes), 2)
+        self.assertEqual(c.stats()['bytes'], 200)
+
+    def test_perInstance(self):
+        other = tempfile.mkdtemp()
+        try:
+            a = self.pwcache.PWSLocCache(self.loc, safePasswords = ['pw0'])
+            b = self.pwcache.PWSLocCache(other, safePasswords = ['pw1'])
+            self.assertEqual(len(a.safes), 1)
+            self.assertEqual(len(b.safes), 0)
+            self.assertEqual(b.safePasswords, ['pw1'])
+        finally:
+            shutil.rmtree(other)
+
+    def test_checkPassword(self):
+        from psafefe.pws.pwcache import readHeader, checkPassword, findPasswords
+        header = readHeader(self.files[2])
+        self.assertTrue(checkPassword('pw2', header))
+        self.assertFalse(checkPassword('pw1', header))
+        jobs = [(readHeader(fil), ['pw3', 'pw0', 'bogus']) for fil in self.files]
+        self.assertEqual(findPasswords(jobs), [1, None, None, 0])
+        bad = os.path.join(self.loc, 'notes.txt')
+        open(bad, 'w').write('Not a safe')
+        self.assertRaises(ValueError, readHeader, bad)
+
+    def test_checkPasswordUnicode(self):
+        from psafefe.pws.pwcache import readHeader, checkPassword, findPasswords
+        password = u'p\xe4ssw\xf6rd'
+        writeHeader(self.files[0], password.encode('utf-8'))
+        header = readHeader(self.files[0])
+        self.assertTrue(checkPassword(password, header))
+        self.assertTrue(checkPassword(password.encode('utf-8'), header))
+        self.assertFalse(checkPassword(u'\xe4', header))
+        # A bad job or password doesn't stop the others
+        jobs = [(('salt', None, 'hP'), ['pw0']), (header, [None, password]), (readHeader(self.files[1]), ['pw1'])]
+        self.assertEqual(findPasswords(jobs), [None, 1, 0])
+
+    def test_memo(self):
+        c = self.pwcache.PWSLocCache(self.loc, safePasswords = ['pw0', 'pw1', 'pw2', 'pw3'], maxSafes = 1)
+        self.assertEqual(len(c.passwordMemo), 4)
+        FakeCachedPWS.opened = 0
+        # Evicted safes are reopened with the remembered password
+        calls = []
+        old = self.pwcache.findPasswords
+        self.pwcache.findPasswords = lambda jobs: calls.append(jobs) or old(jobs)
+        try:
+            evicted = [fil for fil in self.files if fil not in c.safes][0]
+            self.assertTrue(c.getSafe(evicted, ['pw3', 'pw2', 'pw1', 'pw0']))
+        finally:
+            self.pwcache.findPasswords = old
+        self.assertEqual(calls, [])
+        self.assertEqual(FakeCachedPWS.opened, 1)
+
+    def test_getSafeNoWalk(self):
+        c = self.pwcache.PWSLocCache(self.loc, safePasswords = ['pw0'])
+        walks = []
+        c.checkLoc = lambda: walks.append(1)
+        self.assertTrue(c.getSafe(self.files[1], ['pw1']))
+        self.assertEqual(walks, [])
+        self.assertTrue('pw1' in c.safePasswords)
+
+    def test_negative(self):
+        notSafe = os.path.join(self.loc, 'notes.txt')
+        open(notSafe, 'w').write('Not a safe')
+        checked = []
+        self.pwcache.ispsafe3 = lambda fil: checked.append(fil) or fil != notSafe
+        c = self.pwcache.PWSLocCache(self.loc, safePasswords = ['pw0', 'pw1'])
+        self.assertEqual(sorted(c.known), self.files[:2])
+        self.assertEqual(len(c.negative), 3)
+        # Nothing changed so nothing is checked again
+        del checked[:]
+        c.checkLoc()
+        self.assertEqual(checked, [])
+        # New password. Only the safes are tried again. 
+        c.addSafePassword('pw2', update = True)
+        self.assertEqual(sorted(checked), self.files[2:])
+        self.assertEqual(sorted(c.known), self.files[:3])
+        # Changed file
+        del checked[:]
+        writeHeader(self.files[3], 'pw0')
+        c.checkLoc()
+        self.assertEqual(checked, [self.files[3]])
+        self.assertEqual(c.stats()['negative'], 1)
+        os.remove(notSafe)
+        c.checkLoc()
+        self.assertEqual(c.negative, {})
+
+    def test_saveTempFile(self):
+        checked = []
+        self.pwcache.ispsafe3 = lambda fil: checked.append(fil) or True
+        tmp = os.path.join(self.loc, '.safe0.psafe3.a1b2c3.psafefe-save.tmp')
+        writeHeader(tmp, 'pw0')
+        c = self.pwcache.PWSLocCache(self.loc, safePasswords = ['pw0'])
+        self.assertFalse(tmp in checked)
+        self.assertFalse(tmp in c.known)
+        self.assertFalse(tmp in c.negative)
+
+    def _cachedPWS(self, fil):
+        """ A CachedPWS for fil that skips the real load """
+        safe = self.oldCachedPWS.__new__(self.oldCachedPWS)
+        safe.filename = fil
+        safe._setSafeInfo()
+        return safe
+
+    def test_freshness(self):
+        import time
+        safe = self._cachedPWS(self.files[0])
+        checks = []
+        changed = safe._changed
+        safe._changed = lambda info = None: checks.append(1) or changed(info)
+        safe.checkUpdate()
+        self.assertEqual(len(checks), 1)
+        safe.freshness = 60
+        safe.checkUpdate()
+        self.assertEqual(len(checks), 1)
+        safe.checkedAt = time.time() - 120
+        safe.checkUpdate()
+        self.assertEqual(len(checks), 2)
+        safe.checkUpdate(force = True)
+        self.assertEqual(len(checks), 3)
+
+    def test_sweep(self):
+        c = self.pwcache.PWSLocCache(self.loc, freshness = 60)
+        for fil in self.files[:2]:
+            c._store(fil, self._cachedPWS(fil))
+        for safe in c.safes.values():
+            self.assertEqual(safe.freshness, 60)
+            safe.checkedAt = None
+        # Replace one of the files like a save does
+        tmp = self.files[1] + '.tmp'
+        writeHeader(tmp, 'pw1')
+        os.rename(tmp, self.files[1])
+        c.sweep()
+        self.assertTrue(c.safes[self.files[0]].isFresh())
+        self.assertFalse(c.safes[self.files[1]].isFresh())
+        self.assertEqual(c.stats()['sweeps'], 1)
+
+    def test_expire(self):
+        c = self.pwcache.PWSLocCache(self.loc, freshness = 60)
+        c._store(self.files[0], self._cachedPWS(self.files[0]))
+        self.pwcache.cache[self.loc] = c
+        try:
+            self.assertTrue(c.safes[self.files[0]].isFresh())
+            self.pwcache.expireSafe(self.loc, self.files[0])
+            self.assertFalse(c.safes[self.files[0]].isFresh())
+            # Not cached
+            self.pwcache.expireSafe(self.loc, self.files[1])
+            self.pwcache.expireSafe('/nonexistent', self.files[0])
+        finally:
+            del self.pwcache.cache[self.loc]
+
+    def test_mmapLoad(self):
+        import mmap
+        safe = self._cachedPWS(self.files[0])
+        loaded = []
+        safe.load = lambda: loaded.append((type(safe.flfull), len(safe.flfull), safe.flfull[:4]))
+        writeHeader(self.files[0], 'pw9')
+        safe.psafeSize = None
+        safe.checkUpdate()
+        size = os.path.getsize(self.files[0])
+        # Read by default
+        self.assertEqual(loaded, [(str, size, 'PWS3')])
+        safe.useMmap = True
+        safe.psafeSize = None
+        safe.checkUpdate()
+        self.assertEqual(loaded[1], (mmap.mmap, size, 'PWS3'))
+        self.assertEqual(safe.flfull, None)
+        self.assertTrue(safe.fl.closed)
+        c = self.pwcache.PWSLocCache(self.loc, useMmap = True)
+        c._store(self.files[1], self._cachedPWS(self.files[1]))
+        self.assertTrue(c.safes[self.files[1]].useMmap)
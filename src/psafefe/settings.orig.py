@@ -166,7 +166,19 @@ CACHES = {
         'OPTIONS': {
             'MAX_ENTRIES': 100000
         },
-    }
+    },
+    # WARNING: Holds decrypted safe and entry passwords (serialized safes and
+    # search results). Keep it in process memory or on a private server that
+    # only this app can reach. Never point it at a cache shared with other 
+    # apps. Remove it to turn off that caching. 
+    'psafe-secrets': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'psafe-secrets',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000
+        },
+    },
 }
 
 INSTALLED_APPS = (
@@ -266,5 +278,102 @@ PSAFE_RPC_MAX_SAFES = 16 * 1024
 # also returns all entries in the psafe. 
 PSAFE_RPC_MAX_SAFES_RCR = 1024
 
-
-
+# Where decrypted safes are cached. The memory table backend stores them in
+# memory-only DB tables and is required for psafe.search. The compact backend
+# keeps them in each worker's memory. 
+# Options: 'psafefe.psafe.cache.memtable.MemTableCacheBackend' or 
+# 'psafefe.psafe.cache.compact.CompactCacheBackend'
+PSAFE_CACHE_BACKEND = 'psafefe.psafe.cache.memtable.MemTableCacheBackend'
+
+# Cache budget. The coldest safes are evicted after each load once either
+# limit is passed. Rows are cached entries, cached old passwords and their
+# group, text, trigram and password index rows. Use None for no limit. 
+PSAFE_CACHE_MAX_SAFES = None
+PSAFE_CACHE_MAX_ROWS = None
+
+# Safe usage counters are buffered in each process and written to the DB at
+# most this many seconds apart. 
+PSAFE_USAGE_FLUSH_INTERVAL = 30
+
+# The CACHES alias for output that includes decrypted passwords: serialized 
+# safes and search results. See the warning on CACHES['psafe-secrets']. 
+# Nothing is cached if it isn't in CACHES. 
+PSAFE_SECRET_CACHE = 'psafe-secrets'
+
+# Seconds to keep serialized safes (MemPSafe.todict output) in the secret
+# cache. Entries are also dropped whenever the safe is reloaded or evicted. 
+PSAFE_SERIALIZED_CACHE_TIMEOUT = 60 * 60
+
+# Include entry notes in the psafe.search.text index. Notes can be large. 
+PSAFE_TEXT_INDEX_NOTES = False
+
+# The max number of entries a single search RPC call will return
+PSAFE_SEARCH_MAX_RESULTS = 100
+
+# The max number of uncached safes a search will decrypt at the same time
+PSAFE_SEARCH_MAX_PARALLEL_LOADS = 4
+
+# Seconds before psafe.search.filterComplexCached will queue another load of
+# a safe that is still loading
+PSAFE_SEARCH_LOAD_TIMEOUT = 60
+
+# HMAC key for the password digest index used by password reuse searches.
+# None derives a key from SECRET_KEY. Changing it requires reloading all safes. 
+PSAFE_PASSWORD_INDEX_KEY = None
+
+# Seconds to keep psafe.search.filterComplex results in the secret cache. 
+# Results are also dropped whenever one of the searched safes is reloaded. 
+PSAFE_SEARCH_CACHE_TIMEOUT = 5 * 60
+
+# Expiry/age report settings. Entries expiring within PSAFE_EXPIRY_REPORT_DAYS
+# or with a password older than PSAFE_PASSWORD_MAX_AGE_DAYS are reported. 
+PSAFE_EXPIRY_REPORT_DAYS = 14
+PSAFE_PASSWORD_MAX_AGE_DAYS = 180
+
+# modifyEntries calls for the same safe that arrive within this many seconds
+# are merged into one decrypt-save pass. Every call waits this long first, so
+# it's only worth setting when many writes to one safe arrive at once. 
+# 0 disables merging. 
+PSAFE_WRITE_COALESCE_WINDOW = 0
+# Seconds a merged call will wait for another task to apply its changes
+PSAFE_WRITE_COALESCE_TIMEOUT = 5 * 60
+
+# Key for encrypting the write journal. None derives a key from SECRET_KEY.
+# Journaled writes that haven't been applied can't be read after changing it. 
+PSAFE_JOURNAL_KEY = None
+# Seconds before a journaled write that's being applied is assumed to be
+# abandoned and is queued again
+PSAFE_JOURNAL_STALE_TIMEOUT = 10 * 60
+
+# Seconds to hold the chunks of a psafe.write.entry.importEntries upload
+# while waiting for the final chunk
+PSAFE_IMPORT_UPLOAD_TIMEOUT = 60 * 60
+# Max number of chunks in an import upload and max bytes in each chunk
+PSAFE_IMPORT_MAX_CHUNKS = 100
+PSAFE_IMPORT_MAX_CHUNK_SIZE = 1024 * 1024
+
+# Length of passwords generated by psafe.write.rotation.start when the
+# policy doesn't give one
+PSAFE_ROTATION_DEFAULT_LENGTH = 20
+# Seconds after a rotation job starts that its entries still pending are
+# failed. Should be longer than the 24 hour expiry of its tasks. 
+PSAFE_ROTATION_STALE_TIMEOUT = 25 * 60 * 60
+
+# Limits for each repo's in-process safe cache in the pws app. The least
+# recently used safes are dropped when either is exceeded. None for no limit. 
+PWS_CACHE_MAX_SAFES = 500
+PWS_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Seconds a cached pws safe is used without checking if its file changed,
+# and how often each worker checks all of its cached safes in the background.
+# Keep the sweep interval below the freshness window so lookups don't have
+# to check the files themselves. 0 checks the file on every lookup. 
+# Writes by the pws tasks expire the safe in the process that wrote it. Other
+# processes can serve the old entries for up to this long after a write. 
+PWS_CACHE_FRESHNESS = 30
+PWS_CACHE_SWEEP_INTERVAL = 10
+# Map changed pws safe files instead of reading them into memory. Only turn
+# this on if safes are always replaced by renaming a new file into place, as
+# this app does. A mapped file that's rewritten in place, e.g. by another 
+# host over NFS, can crash the worker with SIGBUS. 
+PWS_CACHE_MMAP = False
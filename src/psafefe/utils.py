@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#===============================================================================
+# This file is part of PyPWSafe.
+#
+#    PyPWSafe is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    PyPWSafe is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyPWSafe.  If not, see http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#===============================================================================
+''' Helpers shared by the psafe and pws apps. Nothing in here
+may depend on Django so that it can be used from the pws cache
+workers too. 
+'''
+import logging
+log = logging.getLogger("psafefe.utils")
+log.debug('initing')
+
+from collections import OrderedDict
+from threading import Lock
+import os, os.path
+import re
+import stat
+import tempfile
+
+# Suffix of the temp files atomicSave writes next to a safe
+SAVE_TEMP_SUFFIX = ".psafefe-save.tmp"
+# Max number of compiled patterns kept by compilePattern
+PATTERN_CACHE_SIZE = 256
+_patterns = OrderedDict()
+_patternsLock = Lock()
+# Regex chars that end a literal prefix
+_REGEX_META = set('.^$*+?{}[]\\|()')
+# Escapes that are just the escaped char
+_LITERAL_ESCAPES = set('.^$*+?{}[]\\|()-/ #&~"\'')
+
+def atomicSave(pypwsafe):
+    """ Save the given safe without ever leaving a partially written
+    file at its path. The safe is written to a temp file in the same 
+    directory, fsynced, given the original file's mode/owner and then 
+    renamed over the original. Readers either see the old file or the
+    new one. 
+    @param pypwsafe: An open, RW safe object
+    @type pypwsafe: PWSafe3
+    @return: None
+    @note: The temp file is removed if anything fails. The original file is left untouched. 
+    @note: If the safe's path is a symlink, the file it points to is replaced and the link is kept. 
+    @note: Anything that scans safe dirs should skip names that isSaveTempFile matches. 
+    """
+    path = pypwsafe.filename
+    target = os.path.realpath(path)
+    dirName, baseName = os.path.split(target)
+    fd, tmpPath = tempfile.mkstemp(prefix=".%s." % baseName, suffix=SAVE_TEMP_SUFFIX, dir=dirName)
+    os.close(fd)
+    log.debug("Saving %r via %r", path, tmpPath)
+    try:
+        pypwsafe.filename = tmpPath
+        try:
+            pypwsafe.save()
+        finally:
+            pypwsafe.filename = path
+        # Make sure the data is on disk before it becomes visible
+        fd = os.open(tmpPath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        try:
+            info = os.stat(target)
+            os.chmod(tmpPath, stat.S_IMODE(info.st_mode))
+            try:
+                os.chown(tmpPath, info.st_uid, info.st_gid)
+            except OSError, e:
+                log.debug("Couldn't copy owner of %r to %r: %r", target, tmpPath, e)
+        except OSError:
+            # New safe. mkstemp uses 0600; match what a normal open() would have done. 
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpPath, 0666 & ~umask)
+        os.rename(tmpPath, target)
+    except:
+        log.debug("Failed to save %r. Removing %r", path, tmpPath)
+        if os.access(tmpPath, os.F_OK):
+            os.remove(tmpPath)
+        raise
+    # Persist the rename itself
+    try:
+        fd = os.open(dirName, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError, e:
+        log.debug("Couldn't fsync %r: %r", dirName, e)
+    log.debug("Saved %r", path)
+
+
+def isSaveTempFile(filename):
+    """ Returns True if filename is one of atomicSave's temp files """
+    return os.path.basename(filename).startswith('.') and filename.endswith(SAVE_TEMP_SUFFIX)
+
+
+def compilePattern(raw, flags=0):
+    """ Returns the compiled form of the regex. The most recently used 
+    PATTERN_CACHE_SIZE patterns are kept. Unlike re's own cache, which is
+    emptied when full, old patterns are dropped one at a time. 
+    @raise re.error: The pattern isn't valid
+    """
+    key = (raw, flags)
+    with _patternsLock:
+        pattern = _patterns.pop(key, None)
+        if pattern is None:
+            pattern = re.compile(raw, flags)
+            if len(_patterns) >= PATTERN_CACHE_SIZE:
+                _patterns.popitem(last=False)
+        _patterns[key] = pattern
+    return pattern
+
+
+def literalPrefix(raw):
+    """ Returns the literal text every match of the regex must start with
+    when used with match(). For example 'web.prod' for '^web\\.prod[0-9]+'. 
+    Returns an empty string if there isn't one, or if the pattern could 
+    match without it (alternation, optional chars, inline flags). 
+    """
+    if '|' in raw:
+        return ''
+    prefix = []
+    i = 0
+    if raw.startswith('^'):
+        i = 1
+    while i < len(raw):
+        c = raw[i]
+        if c == '\\':
+            if i + 1 < len(raw) and raw[i + 1] in _LITERAL_ESCAPES:
+                c = raw[i + 1]
+                i += 2
+            else:
+                break
+        elif c in _REGEX_META:
+            break
+        else:
+            i += 1
+        # The last char isn't required if it's followed by a quantifier that allows zero
+        if i < len(raw) and raw[i] in '*?{':
+            break
+        prefix.append(c)
+    return ''.join(prefix)